@@ -0,0 +1,20 @@
+########################################################################################################################
+#                                                          IMPORT                                                      #
+########################################################################################################################
+import argparse
+
+from singleVis.sprite_pack import build_sprite_pack
+########################################################################################################################
+#                                                     LOAD PARAMETERS                                                  #
+########################################################################################################################
+"""Pack content_path/sprites/{idx}.png into one sprites.pack file with an offset index, served by the /spriteBatch endpoint."""
+
+parser = argparse.ArgumentParser(description='Build the sprite pack of a content path...')
+parser.add_argument('--content_path', type=str)
+parser.add_argument('--ext', type=str, default=".png", choices=[".png", ".webp"])
+args = parser.parse_args()
+
+########################################################################################################################
+#                                                           PACK                                                       #
+########################################################################################################################
+build_sprite_pack(args.content_path, ext=args.ext)
@@ -0,0 +1,36 @@
+########################################################################################################################
+#                                                          IMPORT                                                      #
+########################################################################################################################
+import os
+import json
+import argparse
+
+from singleVis.epoch_store import consolidate
+########################################################################################################################
+#                                                     LOAD PARAMETERS                                                  #
+########################################################################################################################
+"""Convert the per-epoch train_data.npy/test_data.npy of an existing content path into consolidated [epoch, sample, dim] stores."""
+
+parser = argparse.ArgumentParser(description='Consolidate per-epoch representations...')
+parser.add_argument('--content_path', type=str)
+parser.add_argument('--vis_method', type=str, default="DVI", help="config.json entry to read EPOCH_START/END/PERIOD from")
+parser.add_argument('--epoch_name', type=str, default="Epoch")
+parser.add_argument('--dtype', type=str, default="float32", choices=["float32", "float16"])
+args = parser.parse_args()
+
+CONTENT_PATH = args.content_path
+with open(os.path.join(CONTENT_PATH, "config.json"), "r") as f:
+    config = json.load(f)
+config = config[args.vis_method]
+
+EPOCH_START = config["EPOCH_START"]
+EPOCH_END = config["EPOCH_END"]
+EPOCH_PERIOD = config["EPOCH_PERIOD"]
+
+########################################################################################################################
+#                                                     CONSOLIDATE                                                      #
+########################################################################################################################
+model_path = os.path.join(CONTENT_PATH, "Model")
+results = consolidate(model_path, list(range(EPOCH_START, EPOCH_END + 1, EPOCH_PERIOD)), epoch_name=args.epoch_name, dtype=args.dtype)
+for split, epochs in results.items():
+    print("{} data: {:d} epochs consolidated".format(split, len(epochs)))
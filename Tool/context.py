@@ -18,6 +18,7 @@ from strategy import StrategyAbstractClass
 from singleVis.utils import *
 from singleVis.trajectory_manager import Recommender
 from singleVis.active_sampling import random_sampling, uncerainty_sampling
+from singleVis.predicate_index import PredicateIndex, load_predicate_index
 
 # active_learning_path = "../../ActiveLearning"
 # sys.path.append(active_learning_path)
@@ -150,16 +151,36 @@ class VisContext(Context):
         return res
     
     def filter_conf(self, conf_min, conf_max, epoch_id):
-        train_data = self.strategy.data_provider.train_representation(epoch_id)
-        test_data =self.strategy.data_provider.test_representation(epoch_id)
-        data = np.concatenate((train_data, test_data), axis=0)
-        data = data.reshape(data.shape[0],data.shape[1])
-        pred = self.strategy.data_provider.get_pred(epoch_id, data)
-        scores = np.amax(softmax(pred, axis=1), axis=1)
+        scores = self.strategy.data_provider.epoch_predictions(epoch_id)["confidence"]
         res = np.argwhere(np.logical_and(scores<=conf_max, scores>=conf_min)).squeeze().tolist()
         return res
 
 
+    def predicate_index(self, epoch_id):
+        """bitmap index over all train and test samples of an epoch, see PredicateIndex for the predicates"""
+        data_provider = self.strategy.data_provider
+        label_files = [os.path.join(data_provider.content_path, "Training_data", "training_dataset_label.pth"),
+                       os.path.join(data_provider.content_path, "Testing_data", "testing_dataset_label.pth")]
+        version = max([data_provider.predictions._version(epoch_id)] + [os.path.getmtime(f) for f in label_files if os.path.exists(f)])
+
+        def build():
+            train_labels = self.train_labels(epoch_id)
+            test_labels = self.test_labels(epoch_id)
+            labels = np.concatenate((train_labels, test_labels), axis=0).astype(int)
+            return PredicateIndex.build(labels, len(train_labels), self.get_epoch_index(epoch_id),
+                                        data_provider.epoch_predictions(epoch_id), data_provider.classes)
+
+        path = os.path.join(data_provider.checkpoint_path(epoch_id), "predicates.npz")
+        return load_predicate_index(path, version, build)
+
+    def filter_points(self, predicates, epoch_id):
+        """
+        indices of the samples matching predicates
+        :param predicates: dict, e.g. {"label": "cat", "type": "train", "confidence": [0.2, 0.6]}
+        :return: numpy.ndarray, ascending indices
+        """
+        return self.predicate_index(epoch_id).query(predicates).indices()
+
     #################################################################################################################
     #                                                                                                               #
     #                                             Helper Functions                                                  #
@@ -294,9 +315,9 @@ class ActiveLearningContext(VisContext):
             print(DATA_NAME)
             print(strategy)
             print('================Round {:d}==============='.format(iteration+1))
-            samples = self.strategy.data_provider.train_representation(iteration)
-            pred = self.strategy.data_provider.get_pred(iteration, samples)
-            confidence = np.amax(softmax(pred, axis=1), axis=1)
+            # rows of the labelled training samples in the cached predictions
+            idxs = self.strategy.data_provider.get_labeled_idx(iteration)
+            confidence = self.strategy.data_provider.epoch_predictions(iteration)["confidence"][idxs]
             uncertainty = 1-confidence
             # query new samples
             t0 = time.time()
@@ -562,9 +583,8 @@ class AnormalyContext(VisContext):
             uncertainty = np.load(uncertainty_path)
         else:
             epoch_num = (self.strategy.data_provider.e - self.strategy.data_provider.s)//self.strategy.data_provider.p + 1
-            samples = self.strategy.data_provider.train_representation(epoch_num)
-            pred = self.strategy.data_provider.get_pred(epoch_num, samples)
-            uncertainty = 1 - np.amax(softmax(pred, axis=1), axis=1)
+            train_num = len(self.strategy.data_provider.train_representation(epoch_num))
+            uncertainty = 1 - self.strategy.data_provider.epoch_predictions(epoch_num)["confidence"][:train_num]
             np.save(uncertainty_path, uncertainty)
         
         # prepare sampling manager
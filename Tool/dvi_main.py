@@ -22,7 +22,7 @@ from singleVis.data import NormalDataProvider
 from singleVis.spatial_edge_constructor import SingleEpochSpatialEdgeConstructor
 from singleVis.projector import DVIProjector
 from singleVis.eval.evaluator import Evaluator
-from singleVis.utils import find_neighbor_preserving_rate
+from singleVis.utils import epoch_neighbor_preserving_rate
 ########################################################################################################################
 #                                                     DVI PARAMETERS                                                   #
 ########################################################################################################################
@@ -131,7 +131,7 @@ for iteration in range(EPOCH_START, EPOCH_END+EPOCH_PERIOD, EPOCH_PERIOD):
         # TODO AL mode, redefine train_representation
         prev_data = data_provider.train_representation(iteration-EPOCH_PERIOD)
         curr_data = data_provider.train_representation(iteration)
-        npr = torch.tensor(find_neighbor_preserving_rate(prev_data, curr_data, N_NEIGHBORS)).to(DEVICE)
+        npr = torch.tensor(epoch_neighbor_preserving_rate(data_provider, iteration-EPOCH_PERIOD, iteration, prev_data, curr_data, N_NEIGHBORS)).to(DEVICE)
         temporal_loss_fn = TemporalLoss(w_prev, DEVICE)
         criterion = DVILoss(umap_loss_fn, recon_loss_fn, temporal_loss_fn, lambd1=LAMBDA1, lambd2=LAMBDA2*npr,device=DEVICE)
     # Define training parameters
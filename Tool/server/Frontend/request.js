@@ -7,6 +7,64 @@ let headers = new Headers();
 headers.append('Content-Type', 'application/json');
 headers.append('Accept', 'application/json');
 
+// binary columnar responses for the large per-sample arrays, see server/columnar.py
+const COLUMNAR_TYPE = 'application/x-ttv-columnar';
+let columnarHeaders = new Headers();
+columnarHeaders.append('Content-Type', 'application/json');
+columnarHeaders.append('Accept', `${COLUMNAR_TYPE}, application/json;q=0.9`);
+
+function parseResponse(response) {
+    let contentType = response.headers.get('Content-Type') || ''
+    if (contentType.startsWith(COLUMNAR_TYPE)) {
+        return response.arrayBuffer().then(decodeColumnar)
+    }
+    return response.json()
+}
+
+const COLUMNAR_DTYPES = {
+    float32: Float32Array, float64: Float64Array,
+    int8: Int8Array, int16: Int16Array, int32: Int32Array,
+    uint8: Uint8Array, uint16: Uint16Array, uint32: Uint32Array,
+}
+
+// rebuild the nested arrays the json response would have held
+function unflattenColumn(flat, shape, categories) {
+    let values = categories ? Array.from(flat, code => categories[code]) : Array.from(flat)
+    if (shape.length <= 1) {
+        return values
+    }
+    let rowSize = shape.slice(1).reduce((a, b) => a * b, 1)
+    let rows = new Array(shape[0])
+    for (let i = 0; i < shape[0]; i++) {
+        rows[i] = unflattenColumn(values.slice(i * rowSize, (i + 1) * rowSize), shape.slice(1), null)
+    }
+    return rows
+}
+
+function decodeColumnar(buffer) {
+    let view = new DataView(buffer)
+    let magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4))
+    if (magic !== 'TTVC') {
+        throw new Error('Not a columnar response')
+    }
+    let headerLength = view.getUint32(4, true)
+    let header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, headerLength)))
+    let base = 8 + headerLength
+    let res = header.fields
+    header.columns.forEach(column => {
+        let ArrayType = COLUMNAR_DTYPES[column.dtype]
+        let flat = new ArrayType(buffer, base + column.offset, column.nbytes / ArrayType.BYTES_PER_ELEMENT)
+        let keys = column.name.split('.')
+        let parent = res
+        keys.slice(0, -1).forEach(key => {
+            parent[key] = parent[key] || {}
+            parent = parent[key]
+        })
+        parent[keys[keys.length - 1]] = unflattenColumn(flat, column.shape, column.categories)
+    })
+    return res
+}
+
 // updateProjection
 
 function updateProjection(content_path, iteration, taskType) {
@@ -25,10 +83,10 @@ function updateProjection(content_path, iteration, taskType) {
             "TaskType": taskType,
             "selectedPoints":window.vueApp.filter_index,
         }),
-        headers: headers,
+        headers: columnarHeaders,
         mode: 'cors'
     })
-    .then(response => response.json())
+    .then(parseResponse)
     .then(res => {
         if (res.errorMessage != "") {
           if (window.vueApp.errorMessage) {
@@ -74,8 +132,40 @@ function updateProjection(content_path, iteration, taskType) {
         })
 }
 
+// many sprites in one request, resolves to an array of object urls in the order of indices
+function fetchSpriteBatch(content_path, indices) {
+    return fetch(`${window.location.href}/spriteBatch?path=${content_path}&index=${indices.join(',')}`, {
+        method: 'GET',
+        mode: 'cors'
+    }).then(response => {
+        let spriteType = response.headers.get('X-Sprite-Type') || 'image/png'
+        return response.arrayBuffer().then(buffer => {
+            let view = new DataView(buffer)
+            let count = view.getUint32(0, true)
+            let offset = 4 + 4 * count
+            let urls = []
+            for (let i = 0; i < count; i++) {
+                let length = view.getUint32(4 + 4 * i, true)
+                urls.push(URL.createObjectURL(new Blob([buffer.slice(offset, offset + length)], { type: spriteType })))
+                offset += length
+            }
+            return urls
+        })
+    })
+}
+
   function getOriginalData(content_path,index, dataType, flag, custom_path){
-    if(index != null){
+    if(index != null && dataType == "Image"){
+        let specifiedImageSrc = makeSpecifiedVariableName('imageSrc', flag)
+        fetchSpriteBatch(content_path, [index]).then(urls => {
+            if (window.vueApp[specifiedImageSrc] && window.vueApp[specifiedImageSrc].startsWith('blob:')) {
+                URL.revokeObjectURL(window.vueApp[specifiedImageSrc])
+            }
+            window.vueApp[specifiedImageSrc] = urls.length ? urls[0] : ""
+        }).catch(error => {
+            console.log("error", error);
+        });
+    } else if(index != null){
         let specifiedCurrEpoch = makeSpecifiedVariableName('currEpoch', flag)
         fetch(`${window.location.href}/sprite${dataType}?index=${index}&path=${content_path}&cus_path=${custom_path}&username=admin&iteration=${window.vueApp[specifiedCurrEpoch]}&`, {
             method: 'GET',
@@ -122,10 +212,10 @@ function updateContraProjection(content_path, iteration, taskType, flag) {
             "TaskType": taskType,
             "selectedPoints":window.vueApp[specifiedFilterIndex]
         }),
-        headers: headers,
+        headers: columnarHeaders,
         mode: 'cors'
     })
-    .then(response => response.json())
+    .then(parseResponse)
     .then(res => {
         currId = 'container_tar'    
         alert_prefix = "right:\n"  
@@ -0,0 +1,107 @@
+"""Process-wide cache of initialized visualization backends (context + strategy)"""
+import os
+import threading
+from collections import OrderedDict
+
+
+class BackendCache:
+    """ thread-safe LRU cache of contexts keyed by (content_path, vis_method, setting, dense)
+
+    Building a strategy re-reads config.json, imports the subject model and creates
+    data provider, projector, visualizer and evaluator, so it is done once per key and
+    the warm context is shared by later requests. An entry is rebuilt when config.json
+    changes on disk, and can be dropped explicitly with invalidate().
+
+    Every context gets a reentrant context.lock, also used as its projector's lock, so that
+    loading visualization weights and projecting with them is atomic. Requests that mutate
+    the context (e.g. training) hold it for their whole duration.
+
+    Args:
+        build_fn (callable): build_fn(content_path, vis_method, setting, dense) -> (context, error_message)
+        max_size (int): maximum number of contexts kept alive
+    """
+    def __init__(self, build_fn, max_size=4):
+        self.build_fn = build_fn
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._key_locks = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(content_path, vis_method, setting, dense=False):
+        return (os.path.normpath(content_path), vis_method, setting, bool(dense))
+
+    @staticmethod
+    def _config_mtime(content_path):
+        try:
+            return os.path.getmtime(os.path.join(content_path, "config.json"))
+        except OSError:
+            return None
+
+    def _key_lock(self, key):
+        with self._lock:
+            if key not in self._key_locks:
+                self._key_locks[key] = threading.Lock()
+            return self._key_locks[key]
+
+    def _lookup(self, key, mtime):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry["mtime"] != mtime:
+                # config.json changed since the context was built
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    @staticmethod
+    def _attach_lock(context):
+        lock = threading.RLock()
+        context.lock = lock
+        projector = getattr(getattr(context, "strategy", None), "projector", None)
+        if projector is not None:
+            projector.lock = lock
+
+    def get(self, content_path, vis_method, setting, dense=False):
+        """ return a (context, error_message) pair, building it on a miss """
+        key = self.make_key(content_path, vis_method, setting, dense)
+        mtime = self._config_mtime(key[0])
+        entry = self._lookup(key, mtime)
+        if entry is not None:
+            return entry["context"], entry["error_message"]
+
+        # only one thread builds a given key, other requests for it wait and reuse the result
+        with self._key_lock(key):
+            entry = self._lookup(key, mtime)
+            if entry is not None:
+                return entry["context"], entry["error_message"]
+            context, error_message = self.build_fn(key[0], vis_method, setting, dense)
+            self._attach_lock(context)
+            if error_message:
+                # do not pin a fallback strategy, retry on the next request
+                return context, error_message
+            with self._lock:
+                self._entries[key] = {"context": context, "error_message": error_message, "mtime": mtime}
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return context, error_message
+
+    def invalidate(self, content_path=None):
+        """ drop cached contexts of content_path (all contexts if None), return the number removed """
+        with self._lock:
+            if content_path is None:
+                removed = len(self._entries)
+                self._entries.clear()
+                return removed
+            content_path = os.path.normpath(content_path)
+            keys = [key for key in self._entries.keys() if key[0] == content_path]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries.keys())
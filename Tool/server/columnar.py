@@ -0,0 +1,114 @@
+"""Binary columnar encoding of large API responses, negotiated with the Accept header"""
+import io
+import gzip
+import json
+import struct
+
+import numpy as np
+from flask import make_response
+
+MIME_TYPE = "application/x-ttv-columnar"
+MAGIC = b"TTVC"
+ALIGN = 8
+# responses smaller than this are not worth compressing
+GZIP_MIN_BYTES = 1 << 16
+
+"""
+Layout (little endian):
+    MAGIC | uint32 header length | JSON header | padding | column buffers, each aligned to 8 bytes
+The header holds the small fields of the payload as plain JSON under "fields", and one entry per
+column {"name", "dtype", "shape", "offset", "nbytes"} with offsets relative to the first column.
+String columns are dictionary encoded: integer codes plus a "categories" list.
+A column name "a.b" is placed at payload["a"]["b"] when decoded.
+"""
+
+
+def wants_columnar(request):
+    return MIME_TYPE in request.headers.get("Accept", "")
+
+
+def _encode_column(value):
+    """return (array, extra header entries) or None if value cannot be a column"""
+    try:
+        arr = np.asarray(value)
+    except ValueError:
+        # ragged nested lists
+        return None
+    if arr.dtype.kind == "f":
+        return arr.astype(np.float32, copy=False), dict()
+    if arr.dtype.kind == "b":
+        return arr.astype(np.uint8), dict()
+    if arr.dtype.kind in "iu":
+        if arr.size and arr.min() >= 0 and arr.max() < 256:
+            return arr.astype(np.uint8), dict()
+        return arr.astype(np.int32), dict()
+    if arr.dtype.kind in "US":
+        categories, codes = np.unique(arr, return_inverse=True)
+        codes = codes.reshape(arr.shape).astype(np.uint16 if len(categories) < 65536 else np.int32)
+        return codes, {"categories": categories.tolist()}
+    return None
+
+
+def encode_columnar(payload, columns):
+    """
+    encode payload into the columnar binary format
+    :param payload: dict, response fields
+    :param columns: list of str, keys of payload to be sent as binary columns, use "a.b" for payload["a"]["b"]
+    :return: bytes
+    """
+    fields = dict(payload)
+    entries = list()
+    buffers = list()
+    offset = 0
+    for name in columns:
+        keys = name.split(".")
+        parent = fields
+        for key in keys[:-1]:
+            # copy nested dicts on the way down, the caller's payload is left untouched
+            parent[key] = dict(parent.get(key, dict()))
+            parent = parent[key]
+        if keys[-1] not in parent:
+            continue
+        encoded = _encode_column(parent[keys[-1]])
+        if encoded is None:
+            continue
+        arr, extra = encoded
+        del parent[keys[-1]]
+        data = np.ascontiguousarray(arr).tobytes()
+        entry = {"name": name, "dtype": arr.dtype.name, "shape": list(arr.shape), "offset": offset, "nbytes": len(data)}
+        entry.update(extra)
+        entries.append(entry)
+        pad = (-len(data)) % ALIGN
+        buffers.append(data + b"\0" * pad)
+        offset += len(data) + pad
+
+    header = json.dumps({"fields": fields, "columns": entries}, default=json_default).encode("utf-8")
+    header += b" " * ((-(len(MAGIC) + 4 + len(header))) % ALIGN)
+    out = io.BytesIO()
+    out.write(MAGIC)
+    out.write(struct.pack("<I", len(header)))
+    out.write(header)
+    for data in buffers:
+        out.write(data)
+    return out.getvalue()
+
+
+def json_default(o):
+    if isinstance(o, np.ndarray):
+        return o.tolist()
+    if isinstance(o, np.generic):
+        return o.item()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(o).__name__))
+
+
+def columnar_response(request, payload, columns, status=200):
+    """flask response with payload encoded by encode_columnar, gzip compressed if the client accepts it"""
+    body = encode_columnar(payload, columns)
+    headers = {"Content-Type": MIME_TYPE}
+    if len(body) >= GZIP_MIN_BYTES and "gzip" in request.headers.get("Accept-Encoding", ""):
+        body = gzip.compress(body, compresslevel=1)
+        headers["Content-Encoding"] = "gzip"
+    response = make_response(body, status)
+    response.headers.update(headers)
+    response.headers["Vary"] = "Accept"
+    return response
@@ -0,0 +1,212 @@
+"""Background jobs for long-running server operations, with records persisted on disk"""
+import os
+import json
+import time
+import uuid
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from columnar import json_default
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """handle passed to the work function, to report progress and notice cancellation"""
+    def __init__(self, queue, record):
+        self._queue = queue
+        self.record = record
+        self._cancel = threading.Event()
+
+    @property
+    def id(self):
+        return self.record["id"]
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def check_cancelled(self):
+        """raise JobCancelled if cancellation was requested, call between steps of the work"""
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def progress(self, value, message=""):
+        """
+        :param value: float, fraction of the work done, in [0, 1]
+        :param message: str, current step
+        """
+        self.check_cancelled()
+        self._queue._update(self, progress=round(float(value), 3), message=message)
+
+
+class JobQueue:
+    """
+    Bounded thread pool running submitted work functions fn(job) -> JSON-serializable result.
+
+    Every job has a record {id, kind, status, progress, message, submitted, started, finished, error}
+    written to job_dir/{id}.json on each change, the result goes to job_dir/{id}.result.json.
+    status is one of queued, running, done, failed, cancelled. Cancelling a queued job drops it,
+    a running job stops at its next progress()/check_cancelled() call.
+    Records of jobs that were queued or running when the server stopped are marked failed on start.
+    Finished jobs are evicted, record and result, once they are older than ttl seconds or more than
+    max_jobs finished jobs are kept, checked on start and on every submit.
+    """
+    FINISHED = ("done", "failed", "cancelled")
+
+    def __init__(self, job_dir, max_workers=2, max_jobs=200, ttl=7*24*3600):
+        self.job_dir = job_dir
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        os.makedirs(job_dir, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs = dict()
+        self._futures = dict()
+        self._lock = threading.Lock()
+        self._recover()
+        self._evict()
+
+    ################################################ records #############################################
+    def _record_path(self, job_id):
+        return os.path.join(self.job_dir, "{}.json".format(job_id))
+
+    def _result_path(self, job_id):
+        return os.path.join(self.job_dir, "{}.result.json".format(job_id))
+
+    def _write(self, path, obj):
+        tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(tmp_path, "w") as f:
+            json.dump(obj, f, default=json_default)
+        os.replace(tmp_path, path)
+
+    def _update(self, job, **fields):
+        with self._lock:
+            job.record.update(fields)
+            record = dict(job.record)
+        self._write(self._record_path(job.id), record)
+
+    def _recover(self):
+        for f in os.listdir(self.job_dir):
+            if not f.endswith(".json") or f.endswith(".result.json"):
+                continue
+            path = os.path.join(self.job_dir, f)
+            try:
+                with open(path, "r") as fp:
+                    record = json.load(fp)
+            except (OSError, ValueError):
+                continue
+            if record.get("status") in ("queued", "running"):
+                record.update(status="failed", error="interrupted by server restart", finished=time.time())
+                self._write(path, record)
+
+    def _load_records(self):
+        records = list()
+        for f in os.listdir(self.job_dir):
+            if not f.endswith(".json") or f.endswith(".result.json"):
+                continue
+            try:
+                with open(os.path.join(self.job_dir, f), "r") as fp:
+                    records.append(json.load(fp))
+            except (OSError, ValueError):
+                continue
+        return records
+
+    def _evict(self):
+        """drop finished jobs older than ttl or beyond the newest max_jobs, in memory and in job_dir"""
+        finished = [r for r in self._load_records() if r.get("status") in self.FINISHED and "id" in r]
+        finished.sort(key=lambda r: r.get("finished") or 0., reverse=True)
+        expired = time.time() - self.ttl
+        evicted = [r["id"] for i, r in enumerate(finished) if i >= self.max_jobs or (r.get("finished") or 0.) < expired]
+        with self._lock:
+            for job_id in evicted:
+                self._jobs.pop(job_id, None)
+        for job_id in evicted:
+            for path in (self._record_path(job_id), self._result_path(job_id)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    ################################################ api #################################################
+    def submit(self, kind, fn):
+        """
+        :param kind: str, e.g. "al_query"
+        :param fn: callable, fn(job) -> result
+        :return: str, job id
+        """
+        self._evict()
+        job_id = uuid.uuid4().hex
+        record = {"id": job_id, "kind": kind, "status": "queued", "progress": 0., "message": "",
+                  "submitted": time.time(), "started": None, "finished": None, "error": None}
+        job = Job(self, record)
+        with self._lock:
+            self._jobs[job_id] = job
+        self._write(self._record_path(job_id), record)
+        future = self._executor.submit(self._run, job, fn)
+        with self._lock:
+            self._futures[job_id] = future
+        return job_id
+
+    def _run(self, job, fn):
+        if job.cancelled:
+            self._update(job, status="cancelled", finished=time.time())
+            return
+        self._update(job, status="running", started=time.time())
+        try:
+            result = fn(job)
+            self._write(self._result_path(job.id), result)
+            self._update(job, status="done", progress=1., finished=time.time())
+        except JobCancelled:
+            self._update(job, status="cancelled", finished=time.time())
+        except Exception as e:
+            traceback.print_exc()
+            self._update(job, status="failed", error="{}: {}".format(type(e).__name__, e), finished=time.time())
+        finally:
+            with self._lock:
+                self._futures.pop(job.id, None)
+
+    def status(self, job_id):
+        """:return: dict, the job record, None for an unknown id"""
+        if not job_id.isalnum():
+            return None
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return dict(job.record)
+        path = self._record_path(job_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def result(self, job_id):
+        """:return: the result of a finished job, None if there is none (yet)"""
+        if not job_id.isalnum():
+            return None
+        path = self._result_path(job_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def cancel(self, job_id):
+        """:return: bool, whether the job was still queued or running"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            future = self._futures.get(job_id)
+        if job is None or job.record["status"] not in ("queued", "running"):
+            return False
+        job._cancel.set()
+        if future is not None and future.cancel():
+            # never started
+            self._update(job, status="cancelled", finished=time.time())
+        return True
+
+
+def report_progress(job, value, message=""):
+    """job.progress for work functions that also run synchronously, with job None"""
+    if job is not None:
+        job.progress(value, message)
@@ -1,7 +1,8 @@
-from flask import request, Flask, jsonify, make_response,render_template,send_from_directory
+from flask import request, Flask, jsonify, make_response,render_template,send_from_directory,send_file
 from flask_cors import CORS, cross_origin
 
 import base64
+import hashlib
 import os
 import sys
 import json
@@ -11,7 +12,9 @@ import gc
 import shutil
 sys.path.append('..')
 sys.path.append('.')
-from utils import get_comparison_coloring, get_coloring, getVisError, update_epoch_projection, initialize_backend, add_line, getConfChangeIndices, getContraVisChangeIndices, getContraVisChangeIndicesSingle,getCriticalChangeIndices, update_custom_epoch_projection, highlight_epoch_projection
+from utils import content_path, get_comparison_coloring, get_coloring, getVisError, update_epoch_projection, initialize_backend, invalidate_backend, get_background_tile, get_background_tile_meta, get_sprite_store, get_sprite_ids, pack_sprites, sprite_mime, add_line, getConfChangeIndices, getContraVisChangeIndices, getContraVisChangeIndicesSingle,getCriticalChangeIndices, update_custom_epoch_projection, highlight_epoch_projection
+from columnar import wants_columnar, columnar_response
+from jobs import JobQueue, report_progress
 
 import time
 # flask for API server
@@ -20,29 +23,24 @@ cors = CORS(app, supports_credentials=True)
 app.config['CORS_HEADERS'] = 'Content-Type'
 
 API_result_path = "./admin_API_result.csv"
+# long-running requests sent with "async": true run here, see /jobs/<job_id>
+jobs = JobQueue("./jobs", max_workers=2)
+# per-sample arrays of /updateProjection sent as binary columns when the client asks for them
+PROJECTION_COLUMNS = ['result', 'grid_index', 'label_color_list', 'label_list', 'training_data', 'testing_data',
+                      'prediction_list', 'selectedPoints', 'properties', 'color_list']
 
 
 import time
 
 import numpy as np
-from pymilvus import (
-    connections,
-    utility,
-    FieldSchema, CollectionSchema, DataType,
-    Collection,
-)
-
-fmt = "\n=== {:30} ===\n"
-search_latency_fmt = "search latency = {:.4f}s"
-# num_entities, dim = 3000, 8
-code_entities = None
+from vector_search import load_collection, hit_list
+
+# collections of the index search endpoints, see vector_search.py
 code_embeddings_collection = None
-nl_entities = None
 nl_embeddings_collection = None
 @app.route('/loadVectorDB', methods=["POST", "GET"])
 @cross_origin()
 def load_vectorDB():
-    global code_entities
     global code_embeddings_collection
     res = request.get_json()
     CONTENT_PATH = os.path.normpath(res['path'])
@@ -54,73 +52,13 @@ def load_vectorDB():
     EPOCH = int(iteration)
 
     code_path = CONTENT_PATH + '/Model/Epoch_' + str(EPOCH) + '/train_data.npy'
-    code_embeddings = np.load(code_path)
-    dim = code_embeddings.shape[1]
-
-    print(fmt.format("start connecting to Milvus"))
-    connections.connect("default", host="localhost", port="19530")
-
-    has_code_embeddings = utility.has_collection("code_embeddings")
-
-    print(f"Does collection code_embeddings exist in Milvus: {has_code_embeddings}")
-
-    if has_code_embeddings:
-        utility.drop_collection("code_embeddings")
-    # utility.drop_collection("nl_embeddings")
-
-    # Define fields for code_embeddings collection
-    code_embeddings_fields = [
-        FieldSchema(name="pk", dtype=DataType.VARCHAR, is_primary=True, auto_id=False, max_length=100),
-        FieldSchema(name="code_embeddings", dtype=DataType.FLOAT_VECTOR, dim=dim)
-    ]
-    # Create schema for code_embeddings collection and nl_embeddings collection
-    code_embeddings_schema = CollectionSchema(code_embeddings_fields, "code_embeddings in Milvus")
-
-    print(fmt.format("Create collection `code_embeddings`"))
-    code_embeddings_collection = Collection("code_embeddings", code_embeddings_schema, consistency_level="Strong")
-
-    print(fmt.format("Start inserting entities"))
-    # rng = np.random.default_rng(seed=19530)
-
-    code_entities = [
-        [str(i) for i in range(len(code_embeddings))],
-        code_embeddings,    # field embeddings, supports numpy.ndarray and list
-    ]
-
-    batch_size = 1000  # 调整批次大小
-    num_batches = len(code_entities[0]) // batch_size
-
-    for i in range(num_batches):
-        start = i * batch_size
-        end = (i + 1) * batch_size
-        batch_entities = [entity[start:end] for entity in code_entities]
-        code_insert_result = code_embeddings_collection.insert(batch_entities)
-
-    remaining_entities = [entity[num_batches * batch_size:] for entity in code_entities]
-    if remaining_entities and any(remaining_entities):
-        code_insert_result = code_embeddings_collection.insert(remaining_entities)
-
-    # hello_milvus.flush()
-    print(f"Number of code entities in Milvus: {code_embeddings_collection.num_entities}")  # check the num_entites
-
-    print(fmt.format("Start Creating index IVF_FLAT"))
-    index = {
-        "index_type": "IVF_FLAT",
-        "metric_type": "L2",
-        "params": {"nlist": 128},
-    }
-
-    code_embeddings_collection.create_index("code_embeddings", index)
-
-    print(fmt.format("Start loading"))
-    code_embeddings_collection.load()
+    code_embeddings_collection = load_collection("code_embeddings", code_path)
 
     return make_response(jsonify({}), 200)
 
 @app.route('/contrastloadVectorDBCode', methods=["POST", "GET"])
 @cross_origin()
 def load_vectorDB_code():
-    global code_entities
     global code_embeddings_collection
     res = request.get_json()
     CONTENT_PATH = os.path.normpath(res['path'])
@@ -132,72 +70,13 @@ def load_vectorDB_code():
     EPOCH = int(iteration)
 
     code_path = CONTENT_PATH + '/Model/Epoch_' + str(EPOCH) + '/train_data.npy'
-    code_embeddings = np.load(code_path)
-    dim = code_embeddings.shape[1]
-
-    print(fmt.format("start connecting to Milvus"))
-    connections.connect("default", host="localhost", port="19530")
-
-    has_code_embeddings = utility.has_collection("code_embeddings")
-
-    print(f"Does collection code_embeddings exist in Milvus: {has_code_embeddings}")
-    if has_code_embeddings:
-        utility.drop_collection("code_embeddings")
-    # utility.drop_collection("code_embeddings")
-    # utility.drop_collection("nl_embeddings")
-
-    # Define fields for code_embeddings collection
-    code_embeddings_fields = [
-        FieldSchema(name="pk", dtype=DataType.VARCHAR, is_primary=True, auto_id=False, max_length=100),
-        FieldSchema(name="code_embeddings", dtype=DataType.FLOAT_VECTOR, dim=dim)
-    ]
-    # Create schema for code_embeddings collection and nl_embeddings collection
-    code_embeddings_schema = CollectionSchema(code_embeddings_fields, "code_embeddings in Milvus")
-
-    print(fmt.format("Create collection `code_embeddings`"))
-    code_embeddings_collection = Collection("code_embeddings", code_embeddings_schema, consistency_level="Strong")
-
-    print(fmt.format("Start inserting entities"))
-    # rng = np.random.default_rng(seed=19530)
-
-    code_entities = [
-        [str(i) for i in range(len(code_embeddings))],
-        code_embeddings,    # field embeddings, supports numpy.ndarray and list
-    ]
-
-    batch_size = 1000  # 调整批次大小
-    num_batches = len(code_entities[0]) // batch_size
-
-    for i in range(num_batches):
-        start = i * batch_size
-        end = (i + 1) * batch_size
-        batch_entities = [entity[start:end] for entity in code_entities]
-        code_insert_result = code_embeddings_collection.insert(batch_entities)
-
-    remaining_entities = [entity[num_batches * batch_size:] for entity in code_entities]
-    if remaining_entities and any(remaining_entities):
-        code_insert_result = code_embeddings_collection.insert(remaining_entities)
-
-    print(f"Number of code entities in Milvus: {code_embeddings_collection.num_entities}")  # check the num_entites
-
-    print(fmt.format("Start Creating index IVF_FLAT"))
-    index = {
-        "index_type": "IVF_FLAT",
-        "metric_type": "L2",
-        "params": {"nlist": 128},
-    }
-
-    code_embeddings_collection.create_index("code_embeddings", index)
-
-    print(fmt.format("Start loading"))
-    code_embeddings_collection.load()
+    code_embeddings_collection = load_collection("code_embeddings", code_path)
 
     return make_response(jsonify({}), 200)
 
 @app.route('/contrastloadVectorDBNl', methods=["POST", "GET"])
 @cross_origin()
 def load_vectorDB_nl():
-    global nl_entities
     global nl_embeddings_collection
     res = request.get_json()
     CONTENT_PATH = os.path.normpath(res['path'])
@@ -209,66 +88,7 @@ def load_vectorDB_nl():
     EPOCH = int(iteration)
 
     nl_path = CONTENT_PATH + '/Model/Epoch_' + str(EPOCH) + '/train_data.npy'
-    nl_embeddings = np.load(nl_path)
-    dim = nl_embeddings.shape[1]
-
-    print(fmt.format("start connecting to Milvus"))
-    connections.connect("default", host="localhost", port="19530")
-
-    has_nl_embeddings = utility.has_collection("nl_embeddings")
-
-    print(f"Does collection nl_embeddings exist in Milvus: {has_nl_embeddings}")
-    if has_nl_embeddings:
-        utility.drop_collection("nl_embeddings")
-    # utility.drop_collection("code_embeddings")
-    # utility.drop_collection("nl_embeddings")
-
-    # Define fields for code_embeddings collection
-    nl_embeddings_fields = [
-        FieldSchema(name="pk", dtype=DataType.VARCHAR, is_primary=True, auto_id=False, max_length=100),
-        FieldSchema(name="nl_embeddings", dtype=DataType.FLOAT_VECTOR, dim=dim)
-    ]
-    # Create schema for code_embeddings collection and nl_embeddings collection
-    nl_embeddings_schema = CollectionSchema(nl_embeddings_fields, "nl_embeddings in Milvus")
-
-    print(fmt.format("Create collection `nl_embeddings`"))
-    nl_embeddings_collection = Collection("nl_embeddings", nl_embeddings_schema, consistency_level="Strong")
-
-    print(fmt.format("Start inserting entities"))
-    # rng = np.random.default_rng(seed=19530)
-
-    nl_entities = [
-        [str(i) for i in range(len(nl_embeddings))],
-        nl_embeddings,    # field embeddings, supports numpy.ndarray and list
-    ]
-
-    nl_batch_size = 1000  # 调整批次大小
-    nl_num_batches = len(nl_entities[0]) // nl_batch_size
-
-    for i in range(nl_num_batches):
-        start = i * nl_batch_size
-        end = (i + 1) * nl_batch_size
-        batch_entities = [entity[start:end] for entity in nl_entities]
-        nl_insert_result = nl_embeddings_collection.insert(batch_entities)
-
-    remaining_entities = [entity[nl_num_batches * nl_batch_size:] for entity in nl_entities]
-    if remaining_entities and any(remaining_entities):
-        nl_insert_result = nl_embeddings_collection.insert(remaining_entities)
-
-    # hello_milvus.flush()
-    print(f"Number of nl entities in Milvus: {nl_embeddings_collection.num_entities}")  # check the num_entites
-
-    print(fmt.format("Start Creating index IVF_FLAT"))
-    index = {
-        "index_type": "IVF_FLAT",
-        "metric_type": "L2",
-        "params": {"nlist": 128},
-    }
-
-    nl_embeddings_collection.create_index("nl_embeddings", index)
-
-    print(fmt.format("Start loading"))
-    nl_embeddings_collection.load()
+    nl_embeddings_collection = load_collection("nl_embeddings", nl_path)
 
     return make_response(jsonify({}), 200)
 
@@ -297,38 +117,50 @@ def update_projection():
             print("Some items in the string cannot be converted to integers.")
             indicates = []  # 或者根据你的需要进行其他处理
         
-    # sys.path.append(CONTENT_PATH)
-    context, error_message_context = initialize_backend(CONTENT_PATH, VIS_METHOD, SETTING)
-    # use the true one
-    # EPOCH = (iteration-1)*context.strategy.data_provider.p + context.strategy.data_provider.s
-    EPOCH = int(iteration)
-    
-    embedding_2d, grid, decision_view, label_name_dict, label_color_list, label_list, max_iter, training_data_index, \
-    testing_data_index, eval_new, prediction_list, selected_points, properties, error_message_projection, color_list, confidence_list = update_epoch_projection(context, EPOCH, predicates, TaskType,indicates)
-    end = time.time()
-    print("label_colorlenUpdate", len(label_color_list))
-    print("duration", end-start)
-    # sys.path.remove(CONTENT_PATH)
-    # add_line(API_result_path,['TT',username])
-    grid = np.array(grid)
-    color_list = color_list.tolist()
-    return make_response(jsonify({'result': embedding_2d, 
-                                  'grid_index': grid.tolist(), 
-                                  'grid_color': 'data:image/png;base64,' + decision_view,
-                                  'label_name_dict':label_name_dict,
-                                  'label_color_list': label_color_list, 
-                                  'label_list': label_list,
-                                  'maximum_iteration': max_iter, 
-                                  'training_data': training_data_index,
-                                  'testing_data': testing_data_index, 
-                                  'evaluation': eval_new,
-                                  'prediction_list': prediction_list,
-                                  "selectedPoints":selected_points.tolist(),
-                                  "properties":properties.tolist(),
-                                  "errorMessage": error_message_context + error_message_projection,
-                                  "color_list": color_list,
-                                  "confidence_list": confidence_list
-                                  }), 200)
+    def work(job):
+        # sys.path.append(CONTENT_PATH)
+        context, error_message_context = initialize_backend(CONTENT_PATH, VIS_METHOD, SETTING)
+        # the cached context is shared with other requests and jobs, al_train mutates it
+        with context.lock:
+            # use the true one
+            # EPOCH = (iteration-1)*context.strategy.data_provider.p + context.strategy.data_provider.s
+            EPOCH = int(iteration)
+            report_progress(job, 0.1, "projecting epoch {}".format(EPOCH))
+
+            embedding_2d, grid, decision_view, label_name_dict, label_color_list, label_list, max_iter, training_data_index, \
+            testing_data_index, eval_new, prediction_list, selected_points, properties, error_message_projection, color_list, confidence_list = update_epoch_projection(context, EPOCH, predicates, TaskType,indicates)
+            end = time.time()
+            print("label_colorlenUpdate", len(label_color_list))
+            print("duration", end-start)
+            # sys.path.remove(CONTENT_PATH)
+            # add_line(API_result_path,['TT',username])
+            grid = np.array(grid)
+            return {'result': embedding_2d, 
+                    'grid_index': grid, 
+                    'grid_color': 'data:image/png;base64,' + decision_view,
+                    'label_name_dict':label_name_dict,
+                    'label_color_list': label_color_list, 
+                    'label_list': label_list,
+                    'maximum_iteration': max_iter, 
+                    'training_data': training_data_index,
+                    'testing_data': testing_data_index, 
+                    'evaluation': eval_new,
+                    'prediction_list': prediction_list,
+                    "selectedPoints":selected_points,
+                    "properties":properties,
+                    "errorMessage": error_message_context + error_message_projection,
+                    "color_list": color_list,
+                    "confidence_list": confidence_list
+                    }
+
+    if res.get("async"):
+        return submit_job("updateProjection", work)
+    payload = work(None)
+    if wants_columnar(request):
+        return columnar_response(request, payload, PROJECTION_COLUMNS)
+    for key in ['result', 'grid_index', 'selectedPoints', 'properties', 'color_list']:
+        payload[key] = payload[key].tolist()
+    return make_response(jsonify(payload), 200)
 
 app.route('/contrast/updateProjection', methods=["POST", "GET"])(update_projection)
 
@@ -497,29 +329,13 @@ def filter():
     predicates = res["predicates"]
     username = res['username']
 
-    sys.path.append(CONTENT_PATH)
-    context, error_message = initialize_backend(CONTENT_PATH, VIS_METHOD, SETTING)
-    # TODO: fix when active learning
-    EPOCH = iteration
-
-    training_data_number = context.strategy.config["TRAINING"]["train_num"]
-    testing_data_number = context.strategy.config["TRAINING"]["test_num"]
-
-    current_index = context.get_epoch_index(EPOCH)
-    selected_points = np.arange(training_data_number)[current_index]
-    selected_points = np.concatenate((selected_points, np.arange(training_data_number, training_data_number + testing_data_number, 1)), axis=0)
-    # selected_points = np.arange(training_data_number + testing_data_number)
-    for key in predicates.keys():
-        if key == "label":
-            tmp = np.array(context.filter_label(predicates[key], int(EPOCH)))
-        elif key == "type":
-            tmp = np.array(context.filter_type(predicates[key], int(EPOCH)))
-        elif key == "confidence":
-            tmp = np.array(context.filter_conf(predicates[key][0],predicates[key][1],int(EPOCH)))
-        else:
-            tmp = np.arange(training_data_number + testing_data_number)
-        selected_points = np.intersect1d(selected_points, tmp)
-    sys.path.remove(CONTENT_PATH)
+    with content_path(CONTENT_PATH):
+        context, error_message = initialize_backend(CONTENT_PATH, VIS_METHOD, SETTING)
+        # TODO: fix when active learning
+        EPOCH = iteration
+
+        # labelled training points and all testing points, narrowed down by the predicates
+        selected_points = context.filter_points({"and": [predicates, {"or": [{"type": "train"}, {"type": "test"}]}]}, int(EPOCH))
     # add_line(API_result_path,['SQ',username])
     return make_response(jsonify({"selectedPoints": selected_points.tolist()}), 200)
 
@@ -535,25 +351,11 @@ def sprite_image():
 
     CONTENT_PATH = os.path.normpath(path)
     print('index', index)
-    idx = int(index)
-    abnorm_idx_list = []
-    abnorm_idx_path = os.path.join(CONTENT_PATH, "Model", "new_index.json")
-    if os.path.isfile(abnorm_idx_path):
-        with open(abnorm_idx_path, "r") as f:
-            idxs = json.load(f)
-
-        for index in idxs:
-            abnorm_idx_list.append(index)
-
-        pic_save_dir_path = os.path.join(CONTENT_PATH, "sprites", "{}.png".format(abnorm_idx_list[idx]))
-    else:
-        pic_save_dir_path = os.path.join(CONTENT_PATH, "sprites", "{}.png".format(idx))
-    img_stream = ''
-    with open(pic_save_dir_path, 'rb') as img_f:
-        img_stream = img_f.read()
-        img_stream = base64.b64encode(img_stream).decode()
+    sprite_id = get_sprite_ids(CONTENT_PATH, [index])[0]
+    sprite = get_sprite_store(CONTENT_PATH).get(sprite_id)
+    img_stream = base64.b64encode(sprite).decode()
     # add_line(API_result_path,['SI',username])
-    return make_response(jsonify({"imgUrl":'data:image/png;base64,' + img_stream}), 200)
+    return make_response(jsonify({"imgUrl":'data:{};base64,'.format(sprite_mime(sprite)) + img_stream}), 200)
 
 app.route('/contrast/spriteImage', methods=["POST", "GET"])(sprite_image)
 
@@ -605,22 +407,46 @@ def sprite_list_image():
     path = data["path"]
 
     CONTENT_PATH = os.path.normpath(path)
-    length = len(indices)
+    store = get_sprite_store(CONTENT_PATH)
     urlList = {}
 
-    for i in range(length):
-        idx = indices[i]
-        pic_save_dir_path = os.path.join(CONTENT_PATH, "sprites", "{}.png".format(idx))
-        img_stream = ''
-        with open(pic_save_dir_path, 'rb') as img_f:
-            img_stream = img_f.read()
-            img_stream = base64.b64encode(img_stream).decode()
-            urlList[idx] = 'data:image/png;base64,' + img_stream
-            # urlList.append('data:image/png;base64,' + img_stream)
+    for idx in indices:
+        sprite = store.get(idx)
+        img_stream = base64.b64encode(sprite).decode()
+        urlList[idx] = 'data:{};base64,'.format(sprite_mime(sprite)) + img_stream
     return make_response(jsonify({"urlList":urlList}), 200)
 
 app.route('/contrast/spriteList', methods=["POST", "GET"])(sprite_list_image)
 
+@app.route('/spriteBatch', methods=["POST", "GET"])
+@cross_origin()
+def sprite_batch():
+    """many sprites in one binary response, see pack_sprites for the layout"""
+    if request.method == "POST":
+        data = request.get_json()
+        path = data["path"]
+        indices = data["index"]
+    else:
+        path = request.args.get("path")
+        indices = [i for i in request.args.get("index", "").split(",") if i != ""]
+
+    CONTENT_PATH = os.path.normpath(path)
+    store = get_sprite_store(CONTENT_PATH)
+    sprite_ids = get_sprite_ids(CONTENT_PATH, indices)
+    etag = hashlib.md5("{}|{}".format(store.version(), ",".join(str(i) for i in sprite_ids)).encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        sprites = store.get_many(sprite_ids)
+        response = make_response(pack_sprites(sprites), 200)
+        response.headers["Content-Type"] = "application/octet-stream"
+        response.headers["X-Sprite-Type"] = sprite_mime(sprites[0]) if len(sprites) else "image/png"
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, max-age=3600"
+    return response
+
+app.route('/contrast/spriteBatch', methods=["POST", "GET"])(sprite_batch)
+
 # contrast Not use spriteList?
 
 @app.route('/highlightConfChange', methods=["POST", "GET"])
@@ -763,24 +589,31 @@ def al_query():
     user_name = data["username"]
     isRecommend = data["isRecommend"]
 
-    sys.path.append(CONTENT_PATH)
-    context, error_message = initialize_backend(CONTENT_PATH, VIS_METHOD, SETTING, dense=True)
-    # TODO add new sampling rule
-    indices, labels, scores = context.al_query(iteration, budget, strategy, np.array(acc_idxs).astype(np.int64), np.array(rej_idxs).astype(np.int64))
+    def work(job):
+        with content_path(CONTENT_PATH):
+            context, error_message = initialize_backend(CONTENT_PATH, VIS_METHOD, SETTING, dense=True)
+            # the cached context is shared with other requests and jobs, al_train mutates it
+            with context.lock:
+                report_progress(job, 0.1, "querying {}".format(strategy))
+                # TODO add new sampling rule
+                indices, labels, scores = context.al_query(iteration, budget, strategy, np.array(acc_idxs).astype(np.int64), np.array(rej_idxs).astype(np.int64))
+
+                sort_i = np.argsort(-scores)
+                indices = indices[sort_i]
+                labels = labels[sort_i]
+                scores = scores[sort_i]
+
+                if not isRecommend: 
+                   #  add_line(API_result_path,['Feedback', user_name]) 
+                    print()
+                else:
+                   #  add_line(API_result_path,['Recommend', user_name])
+                    print()
+                return {"selectedPoints": indices.tolist(), "scores": scores.tolist(), "suggestLabels":labels.tolist()}
 
-    sort_i = np.argsort(-scores)
-    indices = indices[sort_i]
-    labels = labels[sort_i]
-    scores = scores[sort_i]
-
-    sys.path.remove(CONTENT_PATH)
-    if not isRecommend: 
-       #  add_line(API_result_path,['Feedback', user_name]) 
-        print()
-    else:
-       #  add_line(API_result_path,['Recommend', user_name])
-        print()
-    return make_response(jsonify({"selectedPoints": indices.tolist(), "scores": scores.tolist(), "suggestLabels":labels.tolist()}), 200)
+    if data.get("async"):
+        return submit_job("al_query", work)
+    return make_response(jsonify(work(None)), 200)
 
 @app.route('/anomaly_query', methods=["POST"])
 @cross_origin()
@@ -797,26 +630,34 @@ def anomaly_query():
     user_name = data["username"]
     isRecommend = data["isRecommend"]
 
-    sys.path.append(CONTENT_PATH)
-    context, error_message = initialize_backend(CONTENT_PATH, VIS_METHOD, SETTING)
-
-    context.save_acc_and_rej(acc_idxs, rej_idxs, user_name)
-    indices, scores, labels = context.suggest_abnormal(strategy, np.array(acc_idxs).astype(np.int64), np.array(rej_idxs).astype(np.int64), budget)
-    clean_list,_ = context.suggest_normal(strategy, np.array(acc_idxs).astype(np.int64), np.array(rej_idxs).astype(np.int64), 1)
-
-    sort_i = np.argsort(-scores)
-    indices = indices[sort_i]
-    labels = labels[sort_i]
-    scores = scores[sort_i]
+    def work(job):
+        with content_path(CONTENT_PATH):
+            context, error_message = initialize_backend(CONTENT_PATH, VIS_METHOD, SETTING)
+            # the cached context is shared with other requests and jobs, al_train mutates it
+            with context.lock:
+
+                context.save_acc_and_rej(acc_idxs, rej_idxs, user_name)
+                report_progress(job, 0.1, "suggesting abnormal samples")
+                indices, scores, labels = context.suggest_abnormal(strategy, np.array(acc_idxs).astype(np.int64), np.array(rej_idxs).astype(np.int64), budget)
+                report_progress(job, 0.6, "suggesting normal samples")
+                clean_list,_ = context.suggest_normal(strategy, np.array(acc_idxs).astype(np.int64), np.array(rej_idxs).astype(np.int64), 1)
+
+                sort_i = np.argsort(-scores)
+                indices = indices[sort_i]
+                labels = labels[sort_i]
+                scores = scores[sort_i]
+
+                if not isRecommend: 
+                   #  add_line(API_result_path,['Feedback', user_name]) 
+                    print()
+                else:
+                    # add_line(API_result_path,['Recommend', user_name])
+                    print()
+                return {"selectedPoints": indices.tolist(), "scores": scores.tolist(), "suggestLabels":labels.tolist(),"cleanList":clean_list.tolist()}
 
-    sys.path.remove(CONTENT_PATH)
-    if not isRecommend: 
-       #  add_line(API_result_path,['Feedback', user_name]) 
-        print()
-    else:
-        # add_line(API_result_path,['Recommend', user_name])
-        print()
-    return make_response(jsonify({"selectedPoints": indices.tolist(), "scores": scores.tolist(), "suggestLabels":labels.tolist(),"cleanList":clean_list.tolist()}), 200)
+    if data.get("async"):
+        return submit_job("anomaly_query", work)
+    return make_response(jsonify(work(None)), 200)
 
 @app.route('/al_train', methods=["POST"])
 @cross_origin()
@@ -831,45 +672,53 @@ def al_train():
     iteration = data["iteration"]
     user_name = data["username"]
 
-    sys.path.append(CONTENT_PATH)
-    # default setting al_train is light version, we only save the last epoch
-    
-    context, error_message = initialize_backend(CONTENT_PATH, VIS_METHOD, SETTING)
-    context.save_acc_and_rej(iteration, acc_idxs, rej_idxs, user_name)
-    context.al_train(iteration, acc_idxs)
-    NEW_ITERATION =  context.get_max_iter()
-    context.vis_train(NEW_ITERATION, iteration)
-
-    # update iteration projection
-    embedding_2d, grid, decision_view, label_name_dict, label_color_list, label_list, _, training_data_index, \
-    testing_data_index, eval_new, prediction_list, selected_points, properties, _, _ = update_epoch_projection(context, NEW_ITERATION, dict(),None)
-    
-    # rewirte json =========
-    res_json_path = os.path.join(CONTENT_PATH, "iteration_structure.json")
-    with open(res_json_path,encoding='utf8')as fp:
-        json_data = json.load(fp)
-
-        json_data.append({'value': NEW_ITERATION, 'name': 'iteration', 'pid': iteration})
-        print('json_data',json_data)
-    with open(res_json_path,'w')as r:
-      json.dump(json_data, r)
-    r.close()
-    # rewirte json =========
-
-    del config
-    gc.collect()
-
-    sys.path.remove(CONTENT_PATH)
- 
-   # add_line(API_result_path,['al_train', user_name])
-    return make_response(jsonify({'result': embedding_2d, 'grid_index': grid, 'grid_color': 'data:image/png;base64,' + decision_view,
-                                  'label_name_dict': label_name_dict,
-                                  'label_color_list': label_color_list, 'label_list': label_list,
-                                  'maximum_iteration': NEW_ITERATION, 'training_data': training_data_index,
-                                  'testing_data': testing_data_index, 'evaluation': eval_new,
-                                  'prediction_list': prediction_list,
-                                  "selectedPoints":selected_points.tolist(),
-                                  "properties":properties.tolist()}), 200)
+    def work(job):
+        with content_path(CONTENT_PATH):
+            # default setting al_train is light version, we only save the last epoch
+
+            context, error_message = initialize_backend(CONTENT_PATH, VIS_METHOD, SETTING)
+            # the cached context is shared with other requests and jobs, al_train mutates it
+            with context.lock:
+                context.save_acc_and_rej(iteration, acc_idxs, rej_idxs, user_name)
+                report_progress(job, 0.05, "training subject model")
+                context.al_train(iteration, acc_idxs)
+                NEW_ITERATION =  context.get_max_iter()
+                report_progress(job, 0.5, "training visualization model")
+                context.vis_train(NEW_ITERATION, iteration)
+
+                # update iteration projection
+                report_progress(job, 0.9, "projecting iteration {}".format(NEW_ITERATION))
+                embedding_2d, grid, decision_view, label_name_dict, label_color_list, label_list, _, training_data_index, \
+                testing_data_index, eval_new, prediction_list, selected_points, properties, _, _, _ = update_epoch_projection(context, NEW_ITERATION, dict(), None, [])
+
+                # rewirte json =========
+                res_json_path = os.path.join(CONTENT_PATH, "iteration_structure.json")
+                with open(res_json_path,encoding='utf8')as fp:
+                    json_data = json.load(fp)
+
+                    json_data.append({'value': NEW_ITERATION, 'name': 'iteration', 'pid': iteration})
+                    print('json_data',json_data)
+                with open(res_json_path,'w')as r:
+                  json.dump(json_data, r)
+                r.close()
+                # rewirte json =========
+
+                gc.collect()
+
+
+               # add_line(API_result_path,['al_train', user_name])
+                return {'result': embedding_2d.tolist(), 'grid_index': grid, 'grid_color': 'data:image/png;base64,' + decision_view,
+                        'label_name_dict': label_name_dict,
+                        'label_color_list': label_color_list, 'label_list': label_list,
+                        'maximum_iteration': NEW_ITERATION, 'training_data': training_data_index,
+                        'testing_data': testing_data_index, 'evaluation': eval_new,
+                        'prediction_list': prediction_list,
+                        "selectedPoints":np.asarray(selected_points).tolist(),
+                        "properties":np.asarray(properties).tolist()}
+
+    if data.get("async"):
+        return submit_job("al_train", work)
+    return make_response(jsonify(work(None)), 200)
 
 def clear_cache(con_paths):
     for CONTENT_PATH in con_paths.values():
@@ -931,51 +780,89 @@ def get_res():
     imglist = dict()
     gridlist = dict()
 
-    sys.path.append(CONTENT_PATH)
-    context, error_message = initialize_backend(CONTENT_PATH, VIS_METHOD, SETTING)
-    
-    EPOCH_START = context.strategy.config["EPOCH_START"]
-    EPOCH_PERIOD = context.strategy.config["EPOCH_PERIOD"]
-    EPOCH_END = context.strategy.config["EPOCH_END"]
-
-    # TODO Interval to be decided
-    epoch_num = (EPOCH_END - EPOCH_START)// EPOCH_PERIOD + 1
-
-    for i in range(1, epoch_num+1, 1):
-        EPOCH = (i-1)*EPOCH_PERIOD + EPOCH_START
-
-        timevis , error_message= initialize_backend(CONTENT_PATH)
-
-        # detect whether we have query before
-        fname = "Epoch" if timevis.data_provider.mode == "normal" or timevis.data_provider.mode == "abnormal" else "Iteration"
-        checkpoint_path = context.strategy.data_provider.checkpoint_path(EPOCH)
-        bgimg_path = os.path.join(checkpoint_path, "bgimg.png")
-        embedding_path = os.path.join(checkpoint_path, "embedding.npy")
-        grid_path = os.path.join(checkpoint_path, "grid.pkl")
-        if os.path.exists(bgimg_path) and os.path.exists(embedding_path) and os.path.exists(grid_path):
-            path = os.path.join(timevis.data_provider.model_path, "{}_{}".format(fname, EPOCH))
-            result_path = os.path.join(path,"embedding.npy")
-            results[str(i)] = np.load(result_path).tolist()
-            with open(os.path.join(path, "grid.pkl"), "rb") as f:
-                grid = pickle.load(f)
-            gridlist[str(i)] = grid
-        else:
-            embedding_2d, grid, _, _, _, _, _, _, _, _, _, _, _, _,_  = update_epoch_projection(timevis, EPOCH, predicates, None)
-            results[str(i)] = embedding_2d
-            gridlist[str(i)] = grid
-        # read background img
-        with open(bgimg_path, 'rb') as img_f:
-            img_stream = img_f.read()
-        img_stream = base64.b64encode(img_stream).decode()
-        imglist[str(i)] = 'data:image/png;base64,' + img_stream
-        # imglist[str(i)] = "http://{}{}".format(ip_adress, bgimg_path)
-    sys.path.remove(CONTENT_PATH)
+    with content_path(CONTENT_PATH):
+        context, error_message = initialize_backend(CONTENT_PATH, VIS_METHOD, SETTING)
     
-    del config
+        EPOCH_START = context.strategy.config["EPOCH_START"]
+        EPOCH_PERIOD = context.strategy.config["EPOCH_PERIOD"]
+        EPOCH_END = context.strategy.config["EPOCH_END"]
+
+        # TODO Interval to be decided
+        epoch_num = (EPOCH_END - EPOCH_START)// EPOCH_PERIOD + 1
+
+        for i in range(1, epoch_num+1, 1):
+            EPOCH = (i-1)*EPOCH_PERIOD + EPOCH_START
+
+            timevis = context
+
+            # detect whether we have query before
+            fname = "Epoch" if timevis.data_provider.mode == "normal" or timevis.data_provider.mode == "abnormal" else "Iteration"
+            checkpoint_path = context.strategy.data_provider.checkpoint_path(EPOCH)
+            bgimg_path = os.path.join(checkpoint_path, "bgimg.png")
+            embedding_path = os.path.join(checkpoint_path, "embedding.npy")
+            grid_path = os.path.join(checkpoint_path, "grid.pkl")
+            if os.path.exists(bgimg_path) and os.path.exists(embedding_path) and os.path.exists(grid_path):
+                path = os.path.join(timevis.data_provider.model_path, "{}_{}".format(fname, EPOCH))
+                result_path = os.path.join(path,"embedding.npy")
+                results[str(i)] = np.load(result_path)
+                with open(os.path.join(path, "grid.pkl"), "rb") as f:
+                    grid = pickle.load(f)
+                gridlist[str(i)] = grid
+            else:
+                embedding_2d, grid, _, _, _, _, _, _, _, _, _, _, _, _,_  = update_epoch_projection(timevis, EPOCH, predicates, None)
+                results[str(i)] = embedding_2d
+                gridlist[str(i)] = grid
+            # read background img
+            with open(bgimg_path, 'rb') as img_f:
+                img_stream = img_f.read()
+            img_stream = base64.b64encode(img_stream).decode()
+            imglist[str(i)] = 'data:image/png;base64,' + img_stream
+            # imglist[str(i)] = "http://{}{}".format(ip_adress, bgimg_path)
     gc.collect()  
 
     # add_line(API_result_path,['animation', username])  
-    return make_response(jsonify({"results":results,"bgimgList":imglist, "grid": gridlist}), 200)
+    payload = {"results":results,"bgimgList":imglist, "grid": gridlist}
+    if wants_columnar(request):
+        columns = ["results.{}".format(key) for key in results.keys()] + ["grid.{}".format(key) for key in gridlist.keys()]
+        return columnar_response(request, payload, columns)
+    payload["results"] = {key: value.tolist() for key, value in results.items()}
+    return make_response(jsonify(payload), 200)
+
+@app.route('/backgroundTileMeta', methods=["POST"])
+@cross_origin()
+def background_tile_meta():
+    # extent of the background of an iteration, tile (z, x, y) covers 1/2^z of it
+    res = request.get_json()
+    CONTENT_PATH = os.path.normpath(res['path'])
+    VIS_METHOD = res['vis_method']
+    SETTING = res["setting"]
+    EPOCH = int(res['iteration'])
+    context, error_message = initialize_backend(CONTENT_PATH, VIS_METHOD, SETTING)
+    meta = get_background_tile_meta(context, EPOCH)
+    meta["errorMessage"] = error_message
+    return make_response(jsonify(meta), 200)
+
+@app.route('/backgroundTile/<int:iteration>/<int:z>/<int:x>/<int:y>.png', methods=["GET"])
+@cross_origin()
+def background_tile(iteration, z, x, y):
+    CONTENT_PATH = os.path.normpath(request.args.get("path"))
+    VIS_METHOD = request.args.get("vis_method")
+    SETTING = request.args.get("setting")
+    context, _ = initialize_backend(CONTENT_PATH, VIS_METHOD, SETTING)
+    try:
+        tile_path = get_background_tile(context, iteration, z, x, y)
+    except ValueError as e:
+        return make_response(jsonify({"errorMessage": str(e)}), 404)
+    return send_file(tile_path, mimetype="image/png", max_age=3600)
+
+@app.route('/invalidateBackend', methods=["POST"])
+@cross_origin()
+def invalidate_backend_cache():
+    # drop warm strategies, e.g. after re-training the visualization model of a content path
+    data = request.get_json(silent=True) or dict()
+    CONTENT_PATH = data.get("content_path")
+    removed = invalidate_backend(CONTENT_PATH)
+    return make_response(jsonify({"removed": removed}), 200)
 
 @app.route("/", methods=["GET", "POST"])
 def GUI():
@@ -995,30 +882,30 @@ def get_tree():
     VIS_METHOD = request.args.get("method")
     SETTING = request.args.get("setting")
 
-    sys.path.append(CONTENT_PATH)
-    context, error_message = initialize_backend(CONTENT_PATH, VIS_METHOD, SETTING)
+    with content_path(CONTENT_PATH):
+        context, error_message = initialize_backend(CONTENT_PATH, VIS_METHOD, SETTING)
     
-    EPOCH_START = context.strategy.config["EPOCH_START"]
-    EPOCH_PERIOD = context.strategy.config["EPOCH_PERIOD"]
-    EPOCH_END = context.strategy.config["EPOCH_END"]
+        EPOCH_START = context.strategy.config["EPOCH_START"]
+        EPOCH_PERIOD = context.strategy.config["EPOCH_PERIOD"]
+        EPOCH_END = context.strategy.config["EPOCH_END"]
 
     
-    res_json_path = os.path.join(CONTENT_PATH, "iteration_structure.json")
-    if os.path.exists(res_json_path):
-        with open(res_json_path,encoding='utf8')as fp:
-            json_data = json.load(fp)
+        res_json_path = os.path.join(CONTENT_PATH, "iteration_structure.json")
+        if os.path.exists(res_json_path):
+            with open(res_json_path,encoding='utf8')as fp:
+                json_data = json.load(fp)
     
-    else:
-        json_data = []
-        previous_epoch = ""
+        else:
+            json_data = []
+            previous_epoch = ""
 
-        for epoch in range(EPOCH_START, EPOCH_END + 1, EPOCH_PERIOD):
-            json_data.append({
-                "value": epoch,
-                "name": str(epoch),
-                "pid": previous_epoch if previous_epoch else ""
-            })
-            previous_epoch = epoch
+            for epoch in range(EPOCH_START, EPOCH_END + 1, EPOCH_PERIOD):
+                json_data.append({
+                    "value": epoch,
+                    "name": str(epoch),
+                    "pid": previous_epoch if previous_epoch else ""
+                })
+                previous_epoch = epoch
 
     return make_response(jsonify({"structure":json_data}), 200)
 
@@ -1027,7 +914,6 @@ app.route('/contrast/get_itertaion_structure', methods=["POST", "GET"])(get_tree
 @app.route('/indexSearch', methods=["POST", "GET"])
 @cross_origin()
 def index_search():
-    global code_entities
     global code_embeddings_collection
     res = request.get_json()
 
@@ -1036,46 +922,27 @@ def index_search():
     print(query)
     if query["key"] == "index":
         index = int(query["value"])
-        code_vectors_to_search = [code_entities[-1][index]]
+        code_vectors_to_search = [code_embeddings_collection.vectors[index]]
     if query["key"] == "nl":
         sys.path.append('/home/yiming/cophi/training_dynamic/code_training_dynamic/saved_models/ruby_fine_tine_5/Model')
         from run import gen_nl_vector
         string = query["value"]
         code_vectors_to_search = [gen_nl_vector(string)]
 
-    search_params = {
-        "metric_type": "L2",
-        "params": {"nprobe": 10},
-    }
-
     DEFAULT_LIMIT = 5
     k_num = int(query["k"]) if query.get("k") is not None else DEFAULT_LIMIT
 
-    code_code_result = code_embeddings_collection.search(code_vectors_to_search, "code_embeddings", search_params, limit=k_num)
+    distances, ids = code_embeddings_collection.search(np.asarray(code_vectors_to_search), k_num)
+    hit_list_ = hit_list(distances[0], ids[0])
 
-    for hits in code_code_result:
-        for hit in hits:
-            print(f"code_code hit: {hit}")
-
-    hit_list = []
-    for hits in code_code_result:
-        for hit in hits:
-            hit_dict = {
-                'distance': hit.distance,
-                'id': hit.id
-            }
-            hit_list.append(hit_dict)
-
-    print(hit_list)
-    return make_response(jsonify({'result': hit_list}), 200)
+    print(hit_list_)
+    return make_response(jsonify({'result': hit_list_}), 200)
 
 
 @app.route('/contrastIndexSearch', methods=["POST", "GET"])
 @cross_origin()
 def contrast_index_search():
-    global code_entities
     global code_embeddings_collection
-    global nl_entities
     global nl_embeddings_collection
     res = request.get_json()
 
@@ -1084,64 +951,40 @@ def contrast_index_search():
     print(query)
     if query["key"] == "left-index":
         index = int(query["value"])
-        vectors_to_search = [code_entities[-1][index]]
+        vectors_to_search = [code_embeddings_collection.vectors[index]]
     if query["key"] == "right-index":
         index = int(query["value"])
-        vectors_to_search = [nl_entities[-1][index]]
+        vectors_to_search = [nl_embeddings_collection.vectors[index]]
     if query["key"] == "inter-index":
         index = int(query["value"])
-        vectors_to_search = [nl_entities[-1][index]]
+        vectors_to_search = [nl_embeddings_collection.vectors[index]]
     if query["key"] == "nl":
         sys.path.append('/home/yiming/cophi/training_dynamic/code_training_dynamic/saved_models/ruby_fine_tine_5/Model')
         from run import gen_nl_vector
         string = query["value"]
         vectors_to_search = [gen_nl_vector(string)]
 
-    search_params = {
-        "metric_type": "L2",
-        "params": {"nprobe": 10},
-    }
-
     DEFAULT_LIMIT = 5
     k_num = int(query["k"]) if query.get("k") is not None else DEFAULT_LIMIT
 
     if query["key"] == "right-index":
-        search_result = nl_embeddings_collection.search(vectors_to_search, "nl_embeddings", search_params, limit=k_num)
+        distances, ids = nl_embeddings_collection.search(np.asarray(vectors_to_search), k_num)
     else:
-        search_result = code_embeddings_collection.search(vectors_to_search, "code_embeddings", search_params, limit=k_num)
-
-    for hits in search_result:
-        for hit in hits:
-            print(f"code_code hit: {hit}")
+        distances, ids = code_embeddings_collection.search(np.asarray(vectors_to_search), k_num)
+    hit_list_ = hit_list(distances[0], ids[0])
 
-    hit_list = []
-    for hits in search_result:
-        for hit in hits:
-            hit_dict = {
-                'distance': hit.distance,
-                'id': hit.id
-            }
-            hit_list.append(hit_dict)
-
-    print(hit_list)
-    return make_response(jsonify({'result': hit_list}), 200)
+    print(hit_list_)
+    return make_response(jsonify({'result': hit_list_}), 200)
 
 @app.route('/queryMissSearch', methods=["POST", "GET"])
 @cross_origin()
 def query_miss_search():
-    global code_entities
     global code_embeddings_collection
-    global nl_entities
     global nl_embeddings_collection
     res = request.get_json()
 
     query = res["query"]
 
-    search_params = {
-        "metric_type": "L2",
-        "params": {"nprobe": 10},
-    }
-
     DEFAULT_LIMIT = 5
     k_num = int(query["k"]) if query.get("k") is not None else DEFAULT_LIMIT
     mis_query_indices = ''
@@ -1162,23 +1005,11 @@ def query_miss_search():
         mis_query_indices = ','.join(str(index) for index, item in enumerate(ref_mis_query_list) if int(item) != 0)
     else:
         print("len", nl_embeddings_collection.num_entities)
-        for i in range(nl_embeddings_collection.num_entities):
-            miss_query_flag = True
-            vectors_to_search = [nl_entities[-1][i]]
-            search_result = code_embeddings_collection.search(vectors_to_search, "code_embeddings", search_params, limit=k_num)
-
-            for hits in search_result:
-                for hit in hits:
-                    if int(hit.id) == i:
-                        miss_query_flag = False
-                        break
-            if miss_query_flag: 
-                if mis_query_indices == '':
-                    mis_query_indices += str(i)
-                else:
-                    mis_query_indices += ',' + str(i)
-            if i % 1000 == 0:
-                print(i, mis_query_indices)
+        # all nl queries in one batched search, a query is missed when its own code is not among the hits
+        queries = nl_embeddings_collection.vectors
+        _, ids = code_embeddings_collection.search(queries, k_num)
+        missed = ~(ids == np.arange(len(queries))[:, None]).any(axis=1)
+        mis_query_indices = ','.join(str(i) for i in np.flatnonzero(missed))
 
     return make_response(jsonify({'result': mis_query_indices}), 200)
 
@@ -1246,6 +1077,42 @@ def add_new_label():
         success = False
     return make_response(jsonify({'success': success}), 200)
 
+################################################ jobs ##################################################
+def submit_job(kind, work):
+    job_id = jobs.submit(kind, work)
+    return make_response(jsonify({"job_id": job_id, "status": "queued"}), 202)
+
+
+@app.route('/jobs/<job_id>', methods=["GET"])
+@cross_origin()
+def job_status(job_id):
+    record = jobs.status(job_id)
+    if record is None:
+        return make_response(jsonify({"errorMessage": "unknown job"}), 404)
+    return make_response(jsonify(record), 200)
+
+
+@app.route('/jobs/<job_id>/result', methods=["GET"])
+@cross_origin()
+def job_result(job_id):
+    record = jobs.status(job_id)
+    if record is None:
+        return make_response(jsonify({"errorMessage": "unknown job"}), 404)
+    if record["status"] != "done":
+        return make_response(jsonify(record), 409)
+    payload = jobs.result(job_id)
+    if record["kind"] == "updateProjection" and wants_columnar(request):
+        return columnar_response(request, payload, PROJECTION_COLUMNS)
+    return make_response(jsonify(payload), 200)
+
+
+@app.route('/jobs/<job_id>/cancel', methods=["POST"])
+@cross_origin()
+def job_cancel(job_id):
+    if jobs.status(job_id) is None:
+        return make_response(jsonify({"errorMessage": "unknown job"}), 404)
+    return make_response(jsonify({"cancelled": jobs.cancel(job_id)}), 200)
+
 def check_port_inuse(port, host):
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -6,17 +6,55 @@ import numpy as np
 import sys
 import pickle
 import base64
+import weakref
+import threading
+from contextlib import contextmanager
 
 vis_path = ".."
 sys.path.append(vis_path)
 from context import VisContext, ActiveLearningContext, AnormalyContext
+from backend_cache import BackendCache
 from strategy import DeepDebugger, TimeVis, tfDeepVisualInsight, DVIAL, tfDVIDenseAL, TimeVisDenseAL, Trustvis, DeepVisualInsight
+from singleVis.tiles import TileRenderer
+from singleVis.spatial_index import SpatialIndexCache
+from singleVis.sprite_pack import SpriteStore, sprite_mime
 from singleVis.eval.evaluate import rank_similarities_and_color, evaluate_isAlign, evaluate_isNearestNeighbour, evaluate_isAlign_single, evaluate_isNearestNeighbour_single
 from sklearn.cluster import KMeans
 from scipy.special import softmax
 import matplotlib.pyplot as plt
 import time
 import torch
+# requests running in threads share sys.path, a content path stays on it while any request needs it
+_content_paths = dict()
+_content_paths_lock = threading.Lock()
+
+def add_content_path(CONTENT_PATH):
+    """sys.path.append(CONTENT_PATH), counted per request"""
+    with _content_paths_lock:
+        if _content_paths.get(CONTENT_PATH, 0) == 0:
+            sys.path.append(CONTENT_PATH)
+        _content_paths[CONTENT_PATH] = _content_paths.get(CONTENT_PATH, 0) + 1
+
+def remove_content_path(CONTENT_PATH):
+    """undo add_content_path, CONTENT_PATH leaves sys.path with its last request"""
+    with _content_paths_lock:
+        count = _content_paths.get(CONTENT_PATH, 0) - 1
+        if count > 0:
+            _content_paths[CONTENT_PATH] = count
+            return
+        _content_paths.pop(CONTENT_PATH, None)
+        if CONTENT_PATH in sys.path:
+            sys.path.remove(CONTENT_PATH)
+
+@contextmanager
+def content_path(CONTENT_PATH):
+    """CONTENT_PATH on sys.path for the duration of the block, removed even if the block raises"""
+    add_content_path(CONTENT_PATH)
+    try:
+        yield
+    finally:
+        remove_content_path(CONTENT_PATH)
+
 """Interface align"""
 
 def initialize_strategy(CONTENT_PATH, VIS_METHOD, SETTING, dense=False):
@@ -81,13 +119,30 @@ def initialize_backend(CONTENT_PATH, VIS_METHOD, SETTING, dense=False):
         NotImplementedError: _description_
 
     Returns:
-        backend: a context with a specific strategy
+        backend: a context with a specific strategy, cached and reused across requests
     """
-    strategy, error_message = initialize_strategy(CONTENT_PATH, VIS_METHOD, SETTING, dense)
+    return backend_cache.get(CONTENT_PATH, VIS_METHOD, SETTING, dense)
+
+def build_backend(CONTENT_PATH, VIS_METHOD, SETTING, dense=False):
+    # the strategy imports the subject model from CONTENT_PATH
+    add_content_path(CONTENT_PATH)
+    try:
+        strategy, error_message = initialize_strategy(CONTENT_PATH, VIS_METHOD, SETTING, dense)
+    finally:
+        remove_content_path(CONTENT_PATH)
     print("contenePath", CONTENT_PATH)
     context = initialize_context(strategy=strategy, setting=SETTING)
     return context, error_message
 
+def invalidate_backend(CONTENT_PATH=None):
+    """drop cached backends of CONTENT_PATH (all backends if None)"""
+    return backend_cache.invalidate(CONTENT_PATH)
+
+# warm contexts shared by all requests, see backend_cache.py
+backend_cache = BackendCache(build_backend, max_size=4)
+# spatial indexes of the embeddings compared in the contrast view
+spatial_index_cache = SpatialIndexCache(max_size=8)
+
 
 
 def check_labels_match_alldata(labels, all_data, error_message):
@@ -149,6 +204,50 @@ def get_grid_bfig(context, EPOCH, embedding_2d):
         np.save(get_embedding_path(context, EPOCH), embedding_2d)
     return grid, b_fig
 
+# one tile renderer per (cached) visualizer
+tile_renderers = weakref.WeakKeyDictionary()
+
+def get_tile_renderer(context):
+    vis = context.strategy.vis
+    renderer = tile_renderers.get(vis)
+    if renderer is None:
+        renderer = TileRenderer(vis)
+        tile_renderers[vis] = renderer
+    return renderer
+
+def get_background_tile_meta(context, EPOCH):
+    meta = get_tile_renderer(context).meta(EPOCH)
+    return {key: meta[key] for key in ["x_min", "y_min", "x_max", "y_max", "tile_size", "max_zoom"]}
+
+def get_background_tile(context, EPOCH, z, x, y):
+    return get_tile_renderer(context).render(EPOCH, z, x, y)
+
+sprite_stores = dict()
+
+def get_sprite_store(CONTENT_PATH):
+    store = sprite_stores.get(CONTENT_PATH)
+    if store is None:
+        store = SpriteStore(CONTENT_PATH)
+        sprite_stores[CONTENT_PATH] = store
+    return store
+
+def get_sprite_ids(CONTENT_PATH, indices):
+    """sprite ids of sample indices, remapped through Model/new_index.json when the content path has one"""
+    abnorm_idx_path = os.path.join(CONTENT_PATH, "Model", "new_index.json")
+    if os.path.isfile(abnorm_idx_path):
+        with open(abnorm_idx_path, "r") as f:
+            idxs = json.load(f)
+        return [idxs[int(idx)] for idx in indices]
+    return [int(idx) for idx in indices]
+
+def pack_sprites(sprites):
+    """
+    concatenate encoded sprites into one binary body
+    layout (little endian): uint32 count | count x uint32 length | sprite bytes in request order
+    """
+    lengths = np.asarray([len(sprite) for sprite in sprites], dtype="<u4")
+    return np.asarray([len(sprites)], dtype="<u4").tobytes() + lengths.tobytes() + b"".join(sprites)
+
 def get_eval_new(context, EPOCH):
     eval_new = dict()
     file_name = context.strategy.config["VISUALIZATION"]["EVALUATION_NAME"]
@@ -185,17 +284,9 @@ def get_train_test_label(context, EPOCH):
     return labels
 
 def get_selected_points(context, predicates, EPOCH, training_data_number, testing_data_number):
-    selected_points = np.arange(training_data_number + testing_data_number)
-    for key in predicates.keys():
-        if key == "label":
-            tmp = np.array(context.filter_label(predicates[key]))
-        elif key == "type":
-            tmp = np.array(context.filter_type(predicates[key], int(EPOCH)))
-        else:
-            tmp = np.arange(training_data_number + testing_data_number)    
-        selected_points = np.intersect1d(selected_points, tmp)
-
-    return selected_points
+    if len(predicates) == 0:
+        return np.arange(training_data_number + testing_data_number)
+    return context.filter_points(predicates, int(EPOCH))
 
 def get_properties(context, training_data_number, testing_data_number, training_data_index, EPOCH):
     properties = np.concatenate((np.zeros(training_data_number, dtype=np.int16), 2*np.ones(testing_data_number, dtype=np.int16)), axis=0)
@@ -352,14 +443,15 @@ def update_epoch_projection(context, EPOCH, predicates, TaskType, indicates):
             for prediction in predictions:
                 prediction_list.append(prediction)
         else:
-            prediction_origin = context.strategy.data_provider.get_pred(EPOCH, all_data)
-            prediction = prediction_origin.argmax(1)
-
-            for i in range(len(prediction)):
-                prediction_list.append(CLASSES[prediction[i]])
-                top_three_indices = np.argsort(prediction_origin[i])[-3:][::-1]
-                conf_list = [(label_name_dict[top_three_indices[j]], round(float(prediction_origin[i][top_three_indices[j]]), 1)) for j in range(len(top_three_indices))]
-                confidence_list.append(conf_list)
+            predictions = context.strategy.data_provider.epoch_predictions(EPOCH)
+            prediction, topk_idx, topk_val = predictions["pred"], predictions["topk_idx"], predictions["topk_val"]
+            if len(indicates):
+                prediction, topk_idx, topk_val = prediction[indicates], topk_idx[indicates], topk_val[indicates]
+
+            prediction_list = CLASSES[prediction].tolist()
+            topk_names = CLASSES[topk_idx].tolist()
+            topk_val = np.round(topk_val.astype(np.float64), 1).tolist()
+            confidence_list = [list(zip(names, vals)) for names, vals in zip(topk_names, topk_val)]
     else:
         for i in range(len(all_data)):
             prediction_list.append(0)
@@ -396,7 +488,7 @@ def update_epoch_projection(context, EPOCH, predicates, TaskType, indicates):
     print("midduration", start1-end)
     print("endduration", end1-start1)
     print("EMBEDDINGLEN", len(embedding_2d))
-    return embedding_2d.tolist(), grid, b_fig, label_name_dict, label_color_list, label_list, max_iter, training_data_index, testing_data_index, eval_new, prediction_list, selected_points, properties,error_message, color_list, confidence_list
+    return embedding_2d, grid, b_fig, label_name_dict, label_color_list, label_list, max_iter, training_data_index, testing_data_index, eval_new, prediction_list, selected_points, properties,error_message, color_list, confidence_list
 
 def highlight_epoch_projection(context, EPOCH, predicates, TaskType,indicates):
     # TODO consider active learning setting
@@ -425,10 +517,10 @@ def highlight_epoch_projection(context, EPOCH, predicates, TaskType,indicates):
                 prediction_list.append(prediction)
                 
         else:
-            prediction = context.strategy.data_provider.get_pred(EPOCH, all_data).argmax(1)
-
-            for i in range(len(prediction)):
-                prediction_list.append(CLASSES[prediction[i]])
+            prediction = context.strategy.data_provider.epoch_predictions(EPOCH)["pred"]
+            if len(indicates):
+                prediction = prediction[indicates]
+            prediction_list = CLASSES[prediction].tolist()
     else:
         for i in range(len(all_data)):
             prediction_list.append(0)
@@ -799,62 +891,50 @@ def getVisError(context, EPOCH, TaskType):
     return highlightedPointIndices
 
 	
+def embedding_neighbors(context, iteration, embedding_2d, n_neighbors=15):
+    """kNN indices of an epoch's 2D embedding, persisted by the data provider's KnnCache, None if it has none"""
+    knn = getattr(context.strategy.data_provider, "knn", None)
+    if knn is None:
+        return None
+    indices, _ = knn.get(iteration, "embedding", embedding_2d, n_neighbors)
+    return indices
+
+def contrast_embedding_index(context, iteration):
+    """SpatialIndex over the 2D embedding of train and test data, projected and saved to embedding.npy on the first request"""
+    embedding_path = os.path.join(context.strategy.data_provider.checkpoint_path(iteration), "embedding.npy")
+    def project():
+        train_data = context.train_representation_data(iteration)
+        test_data = context.test_representation_data(iteration)
+        all_data = np.concatenate((train_data, test_data), axis=0)
+        return context.strategy.projector.batch_project(iteration, all_data)
+    return spatial_index_cache.get(embedding_path, project)
+
 def getContraVisChangeIndices(context_left,context_right, iterationLeft, iterationRight, method):
    
     predChangeIndices = []
     
-    train_data = context_left.train_representation_data(iterationLeft)
-    test_data = context_left.test_representation_data(iterationLeft)
-    all_data = np.concatenate((train_data, test_data), axis=0)
-    embedding_path = os.path.join(context_left.strategy.data_provider.checkpoint_path(iterationLeft), "embedding.npy")
-    if os.path.exists(embedding_path):
-        embedding_2d = np.load(embedding_path)
-    else:
-        embedding_2d = context_left.strategy.projector.batch_project(iterationLeft, all_data)
-        np.save(embedding_path, embedding_2d)
-    last_train_data = context_right.train_representation_data(iterationRight)
-    last_test_data = context_right.test_representation_data(iterationRight)
-    last_all_data = np.concatenate((last_train_data, last_test_data), axis=0)
-    last_embedding_path = os.path.join(context_right.strategy.data_provider.checkpoint_path(iterationRight), "embedding.npy")
-    if os.path.exists(last_embedding_path):
-        last_embedding_2d = np.load(last_embedding_path)
-    else:
-        last_embedding_2d = context_right.strategy.projector.batch_project(iterationRight, last_all_data)
-        np.save(last_embedding_path, last_embedding_2d)
+    left_index = contrast_embedding_index(context_left, iterationLeft)
+    right_index = contrast_embedding_index(context_right, iterationRight)
+    embedding_2d = left_index.embedding
+    last_embedding_2d = right_index.embedding
     if (method == "align"):
         predChangeIndices = evaluate_isAlign(embedding_2d, last_embedding_2d)
     elif (method == "nearest neighbour"):
-        predChangeIndices = evaluate_isNearestNeighbour(embedding_2d, last_embedding_2d)
+        predChangeIndices = evaluate_isNearestNeighbour(embedding_2d, last_embedding_2d, left_neighbors=embedding_neighbors(context_left, iterationLeft, embedding_2d), right_neighbors=embedding_neighbors(context_right, iterationRight, last_embedding_2d))
     elif (method == "both"):
         predChangeIndices_align = evaluate_isAlign(embedding_2d, last_embedding_2d)
-        predChangeIndices_nearest = evaluate_isNearestNeighbour(embedding_2d, last_embedding_2d)
+        predChangeIndices_nearest = evaluate_isNearestNeighbour(embedding_2d, last_embedding_2d, left_neighbors=embedding_neighbors(context_left, iterationLeft, embedding_2d), right_neighbors=embedding_neighbors(context_right, iterationRight, last_embedding_2d))
   
-        intersection = set(predChangeIndices_align).intersection(predChangeIndices_nearest)
-    
-        predChangeIndices = list(intersection)
+        predChangeIndices = np.intersect1d(predChangeIndices_align, predChangeIndices_nearest).tolist()
     else:
         print("wrong method")
     return predChangeIndices
 def getContraVisChangeIndicesSingle(context_left,context_right, iterationLeft, iterationRight, method, left_selected, right_selected):
     
-    train_data = context_left.train_representation_data(iterationLeft)
-    test_data = context_left.test_representation_data(iterationLeft)
-    all_data = np.concatenate((train_data, test_data), axis=0)
-    embedding_path = os.path.join(context_left.strategy.data_provider.checkpoint_path(iterationLeft), "embedding.npy")
-    if os.path.exists(embedding_path):
-        embedding_2d = np.load(embedding_path)
-    else:
-        embedding_2d = context_left.strategy.projector.batch_project(iterationLeft, all_data)
-        np.save(embedding_path, embedding_2d)
-    last_train_data = context_right.train_representation_data(iterationRight)
-    last_test_data = context_right.test_representation_data(iterationRight)
-    last_all_data = np.concatenate((last_train_data, last_test_data), axis=0)
-    last_embedding_path = os.path.join(context_right.strategy.data_provider.checkpoint_path(iterationRight), "embedding.npy")
-    if os.path.exists(last_embedding_path):
-        last_embedding_2d = np.load(last_embedding_path)
-    else:
-        last_embedding_2d = context_right.strategy.projector.batch_project(iterationRight, last_all_data)
-        np.save(last_embedding_path, last_embedding_2d)
+    left_index = contrast_embedding_index(context_left, iterationLeft)
+    right_index = contrast_embedding_index(context_right, iterationRight)
+    embedding_2d = left_index.embedding
+    last_embedding_2d = right_index.embedding
     predChangeIndicesLeft = []
     predChangeIndicesRight = []
     predChangeIndicesLeft_Left = []
@@ -862,19 +942,15 @@ def getContraVisChangeIndicesSingle(context_left,context_right, iterationLeft, i
     predChangeIndicesRight_Left = []
     predChangeIndicesRight_Right = []
     if (method == "align"):
-        predChangeIndicesLeft, predChangeIndicesRight = evaluate_isAlign_single(embedding_2d, last_embedding_2d, left_selected, right_selected)
+        predChangeIndicesLeft, predChangeIndicesRight = evaluate_isAlign_single(embedding_2d, last_embedding_2d, left_selected, right_selected, left_index=left_index, right_index=right_index)
     elif (method == "nearest neighbour"):
-        predChangeIndicesLeft_Left, predChangeIndicesLeft_Right,predChangeIndicesRight_Left, predChangeIndicesRight_Right= evaluate_isNearestNeighbour_single(embedding_2d, last_embedding_2d, left_selected, right_selected)
+        predChangeIndicesLeft_Left, predChangeIndicesLeft_Right,predChangeIndicesRight_Left, predChangeIndicesRight_Right= evaluate_isNearestNeighbour_single(embedding_2d, last_embedding_2d, left_selected, right_selected, left_neighbors=embedding_neighbors(context_left, iterationLeft, embedding_2d), right_neighbors=embedding_neighbors(context_right, iterationRight, last_embedding_2d))
     return predChangeIndicesLeft, predChangeIndicesRight, predChangeIndicesLeft_Left, predChangeIndicesLeft_Right, predChangeIndicesRight_Left, predChangeIndicesRight_Right
 
 def getCriticalChangeIndices(context, curr_iteration, next_iteration):
     predChangeIndices = []
-    
-    all_data = get_train_test_data(context, curr_iteration)
-    all_data_next = get_train_test_data(context, next_iteration)
-  
-    high_pred = context.strategy.data_provider.get_pred(curr_iteration, all_data).argmax(1)
-    next_high_pred = context.strategy.data_provider.get_pred(next_iteration, all_data_next).argmax(1)
+    high_pred = context.strategy.data_provider.epoch_predictions(curr_iteration)["pred"]
+    next_high_pred = context.strategy.data_provider.epoch_predictions(next_iteration)["pred"]
     predChangeIndices = np.where(high_pred != next_high_pred)[0]
     return predChangeIndices
 
@@ -898,18 +974,16 @@ def getConfChangeIndices(context, curr_iteration, last_iteration, confChangeInpu
     else:
         last_embedding_2d = context.strategy.projector.batch_project(last_iteration, last_all_data)
         np.save(last_embedding_path, last_embedding_2d)
-    high_pred = context.strategy.data_provider.get_pred(curr_iteration, all_data)
-    last_high_pred = context.strategy.data_provider.get_pred(last_iteration, last_all_data)
-    high_conf = softmax(high_pred, axis=1)
-    last_high_conf = softmax(last_high_pred, axis=1)
+    high_pred = context.strategy.data_provider.epoch_predictions(curr_iteration)
+    last_high_pred = context.strategy.data_provider.epoch_predictions(last_iteration)
     # get class type with highest prob
-    high_pred_class = high_conf.argmax(axis=1)
-    last_high_pred_class = last_high_conf.argmax(axis=1)
+    high_pred_class = high_pred["pred"]
+    last_high_pred_class = last_high_pred["pred"]
     same_pred_indices = np.where(high_pred_class == last_high_pred_class)[0]
     print("same")
     print(same_pred_indices)
     # get
-    conf_diff = np.abs(high_conf[np.arange(len(high_conf)), high_pred_class] - last_high_conf[np.arange(len(last_high_conf)), last_high_pred_class])
+    conf_diff = np.abs(high_pred["confidence"] - last_high_pred["confidence"])
     print("conf")
     print(conf_diff)
     significant_conf_change_indices = same_pred_indices[conf_diff[same_pred_indices] > confChangeInput]
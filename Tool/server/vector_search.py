@@ -0,0 +1,107 @@
+"""Vector collections behind the index search endpoints, an in-process IVF index or a Milvus server"""
+import os
+
+import numpy as np
+
+from singleVis.vector_index import load_vector_index
+
+# "local" keeps an IVF index in process, persisted next to the representations
+# "milvus" inserts the representations into a Milvus server on localhost:19530
+VECTOR_BACKEND = os.environ.get("VECTOR_BACKEND", "local")
+
+fmt = "\n=== {:30} ===\n"
+
+
+class LocalCollection:
+    def __init__(self, name, source):
+        self.name = name
+        self.index = load_vector_index(source, name=name)
+
+    @property
+    def vectors(self):
+        return self.index.vectors
+
+    @property
+    def num_entities(self):
+        return self.index.num_entities
+
+    def search(self, vectors, limit, nprobe=10):
+        """:return: (distances, ids), numpy.ndarray of shape (len(vectors), limit)"""
+        return self.index.search(vectors, k=limit, nprobe=nprobe)
+
+
+class MilvusCollection:
+    def __init__(self, name, source):
+        # optional dependency, only needed for this backend
+        from pymilvus import connections, utility, FieldSchema, CollectionSchema, DataType, Collection
+
+        self.name = name
+        self.vectors = np.load(source)
+        dim = self.vectors.shape[1]
+
+        print(fmt.format("start connecting to Milvus"))
+        connections.connect("default", host="localhost", port="19530")
+        if utility.has_collection(name):
+            utility.drop_collection(name)
+
+        fields = [
+            FieldSchema(name="pk", dtype=DataType.VARCHAR, is_primary=True, auto_id=False, max_length=100),
+            FieldSchema(name=name, dtype=DataType.FLOAT_VECTOR, dim=dim)
+        ]
+        schema = CollectionSchema(fields, "{} in Milvus".format(name))
+        print(fmt.format("Create collection `{}`".format(name)))
+        self.collection = Collection(name, schema, consistency_level="Strong")
+
+        print(fmt.format("Start inserting entities"))
+        batch_size = 1000
+        for start in range(0, len(self.vectors), batch_size):
+            end = min(start + batch_size, len(self.vectors))
+            self.collection.insert([[str(i) for i in range(start, end)], self.vectors[start:end]])
+        print(f"Number of entities in Milvus: {self.collection.num_entities}")
+
+        print(fmt.format("Start Creating index IVF_FLAT"))
+        index = {
+            "index_type": "IVF_FLAT",
+            "metric_type": "L2",
+            "params": {"nlist": 128},
+        }
+        self.collection.create_index(name, index)
+        print(fmt.format("Start loading"))
+        self.collection.load()
+
+    @property
+    def num_entities(self):
+        return self.collection.num_entities
+
+    def search(self, vectors, limit, nprobe=10):
+        search_params = {
+            "metric_type": "L2",
+            "params": {"nprobe": nprobe},
+        }
+        distances = np.full((len(vectors), limit), np.inf, dtype=np.float32)
+        ids = np.full((len(vectors), limit), -1, dtype=np.int64)
+        # Milvus caps the number of queries per request
+        for start in range(0, len(vectors), 1000):
+            result = self.collection.search(list(vectors[start:start + 1000]), self.name, search_params, limit=limit)
+            for q, hits in enumerate(result):
+                for j, hit in enumerate(hits):
+                    distances[start + q, j] = hit.distance
+                    ids[start + q, j] = int(hit.id)
+        return distances, ids
+
+
+def load_collection(name, source, backend=None):
+    """
+    :param name: str, collection name, e.g. "code_embeddings"
+    :param source: str, location of the representation .npy file
+    :param backend: str or None, "local" or "milvus", VECTOR_BACKEND by default
+    """
+    backend = VECTOR_BACKEND if backend is None else backend
+    if backend == "milvus":
+        return MilvusCollection(name, source)
+    return LocalCollection(name, source)
+
+
+def hit_list(distances, ids):
+    """hits of a single query in the response format of the search endpoints"""
+    return [{'distance': float(d), 'id': str(i)} for d, i in zip(distances, ids) if i >= 0]
@@ -14,7 +14,8 @@ from sklearn.utils import check_random_state
 from singleVis.kcenter_greedy import kCenterGreedy
 from singleVis.intrinsic_dim import IntrinsicDim
 from singleVis.backend import get_graph_elements, get_attention
-from singleVis.utils import find_neighbor_preserving_rate
+from singleVis.utils import epoch_neighbor_preserving_rate
+from singleVis.knn_cache import KnnCache
 from kmapper import KeplerMapper
 from sklearn.cluster import DBSCAN
 import networkx as nx
@@ -27,7 +28,7 @@ from trustVis.sampeling import Sampleing
 from trustVis.data_generation import DataGeneration
 from sklearn.neighbors import KernelDensity
 from singleVis.utils import *
-from scipy.sparse import coo_matrix
+from scipy.sparse import coo_matrix, csr_matrix
 from trustVis.data_generation import DataGeneration
 
 seed_value = 0
@@ -42,6 +43,9 @@ torch.backends.cudnn.benchmark = False
 # Set the random seed for numpy
 np.random.seed(seed_value)
 
+# upper bound of the temporary arrays of the batched kernels below, in bytes
+MAX_CHUNK_BYTES = 1 << 28
+
 class SpatialEdgeConstructorAbstractClass(ABC):
     @abstractmethod
     def __init__(self, data_provider) -> None:
@@ -84,27 +88,17 @@ class SpatialEdgeConstructor(SpatialEdgeConstructorAbstractClass):
         self.n_neighbors = n_neighbors
 
 
-    def _construct_fuzzy_complex(self, train_data, metric="euclidean"):
+    def _construct_fuzzy_complex(self, train_data, metric="euclidean", epoch=None):
         # """
         # construct a vietoris-rips complex
         # """
-        # number of trees in random projection forest
-        n_trees = min(64, 5 + int(round((train_data.shape[0]) ** 0.5 / 20.0)))
-        # max number of nearest neighbor iters to perform
-        n_iters = max(5, int(round(np.log2(train_data.shape[0]))))
-        # distance metric
         # # get nearest neighbors
-        
-        nnd = NNDescent(
-            train_data,
-            n_neighbors=self.n_neighbors,
-            metric=metric,
-            n_trees=n_trees,
-            n_iters=n_iters,
-            max_candidates=60,
-            verbose=True
-        )
-        knn_indices, knn_dists = nnd.neighbor_graph
+        # the full train representation of an epoch shares its kNN graph with the evaluator
+        knn = getattr(self.data_provider, "knn", None)
+        if epoch is not None and knn is not None:
+            knn_indices, knn_dists = knn.get(epoch, "train", train_data, self.n_neighbors, metric=metric)
+        else:
+            knn_indices, knn_dists = KnnCache.build(train_data, self.n_neighbors, metric=metric)
         random_state = check_random_state(42)
         complex, sigmas, rhos = fuzzy_simplicial_set(
             X=train_data,
@@ -116,17 +110,21 @@ class SpatialEdgeConstructor(SpatialEdgeConstructorAbstractClass):
         )
         return complex, sigmas, rhos, knn_indices
     def get_pred_diff( self, data, neibour_data, knn_indices, epoch):
+        """
+        prediction difference between each sample and its neighbours, exp(mean |g(x) - g(x_j)|) - 1
+        :param knn_indices: numpy.ndarray, (len(data), k) indices into neibour_data
+        :return: numpy.ndarray, (len(data), k)
+        """
         pred  = self.data_provider.get_pred(epoch, data)
         pred_n  = self.data_provider.get_pred(epoch, neibour_data)
-        new_l =[]
-        for i in range(len(knn_indices)):
-            pred_i = pred_n[knn_indices[i]]
-            pred_diff = np.mean(np.abs(pred_i - pred[i]), axis=-1) #
-            
-            pred_diff = np.exp(pred_diff) - 1  # amplify the difference
-            new_l.append(pred_diff)
-
-        new_l = np.array(new_l)
+        knn_indices = np.asarray(knn_indices)
+        new_l = np.empty(knn_indices.shape, dtype=pred_n.dtype)
+        # gather the neighbour predictions of a block of rows at a time, (rows, k, classes) stays below MAX_CHUNK_BYTES
+        rows = max(1, MAX_CHUNK_BYTES // max(1, knn_indices.shape[1] * pred_n.shape[1] * pred_n.itemsize))
+        for start in range(0, len(knn_indices), rows):
+            end = min(start + rows, len(knn_indices))
+            pred_diff = np.abs(pred_n[knn_indices[start:end]] - pred[start:end, None, :]).mean(axis=-1)
+            new_l[start:end] = np.exp(pred_diff) - 1  # amplify the difference
         return new_l
 
     
@@ -170,24 +168,29 @@ class SpatialEdgeConstructor(SpatialEdgeConstructorAbstractClass):
     
    
     
-    def _get_perturb_neibour(self,train_data,n_perturbations=10,perturbation_scale=0.04):
+    def _iter_perturb_neibour(self,train_data,n_perturbations=10,perturbation_scale=0.04):
+        """
+        gaussian perturbations of the k nearest neighbours of every point, in chunks of at most MAX_CHUNK_BYTES
+            rows are ordered by point, then neighbour, then perturbation
+        :return: generator of numpy.ndarray, (chunk_size, dim)
+        """
         # find neibour of each point
-        X = train_data
+        X = np.asarray(train_data)
         nn = NearestNeighbors(n_neighbors=self.n_neighbors)
         nn.fit(X)
         _, indices = nn.kneighbors(X)
-        # generate pertubation
-       
-        for i in range(X.shape[0]):
-            for j in range(self.n_neighbors):
-                for _ in range(n_perturbations):
-                 
-                    perturbation = np.random.normal(scale=perturbation_scale, size=X.shape[1])
-                 
-                    perturbed_point = X[indices[i, j]] + perturbation
-                    X_perturbed.append(perturbed_point)
-        X_perturbed = np.array(X_perturbed)
-        return X_perturbed
+        indices = indices.reshape(-1)
+        # generate pertubation, a chunk of neighbours at a time
+        rows = max(1, MAX_CHUNK_BYTES // max(1, n_perturbations * X.shape[1] * X.itemsize))
+        for start in range(0, len(indices), rows):
+            neighbours = X[indices[start:start + rows]]
+            perturbation = np.random.normal(scale=perturbation_scale, size=(len(neighbours), n_perturbations, X.shape[1]))
+            X_perturbed = neighbours[:, None, :] + perturbation.astype(X.dtype, copy=False)
+            yield X_perturbed.reshape(-1, X.shape[1])
+
+    def _get_perturb_neibour(self,train_data,n_perturbations=10,perturbation_scale=0.04):
+        """:return: numpy.ndarray, (len(train_data) * n_neighbors * n_perturbations, dim), see _iter_perturb_neibour"""
+        return np.concatenate(list(self._iter_perturb_neibour(train_data, n_perturbations, perturbation_scale)), axis=0)
     
 
     def if_border(self,data):
@@ -351,21 +354,19 @@ class SingleEpochSpatialEdgeConstructor(SpatialEdgeConstructor):
         if self.b_n_epochs > 0:
             border_centers = self.data_provider.border_representation(self.iteration).squeeze()
             
-            complex, _, _, _ = self._construct_fuzzy_complex(train_data)
+            complex, _, _, _ = self._construct_fuzzy_complex(train_data, epoch=self.iteration)
             ## str1
             bw_complex, _, _, _ = self._construct_boundary_wise_complex(train_data, border_centers)
 
             edge_to, edge_from, weight = self._construct_step_edge_dataset(complex, bw_complex)
             feature_vectors = np.concatenate((train_data, border_centers ), axis=0)
-            pred_model = self.data_provider.prediction_function(self.iteration)
-            attention = get_attention(pred_model, feature_vectors, temperature=.01, device=self.data_provider.DEVICE, verbose=1)
+            attention = self.data_provider.get_attention(self.iteration, feature_vectors, temperature=.01, verbose=1)
             # attention = np.zeros(feature_vectors.shape)
         elif self.b_n_epochs == 0:
-            complex, _, _, _ = self._construct_fuzzy_complex(train_data)
+            complex, _, _, _ = self._construct_fuzzy_complex(train_data, epoch=self.iteration)
             edge_to, edge_from, weight = self._construct_step_edge_dataset(complex, None)
             feature_vectors = np.copy(train_data)
-            pred_model = self.data_provider.prediction_function(self.iteration)
-            attention = get_attention(pred_model, feature_vectors, temperature=.01, device=self.data_provider.DEVICE, verbose=1)            
+            attention = self.data_provider.get_attention(self.iteration, feature_vectors, temperature=.01, verbose=1)            
             # attention = np.zeros(feature_vectors.shape)
         else: 
             raise Exception("Illegal border edges proposion!")
@@ -386,6 +387,41 @@ class SingleEpochSpatialEdgeConstructor(SpatialEdgeConstructor):
 
 
 
+########################################################################################################################
+#                                                  EDGE SET MERGING                                                    #
+########################################################################################################################
+# edge sets are (edge_to, edge_from, weight) arrays, kept as sparse matrices with edge_from as row and edge_to as column,
+# so the edges of a complex come out in the same order as _construct_step_edge_dataset returns them
+
+def _edge_matrix(edge_to, edge_from, weight, n, mask=None):
+    if mask is not None:
+        edge_to, edge_from, weight = edge_to[mask], edge_from[mask], weight[mask]
+    return csr_matrix((weight, (edge_from, edge_to)), shape=(n, n))
+
+def _pattern(m):
+    p = m.copy()
+    p.data = np.ones_like(p.data)
+    return p
+
+def _matrix_edges(m):
+    m = m.tocoo()
+    return m.col.astype(np.int64), m.row.astype(np.int64), m.data
+
+def _weighted_union(m1, m2, alpha):
+    """edges of m1 or m2, weighted (1-alpha) * w1 + alpha * w2 where both have the edge"""
+    both1 = m1.multiply(_pattern(m2)).tocsr()
+    both2 = m2.multiply(_pattern(m1)).tocsr()
+    merged = (m1 - both1) + (m2 - both2) + ((1 - alpha) * both1 + alpha * both2)
+    merged.eliminate_zeros()
+    return merged
+
+def _overwrite(m1, m2):
+    """edges of m1 or m2, weighted as in m2 where both have the edge"""
+    merged = (m1 - m1.multiply(_pattern(m2)).tocsr()) + m2
+    merged.eliminate_zeros()
+    return merged
+
+
 class TrustvisSpatialEdgeConstructor(SpatialEdgeConstructor):
     def __init__(self, data_provider, iteration, s_n_epochs, b_n_epochs, n_neighbors, alpha=0.7, train_data=None, combine_border=False) -> None:
         super().__init__(data_provider, 100, s_n_epochs, b_n_epochs, n_neighbors)
@@ -421,7 +457,9 @@ class TrustvisSpatialEdgeConstructor(SpatialEdgeConstructor):
             train_data = self.data_provider.train_representation(self.iteration)
             train_data = train_data.reshape(train_data.shape[0],train_data.shape[1])
         # step 1
-        complex, _, _, _ = self._construct_fuzzy_complex(train_data)
+        # only the epoch's own train representation has a shared kNN graph
+        use_knn_cache = self.train_data is None or len(self.train_data) == 0
+        complex, _, _, _ = self._construct_fuzzy_complex(train_data, epoch=self.iteration if use_knn_cache else None)
         # step 2
         complex_pred, _, _, _ = self._construct_fuzzy_complex_pred_Diff(train_data,self.iteration)
 
@@ -431,7 +469,7 @@ class TrustvisSpatialEdgeConstructor(SpatialEdgeConstructor):
             border_centers = data_generator.get_boundary_sample()
             bw_complex, _, _, _ = self._construct_boundary_wise_complex(self.data_provider.get_pred(self.iteration, train_data), self.data_provider.get_pred(self.iteration, border_centers),1)
             feature_vectors = np.concatenate((train_data, border_centers),axis=0)
-            edge_to, edge_from, weight = self.merge_complexes(complex, complex_pred, bw_complex, feature_vectors,self.alpha)  
+            edge_to, edge_from, weight, b_edge_to, b_edge_from, b_weight = self.merge_complexes(complex, complex_pred, bw_complex, feature_vectors,self.alpha)  
         else:
             print("without border")
             feature_vectors = train_data
@@ -439,70 +477,45 @@ class TrustvisSpatialEdgeConstructor(SpatialEdgeConstructor):
             edge_to, edge_from, weight, b_edge_to, b_edge_from, b_weight = self.merge_complexes(complex, complex_pred, None, feature_vectors,self.alpha)  
         
         # feature_vectors = train_data
-        pred_model = self.data_provider.prediction_function(self.iteration)
-        attention = get_attention(pred_model, feature_vectors, temperature=.01, device=self.data_provider.DEVICE, verbose=1)            
+        attention = self.data_provider.get_attention(self.iteration, feature_vectors, temperature=.01, verbose=1)            
         # attention = np.zeros(feature_vectors.shape)
             
         return edge_to, edge_from, weight, feature_vectors, attention, b_edge_to, b_edge_from, b_weight
 
     def merge_complexes(self, complex1, complex2, bw_complex, train_data, alpha=0.7):
+        """
+        merge the complexes on the prediction of train_data
+            edges of complex1 between samples with different predictions become boundary edges,
+            the other edges of complex1 and complex2 are united, weighted (1-alpha) * w1 + alpha * w2 where both have the edge,
+            and edges of bw_complex with agreeing predictions are added, replacing the weight of existing ones
+        :return: edge_to, edge_from, weight, boundary_edge_to, boundary_edge_from, boundary_weight
+        """
+        t0 = time.time()
+        n = len(train_data)
         edge_to_1, edge_from_1, weight_1 = self._construct_step_edge_dataset(complex1, None)
-       
-        train_data_pred =  self.data_provider.get_pred(self.iteration, train_data).argmax(axis=1)
-
-        pred_edge_to_1 = train_data_pred[edge_to_1]
-        pred_edge_from_1 = train_data_pred[edge_from_1]
 
+        train_data_pred =  self.data_provider.get_pred(self.iteration, train_data).argmax(axis=1)
 
-        merged_edges = {}
-        merged_boundary_edges = {}
-
-        for i in range(len(edge_to_1)):
-            edge = (edge_to_1[i], edge_from_1[i])
-            if pred_edge_to_1[i] != pred_edge_from_1[i]:
-                merged_boundary_edges[edge] = weight_1[i]
-            else:
-                merged_edges[edge] = weight_1[i]
+        same_1 = train_data_pred[edge_to_1] == train_data_pred[edge_from_1]
+        merged = _edge_matrix(edge_to_1, edge_from_1, weight_1, n, same_1)
+        boundary = _edge_matrix(edge_to_1, edge_from_1, weight_1, n, ~same_1)
         # merge the second edge and weight
         if complex2 != None:
             edge_to_2, edge_from_2, weight_2 = self._construct_step_edge_dataset(complex2, None)
-            pred_edge_to_2 = train_data_pred[edge_to_2]
-            pred_edge_from_2 = train_data_pred[edge_from_2]
-            for i in range(len(edge_to_2)):
-                edge = (edge_to_2[i], edge_from_2[i])
-                if pred_edge_to_2[i] != pred_edge_from_2[i]:
-                    continue
-                    # if edge in merged_boundary_edges:
-                    # # if this edge is already in boundary edges
-                    #     merged_boundary_edges[edge] = max(merged_boundary_edges[edge], weight_2[i])
-                    # else:
-                    #     merged_boundary_edges[edge] = weight_2[i]
-               
-                elif edge in merged_edges:
-                    merged_edges[edge] = (1-alpha) * merged_edges[edge] + alpha * weight_2[i]
-                else:
-                    merged_edges[edge] = weight_2[i]
-
+            same_2 = train_data_pred[edge_to_2] == train_data_pred[edge_from_2]
+            merged = _weighted_union(merged, _edge_matrix(edge_to_2, edge_from_2, weight_2, n, same_2), alpha)
 
         if bw_complex != None:
             edge_to_bw, edge_from_bw, weight_bw = self._construct_step_edge_dataset(bw_complex, None)
-            pred_edge_to_bw = train_data_pred[edge_to_bw]
-            pred_edge_from_bw = train_data_pred[edge_from_bw]
-            for i in range(len(edge_to_bw)):
-                    if pred_edge_to_bw[i] != pred_edge_from_bw[i]:
-                        continue  # Skip this edge if predictions do not agree
-                    else:
-                        edge = (edge_to_bw[i], edge_from_bw[i])
-                        merged_edges[edge] = weight_bw[i]
+            same_bw = train_data_pred[edge_to_bw] == train_data_pred[edge_from_bw]
+            merged = _overwrite(merged, _edge_matrix(edge_to_bw, edge_from_bw, weight_bw, n, same_bw))
 
-        merged_edge_to, merged_edge_from, merged_weight = zip(*[
-            (edge[0], edge[1], wgt) for edge, wgt in merged_edges.items()
-        ])
+        merged_edge_to, merged_edge_from, merged_weight = _matrix_edges(merged)
+        merged_boundary_edge_to, merged_boundary_edge_from, merged_boundary_weight = _matrix_edges(boundary)
+        self.merge_time = time.time() - t0
+        print("merge complexes: {:.3f}s".format(self.merge_time))
 
-        merged_boundary_edge_to, merged_boundary_edge_from, merged_boundary_weight = zip(*[
-        (edge[0], edge[1], wgt) for edge, wgt in merged_boundary_edges.items()])
-
-        return np.array(merged_edge_to), np.array(merged_edge_from), np.array(merged_weight),np.array(merged_boundary_edge_to), np.array(merged_boundary_edge_from), np.array(merged_boundary_weight)
+        return merged_edge_to, merged_edge_from, merged_weight, merged_boundary_edge_to, merged_boundary_edge_from, merged_boundary_weight
 
     def record_time(self, save_dir, file_name, operation, t):
         file_path = os.path.join(save_dir, file_name+".json")
@@ -541,79 +554,28 @@ class TrustALSpatialEdgeConstructor(SpatialEdgeConstructor):
         # step 3
        
         feature_vectors = train_data
-        pred_model = self.data_provider.prediction_function(self.iteration)
-        attention = get_attention(pred_model, feature_vectors, temperature=.01, device=self.data_provider.DEVICE, verbose=1)            
+        attention = self.data_provider.get_attention(self.iteration, feature_vectors, temperature=.01, verbose=1)            
         # attention = np.zeros(feature_vectors.shape)
             
         return edge_to, edge_from, weight, feature_vectors, attention
 
     def merge_complexes(self, complex1, complex2,train_data,alpha=0.7):
+        """edges of both complexes between samples with the same prediction, weighted (1-alpha) * w1 + alpha * w2 where both have the edge"""
+        t0 = time.time()
+        n = len(train_data)
         edge_to_1, edge_from_1, weight_1 = self._construct_step_edge_dataset(complex1, None)
         edge_to_2, edge_from_2, weight_2 = self._construct_step_edge_dataset(complex2, None)
 
         train_data_pred =  self.data_provider.get_pred(self.iteration, train_data).argmax(axis=1)
 
-        pred_edge_to_1 = train_data_pred[edge_to_1]
-        pred_edge_from_1 = train_data_pred[edge_from_1]
-        pred_edge_to_2 = train_data_pred[edge_to_2]
-        pred_edge_from_2 = train_data_pred[edge_from_2]
-
-        # # Vectorized equality check
-        # valid_edges_1 = pred_edge_to_1 == pred_edge_from_1
-        # valid_edges_2 = pred_edge_to_2 == pred_edge_from_2
-
-        # # Filter the edges and weights based on validity
-        # valid_edge_to_1, valid_edge_from_1, valid_weight_1 = edge_to_1[valid_edges_1], edge_from_1[valid_edges_1], weight_1[valid_edges_1]
-        # valid_edge_to_2, valid_edge_from_2, valid_weight_2 = edge_to_2[valid_edges_2], edge_from_2[valid_edges_2], weight_2[valid_edges_2]
-
-        # # Combine edges into a single array for easier processing
-        # combined_edges_1 = np.vstack((valid_edge_to_1, valid_edge_from_1)).T
-        # combined_edges_2 = np.vstack((valid_edge_to_2, valid_edge_from_2)).T
-
-        #  # Use a dictionary for merging
-        # merged_edges = {}
-        # for edge, weight in zip(combined_edges_1, valid_weight_1):
-        #     edge_tuple = tuple(edge)
-        #     merged_edges[edge_tuple] = weight
-
-        # for edge, weight in zip(combined_edges_2, valid_weight_2):
-        #     edge_tuple = tuple(edge)
-        #     if edge_tuple in merged_edges:
-        #         merged_edges[edge_tuple] = (1 - alpha) * merged_edges[edge_tuple] + alpha * weight
-        #     else:
-        #         merged_edges[edge_tuple] = weight
-
-        # # Unpack the merged edges
-        # merged_edge_to, merged_edge_from, merged_weight = zip(*[
-        #     (edge[0], edge[1], wgt) for edge, wgt in merged_edges.items()
-        # ])
-
-
+        same_1 = train_data_pred[edge_to_1] == train_data_pred[edge_from_1]
+        same_2 = train_data_pred[edge_to_2] == train_data_pred[edge_from_2]
+        merged = _weighted_union(_edge_matrix(edge_to_1, edge_from_1, weight_1, n, same_1),
+                                 _edge_matrix(edge_to_2, edge_from_2, weight_2, n, same_2), alpha)
+        self.merge_time = time.time() - t0
+        print("merge complexes: {:.3f}s".format(self.merge_time))
 
-        merged_edges = {}
-
-        for i in range(len(edge_to_1)):
-            if pred_edge_to_1[i] != pred_edge_from_1[i]:
-                continue  # Skip this edge if pred_edge_to_1 is not equal to pred_edge_from_1
-            edge = (edge_to_1[i], edge_from_1[i])
-            merged_edges[edge] = weight_1[i]
-        # merge the second edge and weight
-        for i in range(len(edge_to_2)):
-            if pred_edge_to_2[i] != pred_edge_from_2[i]:
-                continue  # Skip this edge if predictions do not agree
-            edge = (edge_to_2[i], edge_from_2[i])
-            if edge in merged_edges:
-                # if we already have the edge strong connection
-                merged_edges[edge] = (1-alpha) * merged_edges[edge] + alpha * weight_2[i] 
-            else:
-                # if we do not have the edge add it to 
-                merged_edges[edge] = weight_2[i]
-
-        merged_edge_to, merged_edge_from, merged_weight = zip(*[
-            (edge[0], edge[1], wgt) for edge, wgt in merged_edges.items()
-        ])
-
-        return np.array(merged_edge_to), np.array(merged_edge_from), np.array(merged_weight)
+        return _matrix_edges(merged)
 
     def record_time(self, save_dir, file_name, operation, t):
         file_path = os.path.join(save_dir, file_name+".json")
@@ -657,42 +619,27 @@ class TrustvisProxyEdgeConstructor(SpatialEdgeConstructor):
         weight = np.concatenate((p_weight, weight), axis=0)
 
         feature_vectors = np.concatenate((self.proxy, train_data ), axis=0)
-        pred_model = self.data_provider.prediction_function(self.iteration)
-        attention = get_attention(pred_model, feature_vectors, temperature=.01, device=self.data_provider.DEVICE, verbose=1)
+        attention = self.data_provider.get_attention(self.iteration, feature_vectors, temperature=.01, verbose=1)
         # attention = np.zeros(feature_vectors.shape)
             
         return edge_to, edge_from, weight, feature_vectors, attention
 
     def merge_complexes(self, complex1, complex2, train_data,alpha=0.7):
-        
+        """edges of complex1 between samples with the same prediction united with all edges of complex2, weighted (1-alpha) * w1 + alpha * w2 where both have the edge"""
+        t0 = time.time()
+        n = len(train_data)
         edge_to_1, edge_from_1, weight_1 = self._construct_step_edge_dataset(complex1, None)
         edge_to_2, edge_from_2, weight_2 = self._construct_step_edge_dataset(complex2, None)
 
-        pred_edge_to_1 = self.data_provider.get_pred(self.iteration, train_data[edge_to_1]).argmax(axis=1)
-        pred_edge_from_1 = self.data_provider.get_pred(self.iteration, train_data[edge_from_1]).argmax(axis=1)
-
-        merged_edges = {}
+        # one prediction per sample instead of one per edge end
+        train_data_pred = self.data_provider.get_pred(self.iteration, train_data).argmax(axis=1)
+        same_1 = train_data_pred[edge_to_1] == train_data_pred[edge_from_1]
+        merged = _weighted_union(_edge_matrix(edge_to_1, edge_from_1, weight_1, n, same_1),
+                                 _edge_matrix(edge_to_2, edge_from_2, weight_2, n), alpha)
+        self.merge_time = time.time() - t0
+        print("merge complexes: {:.3f}s".format(self.merge_time))
 
-        for i in range(len(edge_to_1)):
-            if pred_edge_to_1[i] != pred_edge_from_1[i]:
-                continue  # Skip this edge if pred_edge_to_1 is not equal to pred_edge_from_1
-            edge = (edge_to_1[i], edge_from_1[i])
-            merged_edges[edge] = weight_1[i]
-        # merge the second edge and weight
-        for i in range(len(edge_to_2)):
-            edge = (edge_to_2[i], edge_from_2[i])
-            if edge in merged_edges:
-                # if we already have the edge strong connection
-                merged_edges[edge] = (1-alpha) * merged_edges[edge] + alpha * weight_2[i] 
-            else:
-                # if we do not have the edge add it to 
-                merged_edges[edge] = weight_2[i]
-
-        merged_edge_to, merged_edge_from, merged_weight = zip(*[
-            (edge[0], edge[1], wgt) for edge, wgt in merged_edges.items()
-        ])
-
-        return np.array(merged_edge_to), np.array(merged_edge_from), np.array(merged_weight)
+        return _matrix_edges(merged)
 
     def record_time(self, save_dir, file_name, operation, t):
         file_path = os.path.join(save_dir, file_name+".json")
@@ -736,8 +683,7 @@ class ErrorALEdgeConstructor(SpatialEdgeConstructor):
 
         edge_to, edge_from, weight = self._construct_step_edge_dataset(complex, err_complex)
         feature_vectors = np.concatenate((train_data, error_data), axis=0)
-        pred_model = self.data_provider.prediction_function(self.iteration)
-        attention = get_attention(pred_model, feature_vectors, temperature=.01, device=self.data_provider.DEVICE, verbose=1)          
+        attention = self.data_provider.get_attention(self.iteration, feature_vectors, temperature=.01, verbose=1)          
         return edge_to, edge_from, weight, feature_vectors, attention
 
 class PROXYEpochSpatialEdgeConstructor(SpatialEdgeConstructor):
@@ -768,15 +714,13 @@ class PROXYEpochSpatialEdgeConstructor(SpatialEdgeConstructor):
 
             edge_to, edge_from, weight = self._construct_step_edge_dataset(complex, bw_complex)
             feature_vectors = np.concatenate((train_data, border_centers ), axis=0)
-            pred_model = self.data_provider.prediction_function(self.iteration)
-            attention = get_attention(pred_model, feature_vectors, temperature=.01, device=self.data_provider.DEVICE, verbose=1)
+            attention = self.data_provider.get_attention(self.iteration, feature_vectors, temperature=.01, verbose=1)
             # attention = np.zeros(feature_vectors.shape)
         elif self.b_n_epochs == 0:
             complex, _, _, _ = self._construct_fuzzy_complex(train_data)
             edge_to, edge_from, weight = self._construct_step_edge_dataset(complex, None)
             feature_vectors = np.copy(train_data)
-            pred_model = self.data_provider.prediction_function(self.iteration)
-            attention = get_attention(pred_model, feature_vectors, temperature=.01, device=self.data_provider.DEVICE, verbose=1)            
+            attention = self.data_provider.get_attention(self.iteration, feature_vectors, temperature=.01, verbose=1)            
             # attention = np.zeros(feature_vectors.shape)
         else: 
             raise Exception("Illegal border edges proposion!")
@@ -915,8 +859,7 @@ class kcHybridSpatialEdgeConstructor(SpatialEdgeConstructor):
                 sigmas_t = np.concatenate((sigmas_t1, sigmas_t2[len(sigmas_t1):]), axis=0)
                 rhos_t = np.concatenate((rhos_t1, rhos_t2[len(rhos_t1):]), axis=0)
                 fitting_data = np.concatenate((train_data, border_centers), axis=0)
-                pred_model = self.data_provider.prediction_function(t)
-                attention_t = get_attention(pred_model, fitting_data, temperature=.01, device=self.data_provider.DEVICE, verbose=1)
+                attention_t = self.data_provider.get_attention(t, fitting_data, temperature=.01, verbose=1)
             else:
                 t_num = len(selected_idxs)
                 b_num = 0
@@ -924,8 +867,7 @@ class kcHybridSpatialEdgeConstructor(SpatialEdgeConstructor):
                 complex, sigmas_t, rhos_t, knn_idxs_t = self._construct_fuzzy_complex(train_data)
                 edge_to_t, edge_from_t, weight_t = self._construct_step_edge_dataset(complex, None)
                 fitting_data = np.copy(train_data)
-                pred_model = self.data_provider.prediction_function(t)
-                attention_t = get_attention(pred_model, fitting_data, temperature=.01, device=self.data_provider.DEVICE, verbose=1)
+                attention_t = self.data_provider.get_attention(t, fitting_data, temperature=.01, verbose=1)
             
             if edge_to is None:
                 edge_to = edge_to_t
@@ -1089,7 +1031,7 @@ class kcHybridDenseALSpatialEdgeConstructor(SpatialEdgeConstructor):
                 sigmas_t = np.concatenate((sigmas_t1, sigmas_t2[len(sigmas_t1):]), axis=0)
                 rhos_t = np.concatenate((rhos_t1, rhos_t2[len(rhos_t1):]), axis=0)
                 fitting_data = np.concatenate((train_data, border_centers), axis=0)
-                pred_model = self.data_provider.prediction_function(t)
+                pred_model = self.data_provider.prediction_function(self.iteration,t)
                 attention_t = get_attention(pred_model, fitting_data, temperature=.01, device=self.data_provider.DEVICE, verbose=1)
             else:
                 t_num = len(selected_idxs)
@@ -1188,10 +1130,10 @@ class tfEdgeConstructor(SpatialEdgeConstructor):
             prev_data = self.data_provider.train_representation(prev_iteration)
         else:
             prev_data = None
-        n_rate = find_neighbor_preserving_rate(prev_data, train_data, self.n_neighbors)
+        n_rate = epoch_neighbor_preserving_rate(self.data_provider, prev_iteration, iteration, prev_data, train_data, self.n_neighbors)
         if self.b_n_epochs > 0:
             border_centers = self.data_provider.border_representation(iteration).squeeze()
-            complex, _, _, _ = self._construct_fuzzy_complex(train_data)
+            complex, _, _, _ = self._construct_fuzzy_complex(train_data, epoch=iteration)
             bw_complex, _, _, _ = self._construct_boundary_wise_complex(train_data, border_centers)
             edges_to_exp, edges_from_exp, weights_exp = self._construct_step_edge_dataset(complex, bw_complex)
             feature_vectors = np.concatenate((train_data, border_centers), axis=0)
@@ -1200,7 +1142,7 @@ class tfEdgeConstructor(SpatialEdgeConstructor):
             attention = np.zeros(feature_vectors.shape)
 
         elif self.b_n_epochs == 0:
-            complex, _, _, _ = self._construct_fuzzy_complex(train_data)
+            complex, _, _, _ = self._construct_fuzzy_complex(train_data, epoch=iteration)
             edges_to_exp, edges_from_exp, weights_exp = self._construct_step_edge_dataset(complex, None)
             feature_vectors = np.copy(train_data)
             # pred_model = self.data_provider.prediction_function(self.iteration)
@@ -1225,7 +1167,7 @@ class OriginSingleEpochSpatialEdgeConstructor(SpatialEdgeConstructor):
         if self.b_n_epochs > 0:
       
             border_centers = self.data_provider.border_representation(self.iteration).squeeze()
-            complex, _, _, _ = self._construct_fuzzy_complex(train_data)
+            complex, _, _, _ = self._construct_fuzzy_complex(train_data, epoch=self.iteration)
             bw_complex, _, _, _ = self._construct_boundary_wise_complex(train_data, border_centers)
             edge_to, edge_from, weight = self._construct_step_edge_dataset(complex, bw_complex)
             feature_vectors = np.concatenate((train_data, border_centers), axis=0)
@@ -1233,7 +1175,7 @@ class OriginSingleEpochSpatialEdgeConstructor(SpatialEdgeConstructor):
             # attention = get_attention(pred_model, feature_vectors, temperature=.01, device=self.data_provider.DEVICE, verbose=1)
             attention = np.zeros(feature_vectors.shape)
         elif self.b_n_epochs == 0:
-            complex, _, _, _ = self._construct_fuzzy_complex(train_data)
+            complex, _, _, _ = self._construct_fuzzy_complex(train_data, epoch=self.iteration)
             edge_to, edge_from, weight = self._construct_step_edge_dataset(complex, None)
             feature_vectors = np.copy(train_data)
             # pred_model = self.data_provider.prediction_function(self.iteration)
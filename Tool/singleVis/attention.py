@@ -0,0 +1,103 @@
+"""Batched gradient attention of the subject model, with an on-disk cache per epoch"""
+import os
+import time
+import zlib
+
+import numpy as np
+import torch
+from scipy.special import softmax
+
+from singleVis.knn_cache import KnnCache
+
+
+def input_gradients(model, data, device, batch_size=1000, verbose=1):
+    """
+    |d top1 / dx| + |d top2 / dx| for every row of data, top1/top2 being the largest and second largest logit
+
+    Rows of a mini-batch are independent in an eval-mode model, so the gradient of the sum of the selected
+    logits w.r.t. the batch gives every row its own gradient, one forward and two backward passes per batch.
+    :param model: callable, prediction function mapping (n, dim) representations to logits
+    :param data: numpy.ndarray, (n, dim)
+    :param batch_size: int, rows per pass
+    :return: numpy.ndarray, float32 (n, dim)
+    """
+    grad = np.empty(data.shape, dtype=np.float32)
+    n_batches = (len(data) + batch_size - 1) // batch_size
+    for i, start in enumerate(range(0, len(data), batch_size)):
+        b = torch.from_numpy(np.ascontiguousarray(data[start:start + batch_size])).to(device=device, dtype=torch.float)
+        b.requires_grad = True
+        out = model(b)
+        # argsort as the per-sample version did, ties resolve the same way
+        order = torch.argsort(out, dim=1)
+        top1 = out.gather(1, order[:, -1:]).sum()
+        top2 = out.gather(1, order[:, -2:-1]).sum()
+        grad1, = torch.autograd.grad(top1, b, retain_graph=True)
+        grad2, = torch.autograd.grad(top2, b)
+        grad[start:start + len(b)] = (grad1.abs() + grad2.abs()).detach().cpu().numpy()
+        if verbose > 1:
+            print("Gradients: batch {:d}/{:d}".format(i + 1, n_batches))
+    return grad
+
+
+def _cache_file(cache_dir, data):
+    fingerprint = KnnCache.fingerprint(np.asarray(data))
+    return os.path.join(cache_dir, "{:08x}.npz".format(zlib.crc32(fingerprint.encode("utf-8")))), fingerprint
+
+
+def _prune_cache(cache_dir, keep, version, max_entries):
+    """remove the entries of cache_dir computed with a model older than version, then all but the newest max_entries"""
+    entries = list()
+    for f in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, f)
+        if not f.endswith(".npz") or f.endswith(".tmp.npz") or path == keep:
+            continue
+        try:
+            with np.load(path) as cached:
+                stale = float(cached["version"]) < version
+            if stale:
+                os.remove(path)
+            else:
+                entries.append((os.path.getmtime(path), path))
+        except (OSError, ValueError, KeyError):
+            continue
+    entries.sort(reverse=True)
+    for _, path in entries[max(0, max_entries - 1):]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def cached_input_gradients(model, data, device, cache_dir=None, version=0., batch_size=1000, max_entries=8, verbose=1):
+    """
+    input_gradients, read from cache_dir when the same data was seen with a model at least as new as version
+    :param cache_dir: str or None, e.g. Epoch_N/attention, no caching if None
+    :param version: float, mtime of the model checkpoint
+    :param max_entries: int, entries kept in cache_dir, older ones and those of older checkpoints are removed on write
+    """
+    if cache_dir is None:
+        return input_gradients(model, data, device, batch_size=batch_size, verbose=verbose)
+    path, fingerprint = _cache_file(cache_dir, data)
+    if os.path.exists(path):
+        with np.load(path) as f:
+            if str(f["fingerprint"]) == fingerprint and float(f["version"]) >= version:
+                return f["grad"]
+    grad = input_gradients(model, data, device, batch_size=batch_size, verbose=verbose)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, grad=grad, fingerprint=np.array(fingerprint), version=np.array(version))
+    os.replace(tmp_path, path)
+    _prune_cache(cache_dir, path, version, max_entries)
+    return grad
+
+
+def attention(model, data, device, temperature=.01, batch_size=1000, cache_dir=None, version=0., verbose=1):
+    """softmax(gradient / temperature) over the feature axis, see input_gradients"""
+    t0 = time.time()
+    grad = cached_input_gradients(model, data, device, cache_dir=cache_dir, version=version, batch_size=batch_size, verbose=verbose)
+    t1 = time.time()
+    grad = softmax(grad / temperature, axis=1)
+    t2 = time.time()
+    if verbose:
+        print("Gradients calculation: {:.2f} seconds\tsoftmax with temperature: {:.2f} seconds".format(round(t1-t0), round(t2-t1)))
+    return grad
@@ -9,6 +9,9 @@ import tensorflow as tf
 from scipy.special import softmax
 from pynndescent import NNDescent
 
+from singleVis.attention import attention
+from singleVis.knn_cache import KnnCache, knn_overlap
+
 
 def get_graph_elements(graph_, n_epochs):
     """
@@ -118,79 +121,30 @@ def compute_cross_entropy_tf(
     return attraction_term, repellent_term, CE
 
 
-def find_neighbor_preserving_rate(prev_data, train_data, n_neighbors):
+def find_neighbor_preserving_rate(prev_data, train_data, n_neighbors, prev_indices=None, train_indices=None):
     """
     neighbor preserving rate, (0, 1)
     :param prev_data: ndarray, shape(N,2) low dimensional embedding from last epoch
     :param train_data: ndarray, shape(N,2) low dimensional embedding from current epoch
     :param n_neighbors:
+    :param prev_indices: ndarray or None, precomputed kNN indices of prev_data, e.g. from KnnCache
+    :param train_indices: ndarray or None, precomputed kNN indices of train_data
     :return alpha: ndarray, shape (N,)
     """
     if prev_data is None:
         return np.zeros(len(train_data))
-    # number of trees in random projection forest
-    n_trees = min(64, 5 + int(round((train_data.shape[0]) ** 0.5 / 20.0)))
-    # max number of nearest neighbor iters to perform
-    n_iters = max(5, int(round(np.log2(train_data.shape[0]))))
-    # distance metric
-    metric = "euclidean"
-
-    # get nearest neighbors
-    nnd = NNDescent(
-        train_data,
-        n_neighbors=n_neighbors,
-        metric=metric,
-        n_trees=n_trees,
-        n_iters=n_iters,
-        max_candidates=60,
-        verbose=False
-    )
-    train_indices, _ = nnd.neighbor_graph
-    prev_nnd = NNDescent(
-        prev_data,
-        n_neighbors=n_neighbors,
-        metric="euclidean",
-        n_trees=n_trees,
-        n_iters=n_iters,
-        max_candidates=60,
-        verbose=False
-    )
-    prev_indices, _ = prev_nnd.neighbor_graph
-    temporal_pres = np.zeros(len(train_data))
-    for i in range(len(train_indices)):
-        pres = np.intersect1d(train_indices[i], prev_indices[i])
-        temporal_pres[i] = len(pres) / float(n_neighbors)
-    return temporal_pres
-
-
-def get_attention(model, data, device, temperature=.01, verbose=1):
-    t0 = time.time()
-    grad_list = []
-
-    for i in range(len(data)):
-        b = torch.from_numpy(data[i:i + 1]).to(device=device, dtype=torch.float)
-        b.requires_grad = True
-        out = model(b)
-        top1 = torch.argsort(out)[0][-1]
-        out[0][top1].backward()
-        grad_list.append(b.grad.data.detach().cpu().numpy())
-    grad_list2 = []
-
-    for i in range(len(data)):
-        b = torch.from_numpy(data[i:i + 1]).to(device=device, dtype=torch.float)
-        b.requires_grad = True
-        out = model(b)
-        top2 = torch.argsort(out)[0][-2]
-        out[0][top2].backward()
-        grad_list2.append(b.grad.data.detach().cpu().numpy())
-    t1 = time.time()
-    grad1 = np.array(grad_list)
-    grad2 = np.array(grad_list2)
-    grad1 = grad1.squeeze(axis=1)
-    grad2 = grad2.squeeze(axis=1)
-    grad = np.abs(grad1) + np.abs(grad2)
-    grad = softmax(grad/temperature, axis=1)
-    t2 = time.time()
-    if verbose:
-        print("Gradients calculation: {:.2f} seconds\tsoftmax with temperature: {:.2f} seconds".format(round(t1-t0), round(t2-t1)))
-    return grad
+    if train_indices is None:
+        train_indices, _ = KnnCache.build(train_data, n_neighbors)
+    if prev_indices is None:
+        prev_indices, _ = KnnCache.build(prev_data, n_neighbors)
+    return knn_overlap(train_indices[:, :n_neighbors], prev_indices[:, :n_neighbors]) / float(n_neighbors)
+
+
+def get_attention(model, data, device, temperature=.01, verbose=1, batch_size=1000, cache_dir=None, version=0.):
+    """
+    gradient attention of data, see singleVis.attention
+    :param batch_size: int, samples per forward/backward pass
+    :param cache_dir: str or None, directory to keep the gradients in, e.g. Epoch_N/attention
+    :param version: float, mtime of the model checkpoint, cached gradients of older models are recomputed
+    """
+    return attention(model, data, device, temperature=temperature, batch_size=batch_size, cache_dir=cache_dir, version=version, verbose=verbose)
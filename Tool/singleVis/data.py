@@ -4,9 +4,17 @@ from abc import ABC, abstractmethod
 import os
 import gc
 import time
+import threading
+from collections import OrderedDict
 
 from singleVis.utils import *
 from singleVis.eval.evaluate import evaluate_inv_accu
+from singleVis.representation_store import RepresentationStore, take_rows
+from singleVis.epoch_store import EpochStore
+from singleVis.preprocess import PreprocessPipeline
+from singleVis.prediction_cache import PredictionCache
+from singleVis.knn_cache import KnnCache
+from singleVis.attention import attention
 
 """
 DataContainder module
@@ -47,7 +55,7 @@ class DataProviderAbstractClass(ABC):
         self.e = epoch_e
 
 class DataProvider(DataProviderAbstractClass):
-    def __init__(self, content_path, model, epoch_start, epoch_end, epoch_period, device, classes, epoch_name, verbose=1):
+    def __init__(self, content_path, model, epoch_start, epoch_end, epoch_period, device, classes, epoch_name, verbose=1, checkpoint_cache_size=4):
         self.content_path = content_path
         self.model = model
         self.s = epoch_start
@@ -58,13 +66,24 @@ class DataProvider(DataProviderAbstractClass):
         self.verbose = verbose
         self.epoch_name = epoch_name
         self.model_path = os.path.join(self.content_path, "Model")
+        # memory-mapped representations and cached index files
+        self.store = RepresentationStore()
+        self._max_norms = dict()
+        # subject model checkpoints, the weights in self.model belong to self._loaded_checkpoint
+        self.checkpoint_cache_size = checkpoint_cache_size
+        self._checkpoints = OrderedDict()
+        self._loaded_checkpoint = None
+        self.model_lock = threading.RLock()
+        # per-epoch predictions of all samples, persisted next to the checkpoint
+        self.predictions = PredictionCache(self)
+        # kNN graphs of representations, shared by edge constructors and evaluators
+        self.knn = KnnCache(self)
         if verbose:
             print("Finish initialization...")
 
     @property
     def train_num(self):
-        with open(os.path.join(self.content_path, "Model", "{}_{}".format(self.epoch_name, self.s), "index.json"), "r") as f:
-            idxs = json.load(f)
+        idxs = self.store.load_index(os.path.join(self.content_path, "Model", "{}_{}".format(self.epoch_name, self.s), "index.json"))
         return len(idxs)
 
     @property
@@ -83,62 +102,109 @@ class DataProvider(DataProviderAbstractClass):
     def _estimate_boundary(self):
         raise NotImplementedError
 
+    def load_subject_model(self, model_location):
+        """
+        load subject_model.pth into self.model, skipping disk I/O when it is already loaded or cached
+        :param model_location: str, location of subject_model.pth
+        """
+        key = (model_location, os.path.getmtime(model_location))
+        with self.model_lock:
+            if self._loaded_checkpoint != key:
+                state_dict = self._checkpoints.get(key)
+                if state_dict is None:
+                    state_dict = torch.load(model_location, map_location=torch.device("cpu"))
+                    if self.checkpoint_cache_size > 0:
+                        self._checkpoints[key] = state_dict
+                        while len(self._checkpoints) > self.checkpoint_cache_size:
+                            self._checkpoints.popitem(last=False)
+                else:
+                    self._checkpoints.move_to_end(key)
+                self.model.load_state_dict(state_dict)
+                self.model = self.model.to(self.DEVICE)
+                self._loaded_checkpoint = key
+            self.model.eval()
+
+    def _prediction_data(self, epoch):
+        """train and test representations of epoch, in the row order of epoch_predictions"""
+        raise NotImplementedError
+
+    def epoch_predictions(self, epoch):
+        """
+        cached predictions of all train and test samples of epoch, computed with the subject model on first use
+        :param epoch: int
+        :return: dict with logits, pred, confidence, topk_idx, topk_val, see PredictionCache
+        """
+        return self.predictions.get(epoch)
+
+    def get_attention(self, epoch, data, temperature=.01, verbose=1):
+        """
+        gradient attention of data under the subject model of epoch, the gradients are kept in Epoch_N/attention/
+        so that training the visualization model again reuses them
+        """
+        model_location = os.path.join(self.checkpoint_path(epoch), "subject_model.pth")
+        with self.model_lock:
+            pred_model = self.prediction_function(epoch)
+            return attention(pred_model, data, self.DEVICE, temperature=temperature, verbose=verbose,
+                             cache_dir=os.path.join(self.checkpoint_path(epoch), "attention"), version=os.path.getmtime(model_location))
+
+    def prefetch_subject_model(self, model_location):
+        """
+        read subject_model.pth into the checkpoint cache without touching self.model,
+        so it can run in a background thread while the current checkpoint is in use
+        """
+        key = (model_location, os.path.getmtime(model_location))
+        with self.model_lock:
+            if key in self._checkpoints or self.checkpoint_cache_size < 2:
+                return
+        state_dict = torch.load(model_location, map_location=torch.device("cpu"))
+        with self.model_lock:
+            self._checkpoints[key] = state_dict
+            while len(self._checkpoints) > self.checkpoint_cache_size:
+                self._checkpoints.popitem(last=False)
+
 
 class NormalDataProvider(DataProvider):
-    def __init__(self, content_path, model, epoch_start, epoch_end, epoch_period, device, classes, epoch_name, verbose=1):
-        super().__init__(content_path, model, epoch_start, epoch_end, epoch_period, device, classes, epoch_name, verbose)
+    def __init__(self, content_path, model, epoch_start, epoch_end, epoch_period, device, classes, epoch_name, verbose=1, consolidate=False, consolidate_dtype="float32", checkpoint_cache_size=4):
+        super().__init__(content_path, model, epoch_start, epoch_end, epoch_period, device, classes, epoch_name, verbose, checkpoint_cache_size)
         self.mode = "normal"
+        # optional [epoch, sample, dim] stores (VISUALIZATION.CONSOLIDATE), read transparently whenever they are up to date
+        self.consolidate = consolidate
+        self.consolidate_dtype = consolidate_dtype
+        self.train_store = EpochStore(self.model_path, "train", self.store)
+        self.test_store = EpochStore(self.model_path, "test", self.store)
     
     @property
     def representation_dim(self):
         train_data_loc = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, self.s), "train_data.npy")
         try:
-            train_data = np.load(train_data_loc)
+            train_data = self.store.load(train_data_loc)
             repr_dim = np.prod(train_data.shape[1:])
             return repr_dim
         except Exception as e:
             return None
 
-    def _meta_data(self):
-        time_inference = list()
+    def _load_training_data(self):
         training_data_path = os.path.join(self.content_path, "Training_data")
         training_data = torch.load(os.path.join(training_data_path, "training_dataset_data.pth"),
                                         map_location="cpu")
-        training_data = training_data.to(self.DEVICE)
+        return training_data.to(self.DEVICE)
+
+    def _load_testing_data(self):
         testing_data_path = os.path.join(self.content_path, "Testing_data")
         testing_data = torch.load(os.path.join(testing_data_path, "testing_dataset_data.pth"),
                                        map_location="cpu")
-        testing_data = testing_data.to(self.DEVICE)
+        return testing_data.to(self.DEVICE)
+
+    def _meta_data(self):
+        time_inference = list()
+        training_data = self._load_training_data()
+        testing_data = self._load_testing_data()
 
         for n_epoch in range(self.s, self.e + 1, self.p):
             t_s = time.time()
-
-            # make it possible to choose a subset of testing data for testing
-            test_index_file = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, n_epoch), "test_index.json")
-            if os.path.exists(test_index_file):
-                test_index = load_labelled_data_index(test_index_file)
-            else:
-                test_index = range(len(testing_data))
-            testing_data = testing_data[test_index]
-
-            model_location = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, n_epoch), "subject_model.pth")
-            self.model.load_state_dict(torch.load(model_location, map_location=torch.device("cpu")))
-            self.model = self.model.to(self.DEVICE)
-            self.model.eval()
-
-            repr_model = self.feature_function(n_epoch)
-            # repr_model = torch.nn.Sequential(*(list(self.model.children())[:self.split]))
-
-            # training data clustering
-            data_pool_representation = batch_run(repr_model, training_data)
-            location = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, n_epoch), "train_data.npy")
-            np.save(location, data_pool_representation)
-
-            # test data
-            test_data_representation = batch_run(repr_model, testing_data)
-            location = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, n_epoch), "test_data.npy")
-            np.save(location, test_data_representation)
-
+            self._meta_data_epoch(n_epoch, training_data, testing_data)
+            if self.consolidate:
+                self._consolidate_epoch(n_epoch)
             t_e = time.time()
             time_inference.append(t_e-t_s)
             if self.verbose > 0:
@@ -147,21 +213,55 @@ class NormalDataProvider(DataProvider):
             "Average time for inferencing data: {:.4f}".format(sum(time_inference) / len(time_inference)))
 
         # save result
-        save_dir = os.path.join(self.model_path, "time.json")
-        if not os.path.exists(save_dir):
-            evaluation = dict()
-        else:
-            f = open(save_dir, "r")
-            evaluation = json.load(f)
-            f.close()
-        evaluation["data_inference"] = round(sum(time_inference) / len(time_inference), 3)
-        with open(save_dir, 'w') as f:
-            json.dump(evaluation, f)
+        self.record_time({"data_inference": round(sum(time_inference) / len(time_inference), 3)})
 
+        self.train_store.close()
+        self.test_store.close()
         del training_data
         del testing_data
         gc.collect()
 
+    def _meta_data_epoch(self, n_epoch, training_data, testing_data):
+        """
+        save train/test representations of one epoch
+        :return: dict, time spent in each stage
+        """
+        t0 = time.time()
+        # make it possible to choose a subset of testing data for testing
+        test_index_file = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, n_epoch), "test_index.json")
+        if os.path.exists(test_index_file):
+            test_index = load_labelled_data_index(test_index_file)
+            testing_data = testing_data[test_index]
+
+        model_location = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, n_epoch), "subject_model.pth")
+        self.load_subject_model(model_location)
+        repr_model = self.feature_function(n_epoch)
+        # repr_model = torch.nn.Sequential(*(list(self.model.children())[:self.split]))
+        t1 = time.time()
+
+        # training data clustering
+        data_pool_representation = batch_run(repr_model, training_data)
+        location = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, n_epoch), "train_data.npy")
+        self.store.save(location, data_pool_representation)
+
+        # test data
+        test_data_representation = batch_run(repr_model, testing_data)
+        location = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, n_epoch), "test_data.npy")
+        self.store.save(location, test_data_representation)
+        t2 = time.time()
+        return {"load_checkpoint": t1 - t0, "inference": t2 - t1}
+
+    def _consolidate_epoch(self, n_epoch):
+        # copy the saved representations of an epoch into the consolidated stores
+        for epoch_store, name in [(self.train_store, "train_data.npy"), (self.test_store, "test_data.npy")]:
+            location = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, n_epoch), name)
+            data = self.store.load(location)
+            # allocate the store when it is missing or laid out for other epochs/shapes, rows of other epochs are kept otherwise
+            epochs = list(range(self.s, self.e + 1, self.p))
+            if not epoch_store.covers(epochs, data.shape, dtype=self.consolidate_dtype):
+                epoch_store.create(epochs, data.shape, dtype=self.consolidate_dtype)
+            epoch_store.write(n_epoch, data, source=location)
+
     def _estimate_boundary(self, num, l_bound):
         '''
         Preprocessing data. This process includes find_border_points and find_border_centers
@@ -169,58 +269,55 @@ class NormalDataProvider(DataProvider):
         '''
 
         time_borders_gen = list()
-        training_data_path = os.path.join(self.content_path, "Training_data")
-        training_data = torch.load(os.path.join(training_data_path, "training_dataset_data.pth"),
-                                   map_location="cpu")
-        training_data = training_data.to(self.DEVICE)
+        training_data = self._load_training_data()
         for n_epoch in range(self.s, self.e + 1, self.p):
-            index_file = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, n_epoch), "index.json")
-            index = load_labelled_data_index(index_file)
-            training_data = training_data[index]
-
-            # model_location = os.path.join(self.model_path, "Epoch_{:d}".format(n_epoch), "subject_model.pth")
-            # self.model.load_state_dict(torch.load(model_location, map_location=torch.device("cpu")))
-            # self.model = self.model.to(self.DEVICE)
-            # self.model.eval()
-            # repr_model = torch.nn.Sequential(*(list(self.model.children())[:self.split]))
-            repr_model = self.feature_function(n_epoch)
-
-            t0 = time.time()
-            confs = batch_run(self.model, training_data)
-            preds = np.argmax(confs, axis=1).squeeze()
-            # TODO how to choose the number of boundary points?
-            num_adv_eg = num
-            border_points, _, _ = get_border_points(model=self.model, input_x=training_data, confs=confs, predictions=preds, device=self.DEVICE, l_bound=l_bound, num_adv_eg=num_adv_eg, lambd=0.05, verbose=0)
-            t1 = time.time()
-            time_borders_gen.append(round(t1 - t0, 4))
-
-            # get gap layer data
-            border_points = border_points.to(self.DEVICE)
-            border_centers = batch_run(repr_model, border_points)
-            location = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, n_epoch), "border_centers.npy")
-            np.save(location, border_centers)
-
-            location = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, n_epoch), "ori_border_centers.npy")
-            np.save(location, border_points.cpu().numpy())
-
-            num_adv_eg = num
-            border_points, _, _ = get_border_points(model=self.model, input_x=training_data, confs=confs, predictions=preds, device=self.DEVICE, l_bound=l_bound, num_adv_eg=num_adv_eg, lambd=0.05, verbose=0)
-
-            # get gap layer data
-            border_points = border_points.to(self.DEVICE)
-            border_centers = batch_run(repr_model, border_points)
-            location = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, n_epoch), "test_border_centers.npy")
-            np.save(location, border_centers)
-
-            location = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, n_epoch), "test_ori_border_centers.npy")
-            np.save(location, border_points.cpu().numpy())
-
+            timing = self._estimate_boundary_epoch(n_epoch, training_data, num, l_bound)
+            time_borders_gen.append(round(timing["border_gen"], 4))
             if self.verbose > 0:
                 print("Finish generating borders for Epoch {:d}...".format(n_epoch))
         print(
             "Average time for generate border points: {:.4f}".format(sum(time_borders_gen) / len(time_borders_gen)))
 
         # save result
+        self.record_time({"data_B_gene": round(sum(time_borders_gen) / len(time_borders_gen), 3)})
+
+    def _estimate_boundary_epoch(self, n_epoch, training_data, num, l_bound):
+        """
+        generate and save border points of one epoch, num for training and num for testing
+        :return: dict, time spent in each stage
+        """
+        t0 = time.time()
+        index_file = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, n_epoch), "index.json")
+        index = load_labelled_data_index(index_file)
+        training_data = training_data[index]
+
+        model_location = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, n_epoch), "subject_model.pth")
+        self.load_subject_model(model_location)
+        repr_model = self.feature_function(n_epoch)
+        t1 = time.time()
+
+        confs = batch_run(self.model, training_data)
+        preds = np.argmax(confs, axis=1).squeeze()
+        # TODO how to choose the number of boundary points?
+        # one run for both the training and the testing border points
+        border_points, _, _ = get_border_points_batch(model=self.model, input_x=training_data, confs=confs, predictions=preds, device=self.DEVICE, l_bound=l_bound, num_adv_eg=2*num, lambd=0.05, verbose=0)
+        border_points = border_points[torch.randperm(len(border_points), device=border_points.device)]
+        t2 = time.time()
+
+        for prefix, points in [("", border_points[:num]), ("test_", border_points[num:])]:
+            # get gap layer data
+            points = points.to(self.DEVICE)
+            border_centers = batch_run(repr_model, points)
+            location = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, n_epoch), "{}border_centers.npy".format(prefix))
+            self.store.save(location, border_centers)
+
+            location = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, n_epoch), "{}ori_border_centers.npy".format(prefix))
+            np.save(location, points.cpu().numpy())
+        t3 = time.time()
+        return {"load_checkpoint": t1 - t0, "border_gen": t2 - t1, "border_inference": t3 - t2}
+
+    def record_time(self, values):
+        """merge values into Model/time.json"""
         save_dir = os.path.join(self.model_path, "time.json")
         if not os.path.exists(save_dir):
             evaluation = dict()
@@ -228,35 +325,75 @@ class NormalDataProvider(DataProvider):
             f = open(save_dir, "r")
             evaluation = json.load(f)
             f.close()
-        evaluation["data_B_gene"] = round(sum(time_borders_gen) / len(time_borders_gen), 3)
+        evaluation.update(values)
         with open(save_dir, 'w') as f:
             json.dump(evaluation, f)
 
-    def initialize(self, num, l_bound):
-        self._meta_data()
-        self._estimate_boundary(num, l_bound)
+    def initialize(self, num, l_bound, workers=1, threads_per_worker=None, skip_existing=False):
+        if workers == 1 and not skip_existing:
+            self._meta_data()
+            self._estimate_boundary(num, l_bound)
+        else:
+            PreprocessPipeline(self, workers=workers, threads_per_worker=threads_per_worker, skip_existing=skip_existing, verbose=self.verbose).run(num, l_bound)
 
 
     def train_representation(self, epoch):
         # load train data
         train_data_loc = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, epoch), "train_data.npy")
         index_file = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, epoch), "index.json")
-        index = load_labelled_data_index(index_file)
         try:
-            train_data = np.load(train_data_loc)
-            train_data = train_data[index]
-            
+            if self.train_store.has(epoch, train_data_loc):
+                train_data = take_rows(self.train_store.read(epoch), self.store.load_index(index_file))
+            else:
+                train_data = self.store.select(train_data_loc, index_file)
         except Exception as e:
             print("no train data saved for Epoch {}".format(epoch))
             train_data = None
         return train_data
+
+    def _prediction_data(self, epoch):
+        return np.concatenate((self.train_representation(epoch), self.test_representation(epoch)), axis=0)
+
+    def train_representations(self, epochs):
+        """
+        representations of several epochs at once
+        :param epochs: iterable of int
+        :return: numpy.ndarray, (len(epochs), train_num, repr_dim)
+        """
+        epochs = list(epochs)
+        return self._representations(self.train_store, epochs, "train_data.npy", "index.json", self.train_representation)
+
+    def test_representations(self, epochs):
+        """
+        representations of several epochs at once
+        :param epochs: iterable of int
+        :return: numpy.ndarray, (len(epochs), test_num, repr_dim)
+        """
+        epochs = list(epochs)
+        return self._representations(self.test_store, epochs, "test_data.npy", "test_index.json", self.test_representation)
+
+    def _representations(self, epoch_store, epochs, data_name, index_name, fallback):
+        dirs = [os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, e)) for e in epochs]
+        if len(epochs) and all(epoch_store.has(e, os.path.join(d, data_name)) for e, d in zip(epochs, dirs)):
+            index_files = [os.path.join(d, index_name) for d in dirs]
+            if all(os.path.exists(f) for f in index_files):
+                indices = [self.store.load_index(f) for f in index_files]
+            elif not any(os.path.exists(f) for f in index_files):
+                indices = None
+            else:
+                indices = False
+            if indices is None or (indices is not False and all(np.array_equal(indices[0], i) for i in indices[1:])):
+                # one sequential read of the consolidated file
+                data = epoch_store.read_many(epochs)
+                if indices is not None:
+                    data = take_rows(data.swapaxes(0, 1), indices[0]).swapaxes(0, 1)
+                return data
+        return np.stack([fallback(e) for e in epochs], axis=0)
     
     def train_labels(self, epoch):
         # load train data
         training_data_loc = os.path.join(self.content_path, "Training_data", "training_dataset_label.pth")
         # training_data_loc = os.path.join(self.content_path, "Training_data", f"training_dataset_label_{epoch}.pth")
-        index_file = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, epoch), "index.json")
-        index = load_labelled_data_index(index_file)
         try:
             training_labels = torch.load(training_data_loc, map_location="cpu")
             training_labels = np.array(training_labels)
@@ -268,11 +405,15 @@ class NormalDataProvider(DataProvider):
     def test_representation(self, epoch):
         data_loc = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, epoch), "test_data.npy")
         try:
-            test_data = np.load(data_loc)
             index_file = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, epoch), "test_index.json")
-            if os.path.exists(index_file):
-                index = load_labelled_data_index(index_file)
-                test_data = test_data[index]
+            if not os.path.exists(index_file):
+                index_file = None
+            if self.test_store.has(epoch, data_loc):
+                test_data = self.test_store.read(epoch)
+                if index_file is not None:
+                    test_data = take_rows(test_data, self.store.load_index(index_file))
+            else:
+                test_data = self.store.select(data_loc, index_file)
         except Exception as e:
             print("no test data saved for Epoch {}".format(epoch))
             test_data = None
@@ -302,7 +443,7 @@ class NormalDataProvider(DataProvider):
         border_centers_loc = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, epoch),
                                           "border_centers.npy")
         try:
-            border_centers = np.load(border_centers_loc)
+            border_centers = self.store.load(border_centers_loc)
         except Exception as e:
             print("no border points saved for Epoch {}".format(epoch))
             border_centers = np.array([])
@@ -312,7 +453,7 @@ class NormalDataProvider(DataProvider):
         border_centers_loc = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, epoch),
                                           "test_border_centers.npy")
         try:
-            border_centers = np.load(border_centers_loc)
+            border_centers = self.store.load(border_centers_loc)
         except Exception as e:
             print("no border points saved for Epoch {}".format(epoch))
             border_centers = np.array([])
@@ -321,11 +462,12 @@ class NormalDataProvider(DataProvider):
     def max_norm(self, epoch):
         train_data_loc = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, epoch), "train_data.npy")
         index_file = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, epoch), "index.json")
-        index = load_labelled_data_index(index_file)
         try:
-            train_data = np.load(train_data_loc)
-            train_data = train_data[index]
-            max_x = np.linalg.norm(train_data, axis=1).max()
+            key = (epoch, os.path.getmtime(train_data_loc), os.path.getmtime(index_file))
+            if key not in self._max_norms:
+                train_data = self.store.select(train_data_loc, index_file)
+                self._max_norms[key] = np.linalg.norm(train_data, axis=1).max()
+            max_x = self._max_norms[key]
         except Exception as e:
             print("no train data saved for Epoch {}".format(epoch))
             max_x = None
@@ -333,9 +475,7 @@ class NormalDataProvider(DataProvider):
 
     def prediction_function(self, epoch):
         model_location = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, epoch), "subject_model.pth")
-        self.model.load_state_dict(torch.load(model_location, map_location=torch.device("cpu")))
-        self.model.to(self.DEVICE)
-        self.model.eval()
+        self.load_subject_model(model_location)
 
         pred_fn = self.model.prediction
         return pred_fn
@@ -343,9 +483,7 @@ class NormalDataProvider(DataProvider):
 
     def feature_function(self, epoch):
         model_location = os.path.join(self.model_path, "{}_{:d}".format(self.epoch_name, epoch), "subject_model.pth")
-        self.model.load_state_dict(torch.load(model_location, map_location=torch.device("cpu")))
-        self.model = self.model.to(self.DEVICE)
-        self.model.eval()
+        self.load_subject_model(model_location)
 
         fea_fn = self.model.feature
         return fea_fn
@@ -357,11 +495,12 @@ class NormalDataProvider(DataProvider):
         :param epoch_id:
         :return: pred, numpy.ndarray
         '''
-        prediction_func = self.prediction_function(epoch)
+        with self.model_lock:
+            prediction_func = self.prediction_function(epoch)
 
-        data = torch.from_numpy(data)
-        data = data.to(self.DEVICE)
-        pred = batch_run(prediction_func, data)
+            data = torch.from_numpy(data)
+            data = data.to(self.DEVICE)
+            pred = batch_run(prediction_func, data)
         return pred
 
     def training_accu(self, epoch):
@@ -499,30 +638,20 @@ class ActiveLearningDataProvider(DataProvider):
         confs = batch_run(self.model, training_data)
         preds = np.argmax(confs, axis=1).squeeze()
         # TODO how to choose the number of boundary points?
-        num_adv_eg = num
-        border_points, _, _ = get_border_points(model=self.model, input_x=training_data, confs=confs, predictions=preds, device=self.DEVICE, l_bound=l_bound, num_adv_eg=num_adv_eg, lambd=0.05, verbose=0)
+        # one run for both the training and the testing border points
+        border_points, _, _ = get_border_points_batch(model=self.model, input_x=training_data, confs=confs, predictions=preds, device=self.DEVICE, l_bound=l_bound, num_adv_eg=2*num, lambd=0.05, verbose=0)
+        border_points = border_points[torch.randperm(len(border_points), device=border_points.device)]
         t1 = time.time()
 
-        # get gap layer data
-        border_points = border_points.to(self.DEVICE)
-        border_centers = batch_run(repr_model, border_points)
-        location = os.path.join(self.model_path, "{}_{:d}".format(self.iteration_name, iteration), "border_centers.npy")
-        np.save(location, border_centers)
-
-        location = os.path.join(self.model_path, "{}_{:d}".format(self.iteration_name, iteration), "ori_border_centers.npy")
-        np.save(location, border_points.cpu().numpy())
-
-        num_adv_eg = num
-        border_points, _, _ = get_border_points(model=self.model, input_x=training_data, confs=confs, predictions=preds, device=self.DEVICE, l_bound=l_bound, num_adv_eg=num_adv_eg, lambd=0.05, verbose=0)
-
-        # get gap layer data
-        border_points = border_points.to(self.DEVICE)
-        border_centers = batch_run(repr_model, border_points)
-        location = os.path.join(self.model_path, "{}_{:d}".format(self.iteration_name, iteration), "test_border_centers.npy")
-        np.save(location, border_centers)
+        for prefix, points in [("", border_points[:num]), ("test_", border_points[num:])]:
+            # get gap layer data
+            points = points.to(self.DEVICE)
+            border_centers = batch_run(repr_model, points)
+            location = os.path.join(self.model_path, "{}_{:d}".format(self.iteration_name, iteration), "{}border_centers.npy".format(prefix))
+            np.save(location, border_centers)
 
-        location = os.path.join(self.model_path, "{}_{:d}".format(self.iteration_nameiteration), "test_ori_border_centers.npy")
-        np.save(location, border_points.cpu().numpy())
+            location = os.path.join(self.model_path, "{}_{:d}".format(self.iteration_name, iteration), "{}ori_border_centers.npy".format(prefix))
+            np.save(location, points.cpu().numpy())
 
         if self.verbose > 0:
             print("Finish generating borders for Iteration {:d} in {:.2f} seconds ...".format(iteration, t1-t0))
@@ -613,6 +742,9 @@ class ActiveLearningDataProvider(DataProvider):
             training_labels = None
         return training_labels.numpy()
 
+    def _prediction_data(self, iteration):
+        return np.concatenate((self.train_representation_all(iteration), self.test_representation(iteration)), axis=0)
+
     def test_representation(self, epoch):
         data_loc = os.path.join(self.model_path, "{}_{:d}".format(self.iteration_name, epoch), "test_data.npy")
         try:
@@ -668,18 +800,14 @@ class ActiveLearningDataProvider(DataProvider):
 
     def prediction_function(self, iteration):
         model_location = os.path.join(self.model_path, "{}_{:d}".format(self.iteration_name, iteration), "subject_model.pth")
-        self.model.load_state_dict(torch.load(model_location, map_location=torch.device("cpu")))
-        self.model.to(self.DEVICE)
-        self.model.eval()
+        self.load_subject_model(model_location)
 
         pred_fn = self.model.prediction
         return pred_fn
 
     def feature_function(self, epoch):
         model_location = os.path.join(self.model_path, "{}_{:d}".format(self.iteration_name, epoch), "subject_model.pth")
-        self.model.load_state_dict(torch.load(model_location, map_location=torch.device("cpu")))
-        self.model.to(self.DEVICE)
-        self.model.eval()
+        self.load_subject_model(model_location)
 
         fea_fn = self.model.feature
         return fea_fn
@@ -691,11 +819,12 @@ class ActiveLearningDataProvider(DataProvider):
         :param epoch_id:
         :return: pred, numpy.ndarray
         '''
-        prediction_func = self.prediction_function(iteration)
+        with self.model_lock:
+            prediction_func = self.prediction_function(iteration)
 
-        data = torch.from_numpy(data)
-        data = data.to(self.DEVICE)
-        pred = batch_run(prediction_func, data)
+            data = torch.from_numpy(data)
+            data = data.to(self.DEVICE)
+            pred = batch_run(prediction_func, data)
         return pred
 
     def training_accu(self, epoch):
@@ -826,31 +955,21 @@ class DenseActiveLearningDataProvider(ActiveLearningDataProvider):
             confs = batch_run(self.model, training_data)
             preds = np.argmax(confs, axis=1).squeeze()
             # TODO how to choose the number of boundary points?
-            num_adv_eg = num
-            border_points, _, _ = get_border_points(model=self.model, input_x=training_data, confs=confs, predictions=preds, device=self.DEVICE, l_bound=l_bound, num_adv_eg=num_adv_eg, lambd=0.05, verbose=0)
+            # one run for both the training and the testing border points
+            border_points, _, _ = get_border_points_batch(model=self.model, input_x=training_data, confs=confs, predictions=preds, device=self.DEVICE, l_bound=l_bound, num_adv_eg=2*num, lambd=0.05, verbose=0)
+            border_points = border_points[torch.randperm(len(border_points), device=border_points.device)]
             t1 = time.time()
             time_borders_gen.append(round(t1 - t0, 4))
 
-            # get gap layer data
-            border_points = border_points.to(self.DEVICE)
-            border_centers = batch_run(repr_model, border_points)
-            location = os.path.join(self.model_path, "{}_{}".format(self.iteration_name, iteration), "{}_{:d}".format(self.epoch_name, n_epoch), "border_centers.npy")
-            np.save(location, border_centers)
-
-            location = os.path.join(self.model_path, "{}_{}".format(self.iteration_name, iteration), "{}_{:d}".format(self.epoch_name, n_epoch), "ori_border_centers.npy")
-            np.save(location, border_points.cpu().numpy())
-
-            num_adv_eg = num
-            border_points, _, _ = get_border_points(model=self.model, input_x=training_data, confs=confs, predictions=preds, device=self.DEVICE, l_bound=l_bound, num_adv_eg=num_adv_eg, lambd=0.05, verbose=0)
-
-            # get gap layer data
-            border_points = border_points.to(self.DEVICE)
-            border_centers = batch_run(repr_model, border_points)
-            location = os.path.join(self.model_path, "{}_{}".format(self.iteration_name, iteration), "{}_{:d}".format(self.epoch_nanme, n_epoch), "test_border_centers.npy")
-            np.save(location, border_centers)
+            for prefix, points in [("", border_points[:num]), ("test_", border_points[num:])]:
+                # get gap layer data
+                points = points.to(self.DEVICE)
+                border_centers = batch_run(repr_model, points)
+                location = os.path.join(self.model_path, "{}_{}".format(self.iteration_name, iteration), "{}_{:d}".format(self.epoch_name, n_epoch), "{}border_centers.npy".format(prefix))
+                np.save(location, border_centers)
 
-            location = os.path.join(self.model_path, "{}_{}".format(self.iteration_name, iteration), "{}_{:d}".format(self.epoch_name, n_epoch), "test_ori_border_centers.npy")
-            np.save(location, border_points.cpu().numpy())
+                location = os.path.join(self.model_path, "{}_{}".format(self.iteration_name, iteration), "{}_{:d}".format(self.epoch_name, n_epoch), "{}ori_border_centers.npy".format(prefix))
+                np.save(location, points.cpu().numpy())
 
             if self.verbose > 0:
                 print("Finish generating borders for Epoch {:d}...".format(n_epoch))
@@ -988,18 +1107,14 @@ class DenseActiveLearningDataProvider(ActiveLearningDataProvider):
 
     def prediction_function(self, iteration, epoch):
         model_location = os.path.join(self.model_path, "{}_{}".format(self.iteration_name, iteration), "{}_{:d}".format(self.epoch_name, epoch), "subject_model.pth")
-        self.model.load_state_dict(torch.load(model_location, map_location=torch.device("cpu")))
-        self.model.to(self.DEVICE)
-        self.model.eval()
+        self.load_subject_model(model_location)
 
         pred_fn = self.model.prediction
         return pred_fn
 
     def feature_function(self, iteration, epoch):
         model_location = os.path.join(self.model_path, "{}_{}".format(self.iteration_name, iteration), "{}_{:d}".format(self.epoch_name, epoch), "subject_model.pth")
-        self.model.load_state_dict(torch.load(model_location, map_location=torch.device("cpu")))
-        self.model = self.model.to(self.DEVICE)
-        self.model.eval()
+        self.load_subject_model(model_location)
 
         fea_fn = self.model.feature
         return fea_fn
@@ -1011,11 +1126,12 @@ class DenseActiveLearningDataProvider(ActiveLearningDataProvider):
         :param epoch_id:
         :return: pred, numpy.ndarray
         '''
-        prediction_func = self.prediction_function(iteration, epoch)
+        with self.model_lock:
+            prediction_func = self.prediction_function(iteration, epoch)
 
-        data = torch.from_numpy(data)
-        data = data.to(self.DEVICE)
-        pred = batch_run(prediction_func, data)
+            data = torch.from_numpy(data)
+            data = data.to(self.DEVICE)
+            pred = batch_run(prediction_func, data)
         return pred
 
     def training_accu(self, iteration, epoch):
@@ -2,6 +2,8 @@
 Edge dataset from temporal complex
 """
 from abc import ABC, abstractmethod
+import math
+import torch
 from torch.utils.data import Dataset
 from PIL import Image
 import tensorflow as tf
@@ -111,6 +113,52 @@ class DVIDataHandler(Dataset):
         # return the number of all edges
         return len(self.edge_to)
 
+class TensorEdgeLoader:
+    """
+    Drop-in replacement of DataLoader(DataHandler(...), sampler=WeightedRandomSampler(probs, n_samples)).
+
+    Features and attention are kept as single torch tensors. Every batch draws batch_size edges
+    at once by inverse-CDF sampling (searchsorted on the cumulative edge weights, no 2^24 category
+    limit) and gathers both endpoints with one index operation, instead of collating per-edge items.
+    Batches are (edge_to, edge_from, a_to, a_from), plus the per-edge labels when edge_labels is given,
+    plus the rows of every node_extras array at the edge_to endpoints, in order
+    (node_extras=(embedded, coefficient) replaces HybridDataHandler).
+    """
+    def __init__(self, edge_to, edge_from, feature_vector, attention, probs, n_samples, batch_size=1000, edge_labels=None, node_extras=(), device="cpu"):
+        self.device = torch.device(device)
+        self.edge_to = torch.as_tensor(np.asarray(edge_to), dtype=torch.long, device=self.device)
+        self.edge_from = torch.as_tensor(np.asarray(edge_from), dtype=torch.long, device=self.device)
+        self.data = torch.as_tensor(np.asarray(feature_vector), dtype=torch.float32, device=self.device)
+        self.attention = torch.as_tensor(np.asarray(attention), dtype=torch.float32, device=self.device)
+        self.edge_labels = None if edge_labels is None else torch.as_tensor(np.asarray(edge_labels), device=self.device)
+        self.node_extras = [torch.as_tensor(np.asarray(extra), dtype=torch.float32, device=self.device) for extra in node_extras]
+        probs = torch.as_tensor(np.asarray(probs), dtype=torch.float64, device=self.device)
+        cdf = torch.cumsum(probs, dim=0)
+        self.cdf = cdf / cdf[-1]
+        self.n_samples = int(n_samples)
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return math.ceil(self.n_samples / self.batch_size)
+
+    def sample(self, size):
+        """draw size edge indices with probability proportional to their weight"""
+        u = torch.rand(size, dtype=torch.float64, device=self.device)
+        idxs = torch.searchsorted(self.cdf, u)
+        return torch.clamp(idxs, max=len(self.cdf) - 1)
+
+    def __iter__(self):
+        for start in range(0, self.n_samples, self.batch_size):
+            idxs = self.sample(min(self.batch_size, self.n_samples - start))
+            to_idxs = self.edge_to[idxs]
+            from_idxs = self.edge_from[idxs]
+            batch = (self.data[to_idxs], self.data[from_idxs], self.attention[to_idxs], self.attention[from_idxs])
+            if self.edge_labels is not None:
+                batch = batch + (self.edge_labels[idxs],)
+            batch = batch + tuple(extra[to_idxs] for extra in self.node_extras)
+            yield batch
+
+
 # tf.dataset
 def construct_edge_dataset(
     edges_to_exp, edges_from_exp, weight, data, alpha, n_rate, batch_size
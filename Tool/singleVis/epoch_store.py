@@ -0,0 +1,206 @@
+"""The EpochStore class keeps the representations of all epochs in a single [epoch, sample, dim] file"""
+import os
+import json
+import threading
+
+import numpy as np
+
+from singleVis.representation_store import RepresentationStore
+
+
+class EpochStore:
+    """
+    Consolidated per-split representation store.
+
+    Layout under content_path/Model/consolidated/:
+        {split}_data.npy    float32/float16 array of shape (n_epochs, n_samples, dim)
+        {split}_data.json   {"epochs": [...], "written": {epoch: source_mtime}, "dtype": ..., "shape": [...]}
+
+    Rows are stored in the same order as Epoch_N/{split}_data.npy (before index.json is applied),
+    so a temporal scan over epochs is a sequential read of one memory-mapped file.
+    An epoch is only served from here while its per-epoch file (if any) has not been rewritten since.
+    """
+    def __init__(self, model_path, split, store=None):
+        self.dir = os.path.join(model_path, "consolidated")
+        self.split = split
+        self.path = os.path.join(self.dir, "{}_data.npy".format(split))
+        self.meta_path = os.path.join(self.dir, "{}_data.json".format(split))
+        self.store = store if store is not None else RepresentationStore()
+        self._meta = None
+        self._meta_mtime = None
+        self._writer = None
+        self._lock = threading.Lock()
+
+    ################################################ meta ################################################
+    def meta(self):
+        """return the parsed meta file, None if the store does not exist"""
+        try:
+            mtime = os.path.getmtime(self.meta_path)
+        except OSError:
+            return None
+        with self._lock:
+            if self._meta is None or self._meta_mtime != mtime:
+                with open(self.meta_path, "r") as f:
+                    self._meta = json.load(f)
+                self._meta_mtime = mtime
+            return self._meta
+
+    def _save_meta(self, meta):
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta_path)
+        with self._lock:
+            self._meta = meta
+            self._meta_mtime = os.path.getmtime(self.meta_path)
+
+    def exists(self):
+        return self.meta() is not None
+
+    @property
+    def epochs(self):
+        meta = self.meta()
+        return list() if meta is None else list(meta["epochs"])
+
+    def has(self, epoch, source=None):
+        """
+        whether epoch has been written and is not older than its per-epoch source file
+        :param epoch: int
+        :param source: str or None, location of Epoch_N/{split}_data.npy
+        """
+        meta = self.meta()
+        if meta is None:
+            return False
+        written = meta["written"].get(str(epoch))
+        if written is None:
+            return False
+        if source is not None and os.path.exists(source):
+            return os.path.getmtime(source) <= written
+        return True
+
+    def covers(self, epochs, sample_shape, dtype="float32"):
+        """whether the store exists with a row for every one of epochs, of sample_shape and dtype"""
+        meta = self.meta()
+        if meta is None:
+            return False
+        if meta["shape"][1:] != [int(s) for s in sample_shape] or meta["dtype"] != np.dtype(dtype).name:
+            return False
+        return set(int(e) for e in epochs).issubset(meta["epochs"])
+
+    ################################################ write ###############################################
+    def create(self, epochs, sample_shape, dtype="float32"):
+        """
+        allocate an empty store for epochs
+        :param epochs: list of int
+        :param sample_shape: tuple, (n_samples, dim)
+        :param dtype: str, "float32" or "float16"
+        """
+        os.makedirs(self.dir, exist_ok=True)
+        self.close()
+        shape = (len(epochs),) + tuple(int(s) for s in sample_shape)
+        tmp_path = self.path + ".tmp.npy"
+        arr = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.dtype(dtype), shape=shape)
+        del arr
+        os.replace(tmp_path, self.path)
+        self.store.invalidate(self.path)
+        self._save_meta({
+            "epochs": [int(e) for e in epochs],
+            "written": dict(),
+            "dtype": np.dtype(dtype).name,
+            "shape": list(shape),
+        })
+
+    def write(self, epoch, data, source=None):
+        """
+        write the representation of one epoch
+        :param epoch: int, must be one of the epochs given to create()
+        :param data: numpy.ndarray, (n_samples, dim)
+        :param source: str or None, per-epoch file whose mtime this row is consistent with
+        :return: bool, whether the row was written
+        """
+        meta = self.meta()
+        if meta is None or int(epoch) not in meta["epochs"]:
+            return False
+        if list(data.shape) != meta["shape"][1:]:
+            print("Shape {} of Epoch {} does not match consolidated {} data {}, skip...".format(data.shape, epoch, self.split, meta["shape"][1:]))
+            return False
+        if self._writer is None:
+            self._writer = np.load(self.path, mmap_mode="r+")
+        pos = meta["epochs"].index(int(epoch))
+        self._writer[pos] = data
+        self._writer.flush()
+        stamp = os.path.getmtime(source) if source is not None and os.path.exists(source) else os.path.getmtime(self.path)
+        meta = dict(meta)
+        meta["written"] = dict(meta["written"])
+        meta["written"][str(epoch)] = stamp
+        self._save_meta(meta)
+        return True
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.flush()
+            self._writer = None
+
+    ################################################ read ################################################
+    def _as_float32(self, data):
+        if data.dtype != np.float32:
+            return data.astype(np.float32)
+        return data
+
+    def read(self, epoch):
+        """
+        :param epoch: int
+        :return: numpy.ndarray, (n_samples, dim), all rows of epoch
+        """
+        meta = self.meta()
+        pos = meta["epochs"].index(int(epoch))
+        data = self.store.load(self.path)
+        return self._as_float32(data[pos])
+
+    def read_many(self, epochs):
+        """
+        :param epochs: list of int
+        :return: numpy.ndarray, (len(epochs), n_samples, dim)
+        """
+        meta = self.meta()
+        pos = np.asarray([meta["epochs"].index(int(e)) for e in epochs], dtype=np.int64)
+        data = self.store.load(self.path)
+        if len(pos) > 1 and np.all(np.diff(pos) == pos[1] - pos[0]) and pos[1] > pos[0]:
+            # evenly spaced epochs, a strided view of the file
+            data = data[pos[0]:pos[-1] + 1:pos[1] - pos[0]]
+        else:
+            data = data[pos]
+        return self._as_float32(data)
+
+
+def consolidate(model_path, epochs, epoch_name="Epoch", splits=("train", "test"), dtype="float32", verbose=1):
+    """
+    convert existing Epoch_N/{split}_data.npy files of a content path into consolidated stores
+    :param model_path: str, content_path/Model
+    :param epochs: list of int
+    :param epoch_name: str, name of per-epoch directories
+    :param splits: tuple of str
+    :param dtype: str, storage dtype, "float32" or "float16"
+    :return: dict, split -> list of epochs written
+    """
+    results = dict()
+    for split in splits:
+        sources = [os.path.join(model_path, "{}_{:d}".format(epoch_name, e), "{}_data.npy".format(split)) for e in epochs]
+        available = [(e, s) for e, s in zip(epochs, sources) if os.path.exists(s)]
+        if len(available) == 0:
+            if verbose:
+                print("No {} data found, skip...".format(split))
+            continue
+        first = np.load(available[0][1], mmap_mode="r")
+        epoch_store = EpochStore(model_path, split)
+        epoch_store.create([e for e, _ in available], first.shape, dtype=dtype)
+        del first
+        written = list()
+        for e, s in available:
+            if epoch_store.write(e, np.load(s, mmap_mode="r"), source=s):
+                written.append(e)
+                if verbose:
+                    print("Finish consolidating {} data of {} {:d}...".format(split, epoch_name, e))
+        epoch_store.close()
+        results[split] = written
+    return results
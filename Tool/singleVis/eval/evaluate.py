@@ -8,6 +8,9 @@ from sklearn.neighbors import NearestNeighbors
 from sklearn.manifold import trustworthiness
 from scipy.stats import kendalltau, spearmanr, pearsonr, rankdata
 
+from singleVis.knn_cache import knn_overlap
+from singleVis.spatial_index import SpatialIndex
+
 def calculate_cosine_similarity(data1, data2):
     """
     Calculate the cosine similarity matrix between two datasets.
@@ -56,47 +59,38 @@ def rank_similarities_and_color(data1, data2, labels=None):
         return colors
 
 def evaluate_isAlign(embeddingLeft, embeddingRight, align_metric=1):
-    lens = len(embeddingLeft)
-    align_indices = []
-    for i in range(lens):
-        dist = np.linalg.norm( embeddingLeft[i]-embeddingRight[i])
-        if dist < align_metric:
-            align_indices.append(i)
-    return align_indices
+    """indices of the points that moved less than align_metric between the two embeddings"""
+    return SpatialIndex.aligned(embeddingLeft, embeddingRight, align_metric).tolist()
 
 
-def evaluate_isAlign_single(embeddingLeft, embeddingRight, selected_left, selected_right,align_metric=1):
-    lens = len(embeddingLeft)
+def evaluate_isAlign_single(embeddingLeft, embeddingRight, selected_left, selected_right,align_metric=1, left_index=None, right_index=None):
+    """
+    points of one embedding closer than align_metric to the selected point of the other
+    :param left_index: SpatialIndex or None, index over embeddingLeft, built on demand if None
+    :param right_index: SpatialIndex or None, index over embeddingRight
+    :return: (indices in embeddingLeft near embeddingRight[selected_right], indices in embeddingRight near embeddingLeft[selected_left])
+    """
     align_indices_left = []
     align_indices_right = []
 
     if selected_left != -1:
-        for i in range(lens):
-            dist = np.linalg.norm( embeddingLeft[selected_left]-embeddingRight[i])
-            if dist < align_metric:
-                align_indices_right.append(i)
+        if right_index is None:
+            right_index = SpatialIndex(embeddingRight)
+        align_indices_right = right_index.within(embeddingLeft[selected_left], align_metric).tolist()
     if selected_right != -1:
-        for i in range(lens):
-            dist = np.linalg.norm( embeddingLeft[i]-embeddingRight[selected_right])
-            if dist < align_metric:
-                align_indices_left.append(i)
+        if left_index is None:
+            left_index = SpatialIndex(embeddingLeft)
+        align_indices_left = left_index.within(embeddingRight[selected_right], align_metric).tolist()
 
     return align_indices_left, align_indices_right
        
-def evaluate_isNearestNeighbour(embeddingLeft, embeddingRight, n_neighbors=15, metric="euclidean"):
-    """
-    Find indices where none of the nearest neighbors in embeddingLeft are preserved in embeddingRight.
-    :param embeddingLeft: ndarray, first set of low dimensional representations
-    :param embeddingRight: ndarray, second set of low dimensional representations
-    :param n_neighbors: int, number of nearest neighbors to consider
-    :param metric: str, metric for nearest neighbor calculation, default "euclidean"
-    :return: list of indices where none of the neighbors are preserved
-    """
-    n_trees = 5 + int(round((embeddingLeft.shape[0]) ** 0.5 / 20.0))
-    n_iters = max(5, int(round(np.log2(embeddingLeft.shape[0]))))
-
-    nnd_left = NNDescent(
-        embeddingLeft,
+def _nearest_neighbours(embedding, n_neighbors, metric, neighbors=None):
+    if neighbors is not None:
+        return neighbors[:, :n_neighbors]
+    n_trees = 5 + int(round((embedding.shape[0]) ** 0.5 / 20.0))
+    n_iters = max(5, int(round(np.log2(embedding.shape[0]))))
+    nnd = NNDescent(
+        embedding,
         n_neighbors=n_neighbors,
         metric=metric,
         n_trees=n_trees,
@@ -104,52 +98,30 @@ def evaluate_isNearestNeighbour(embeddingLeft, embeddingRight, n_neighbors=15, m
         max_candidates=60,
         verbose=True
     )
-    left_neighbors, _ = nnd_left.neighbor_graph
+    return nnd.neighbor_graph[0]
 
-    nnd_right = NNDescent(
-        embeddingRight,
-        n_neighbors=n_neighbors,
-        metric=metric,
-        n_trees=n_trees,
-        n_iters=n_iters,
-        max_candidates=60,
-        verbose=True
-    )
-    right_neighbors, _ = nnd_right.neighbor_graph
+def evaluate_isNearestNeighbour(embeddingLeft, embeddingRight, n_neighbors=15, metric="euclidean", left_neighbors=None, right_neighbors=None):
+    """
+    Find indices where none of the nearest neighbors in embeddingLeft are preserved in embeddingRight.
+    :param embeddingLeft: ndarray, first set of low dimensional representations
+    :param embeddingRight: ndarray, second set of low dimensional representations
+    :param n_neighbors: int, number of nearest neighbors to consider
+    :param metric: str, metric for nearest neighbor calculation, default "euclidean"
+    :param left_neighbors: ndarray or None, precomputed kNN indices of embeddingLeft, e.g. from KnnCache
+    :param right_neighbors: ndarray or None, precomputed kNN indices of embeddingRight
+    :return: list of indices where none of the neighbors are preserved
+    """
+    left_neighbors = _nearest_neighbours(embeddingLeft, n_neighbors, metric, left_neighbors)
+    right_neighbors = _nearest_neighbours(embeddingRight, n_neighbors, metric, right_neighbors)
 
-    non_preserved_indices = []
-    for i in range(len(embeddingLeft)):
-        if len(np.intersect1d(left_neighbors[i], right_neighbors[i])) == 0:
-            non_preserved_indices.append(i)
+    non_preserved_indices = np.flatnonzero(knn_overlap(left_neighbors, right_neighbors) == 0).tolist()
 
     return non_preserved_indices
 
-def evaluate_isNearestNeighbour_single(embeddingLeft, embeddingRight, selected_left, selected_right, n_neighbors=15,  metric="euclidean"):
+def evaluate_isNearestNeighbour_single(embeddingLeft, embeddingRight, selected_left, selected_right, n_neighbors=15,  metric="euclidean", left_neighbors=None, right_neighbors=None):
 
-    n_trees = 5 + int(round((embeddingLeft.shape[0]) ** 0.5 / 20.0))
-    n_iters = max(5, int(round(np.log2(embeddingLeft.shape[0]))))
-
-    nnd_left = NNDescent(
-        embeddingLeft,
-        n_neighbors=n_neighbors,
-        metric=metric,
-        n_trees=n_trees,
-        n_iters=n_iters,
-        max_candidates=60,
-        verbose=True
-    )
-    left_neighbors, _ = nnd_left.neighbor_graph
-
-    nnd_right = NNDescent(
-        embeddingRight,
-        n_neighbors=n_neighbors,
-        metric=metric,
-        n_trees=n_trees,
-        n_iters=n_iters,
-        max_candidates=60,
-        verbose=True
-    )
-    right_neighbors, _ = nnd_right.neighbor_graph
+    left_neighbors = _nearest_neighbours(embeddingLeft, n_neighbors, metric, left_neighbors)
+    right_neighbors = _nearest_neighbours(embeddingRight, n_neighbors, metric, right_neighbors)
 
     nearest_neighbors_leftE_rightS = []
     nearest_neighbors_rightE_rightS = []
@@ -165,28 +137,30 @@ def evaluate_isNearestNeighbour_single(embeddingLeft, embeddingRight, selected_l
         nearest_neighbors_rightE_rightS = right_neighbors[selected_right].tolist()
 
     return nearest_neighbors_leftE_leftS, nearest_neighbors_leftE_rightS, nearest_neighbors_rightE_leftS, nearest_neighbors_rightE_rightS
-def evaluate_proj_nn_perseverance_knn(data, embedding, n_neighbors, metric="euclidean"):
+def evaluate_proj_nn_perseverance_knn(data, embedding, n_neighbors, metric="euclidean", high_ind=None):
     """
     evaluate projection function, nn preserving property using knn algorithm
     :param data: ndarray, high dimensional representations
     :param embedding: ndarray, low dimensional representations
     :param n_neighbors: int, the number of neighbors
     :param metric: str, by default "euclidean"
+    :param high_ind: ndarray or None, precomputed kNN indices of data, e.g. from KnnCache
     :return nn property: float, nn preserving property
     """
     n_trees = 5 + int(round((data.shape[0]) ** 0.5 / 20.0))
     n_iters = max(5, int(round(np.log2(data.shape[0]))))
     # get nearest neighbors
-    nnd = NNDescent(
-        data,
-        n_neighbors=n_neighbors,
-        metric=metric,
-        n_trees=n_trees,
-        n_iters=n_iters,
-        max_candidates=60,
-        verbose=True
-    )
-    high_ind, _ = nnd.neighbor_graph
+    if high_ind is None:
+        nnd = NNDescent(
+            data,
+            n_neighbors=n_neighbors,
+            metric=metric,
+            n_trees=n_trees,
+            n_iters=n_iters,
+            max_candidates=60,
+            verbose=True
+        )
+        high_ind, _ = nnd.neighbor_graph
     nnd = NNDescent(
         embedding,
         n_neighbors=n_neighbors,
@@ -198,9 +172,7 @@ def evaluate_proj_nn_perseverance_knn(data, embedding, n_neighbors, metric="eucl
     )
     low_ind, _ = nnd.neighbor_graph
 
-    border_pres = np.zeros(len(data))
-    for i in range(len(data)):
-        border_pres[i] = len(np.intersect1d(high_ind[i], low_ind[i]))
+    border_pres = knn_overlap(high_ind, low_ind)
 
     # return border_pres.mean(), border_pres.max(), border_pres.min()
     return border_pres.mean()
@@ -219,7 +191,7 @@ def evaluate_proj_nn_perseverance_trustworthiness(data, embedding, n_neighbors,
     return t
 
 
-def evaluate_proj_boundary_perseverance_knn(data, embedding, high_centers, low_centers, n_neighbors):
+def evaluate_proj_boundary_perseverance_knn(data, embedding, high_centers, low_centers, n_neighbors, high_ind=None):
     """
     evaluate projection function, boundary preserving property
     :param data: ndarray, high dimensional representations
@@ -227,19 +199,19 @@ def evaluate_proj_boundary_perseverance_knn(data, embedding, high_centers, low_c
     :param high_centers: ndarray, border points high dimensional representations
     :param low_centers: ndarray, border points low dimensional representations
     :param n_neighbors: int, the number of neighbors
+    :param high_ind: ndarray or None, precomputed indices of the nearest high_centers of data, e.g. from KnnCache
     :return boundary preserving property: float,boundary preserving property
     """
-    high_neigh = NearestNeighbors(n_neighbors=n_neighbors, radius=0.4)
-    high_neigh.fit(high_centers)
-    high_ind = high_neigh.kneighbors(data, n_neighbors=n_neighbors, return_distance=False)
+    if high_ind is None:
+        high_neigh = NearestNeighbors(n_neighbors=n_neighbors, radius=0.4)
+        high_neigh.fit(high_centers)
+        high_ind = high_neigh.kneighbors(data, n_neighbors=n_neighbors, return_distance=False)
 
     low_neigh = NearestNeighbors(n_neighbors=n_neighbors, radius=0.4)
     low_neigh.fit(low_centers)
     low_ind = low_neigh.kneighbors(embedding, n_neighbors=n_neighbors, return_distance=False)
 
-    border_pres = np.zeros(len(data))
-    for i in range(len(data)):
-        border_pres[i] = len(np.intersect1d(high_ind[i], low_ind[i]))
+    border_pres = knn_overlap(high_ind, low_ind)
 
     # return border_pres.mean(), border_pres.max(), border_pres.min()
     return border_pres.mean()
@@ -9,8 +9,10 @@ from scipy.spatial.distance import cosine
 
 from singleVis.eval.evaluate import *
 from singleVis.backend import *
-from singleVis.utils import is_B, js_div
+from singleVis.utils import is_B, js_div, epoch_neighbor_preserving_rate
+from singleVis.knn_cache import knn_overlap
 from singleVis.visualizer import visualizer
+from singleVis.eval.runner import EvalRunner
 
 class EvaluatorAbstractClass(ABC):
     def __init__(self, data_provider, projector, *args, **kwargs):
@@ -48,13 +50,22 @@ class Evaluator(EvaluatorAbstractClass):
         self.projector = projector
         self.verbose = verbose
 
+    def _high_knn(self, epoch, split, data, n_neighbors, query=None):
+        """kNN indices of high dimensional data from the data provider's KnnCache, None if it has none"""
+        knn = getattr(self.data_provider, "knn", None)
+        if knn is None:
+            return None
+        indices, _ = knn.get(epoch, split, data, n_neighbors, metric="euclidean", query=query)
+        return indices
+
     ####################################### ATOM #############################################
 
     def eval_nn_train(self, epoch, n_neighbors):
         train_data = self.data_provider.train_representation(epoch)
         train_data = train_data.reshape(len(train_data), -1)
         embedding = self.projector.batch_project(epoch, train_data)
-        val = evaluate_proj_nn_perseverance_knn(train_data, embedding, n_neighbors=n_neighbors, metric="euclidean")
+        high_ind = self._high_knn(epoch, "train", train_data, n_neighbors)
+        val = evaluate_proj_nn_perseverance_knn(train_data, embedding, n_neighbors=n_neighbors, metric="euclidean", high_ind=high_ind)
         if self.verbose:
             print("#train# nn preserving: {:.2f}/{:d} in epoch {:d}".format(val, n_neighbors, epoch))
         return val
@@ -66,7 +77,8 @@ class Evaluator(EvaluatorAbstractClass):
         test_data = test_data.reshape(len(test_data), -1)
         fitting_data = np.concatenate((train_data, test_data), axis=0)
         embedding = self.projector.batch_project(epoch, fitting_data)
-        val = evaluate_proj_nn_perseverance_knn(fitting_data, embedding, n_neighbors=n_neighbors, metric="euclidean")
+        high_ind = self._high_knn(epoch, "all", fitting_data, n_neighbors)
+        val = evaluate_proj_nn_perseverance_knn(fitting_data, embedding, n_neighbors=n_neighbors, metric="euclidean", high_ind=high_ind)
         if self.verbose:
             print("#test# nn preserving : {:.2f}/{:d} in epoch {:d}".format(val, n_neighbors, epoch))
         return val
@@ -79,11 +91,13 @@ class Evaluator(EvaluatorAbstractClass):
         low_center = self.projector.batch_project(epoch, border_centers)
         low_train = self.projector.batch_project(epoch, train_data)
 
+        high_ind = self._high_knn(epoch, "train_border", border_centers, n_neighbors, query=train_data)
         val = evaluate_proj_boundary_perseverance_knn(train_data,
                                                       low_train,
                                                       border_centers,
                                                       low_center,
-                                                      n_neighbors=n_neighbors)
+                                                      n_neighbors=n_neighbors,
+                                                      high_ind=high_ind)
         if self.verbose:
             print("#train# boundary preserving: {:.2f}/{:d} in epoch {:d}".format(val, n_neighbors, epoch))
         return val
@@ -97,11 +111,13 @@ class Evaluator(EvaluatorAbstractClass):
         low_center = self.projector.batch_project(epoch, border_centers)
         low_test = self.projector.batch_project(epoch, test_data)
 
+        high_ind = self._high_knn(epoch, "test_border", border_centers, n_neighbors, query=test_data)
         val = evaluate_proj_boundary_perseverance_knn(test_data,
                                                       low_test,
                                                       border_centers,
                                                       low_center,
-                                                      n_neighbors=n_neighbors)
+                                                      n_neighbors=n_neighbors,
+                                                      high_ind=high_ind)
         if self.verbose:
             print("#test# boundary preserving: {:.2f}/{:d} in epoch {:d}".format(val, n_neighbors, epoch))
         return val
@@ -165,7 +181,7 @@ class Evaluator(EvaluatorAbstractClass):
             curr_data = self.data_provider.train_representation((t+1) * self.data_provider.p + self.data_provider.s)
             curr_embedding = self.projector.batch_project((t+1) * self.data_provider.p + self.data_provider.s, curr_data)
 
-            alpha_ = find_neighbor_preserving_rate(prev_data, curr_data, n_neighbors=n_neighbors)
+            alpha_ = epoch_neighbor_preserving_rate(self.data_provider, t * self.data_provider.p + self.data_provider.s, (t+1) * self.data_provider.p + self.data_provider.s, prev_data, curr_data, n_neighbors, split="train")
             delta_x_ = np.linalg.norm(prev_embedding - curr_embedding, axis=1)
 
             alpha[t] = alpha_
@@ -193,7 +209,7 @@ class Evaluator(EvaluatorAbstractClass):
             curr_data = np.concatenate((curr_data_train, curr_data_test), axis=0)
             curr_embedding = self.projector.batch_project((t+1) * self.data_provider.p + self.data_provider.s, curr_data)
 
-            alpha_ = find_neighbor_preserving_rate(prev_data, curr_data, n_neighbors=n_neighbors)
+            alpha_ = epoch_neighbor_preserving_rate(self.data_provider, t * self.data_provider.p + self.data_provider.s, (t+1) * self.data_provider.p + self.data_provider.s, prev_data, curr_data, n_neighbors, split="all")
             delta_x_ = np.linalg.norm(prev_embedding - curr_embedding, axis=1)
 
             alpha[t] = alpha_
@@ -213,8 +229,10 @@ class Evaluator(EvaluatorAbstractClass):
         curr_data = self.data_provider.train_representation(epoch)
         curr_embedding = self.projector.batch_project(epoch, curr_data)
         
+        # one read of all epochs, from the consolidated store when it is up to date
+        all_data = self.data_provider.train_representations(range(self.data_provider.s, self.data_provider.e + 1, self.data_provider.p))
         for t in range(epoch_num):
-            data = self.data_provider.train_representation(t * self.data_provider.p + self.data_provider.s)
+            data = all_data[t]
             embedding = self.projector.batch_project(t * self.data_provider.p + self.data_provider.s, data)
 
             high_dist = np.linalg.norm(curr_data - data, axis=1)
@@ -230,9 +248,7 @@ class Evaluator(EvaluatorAbstractClass):
         high_rankings = high_orders[:, 1:n_neighbors+1]
         low_rankings = low_orders[:, 1:n_neighbors+1]
         
-        corr = np.zeros(len(high_dists))
-        for i in range(len(data)):
-            corr[i] = len(np.intersect1d(high_rankings[i], low_rankings[i]))
+        corr = knn_overlap(high_rankings, low_rankings).astype(float)
 
         if self.verbose:
             print("Temporal temporal neighbor preserving (train) for {}-th epoch {}: {:.3f}\t std :{:.3f}".format(epoch, n_neighbors, corr.mean(), corr.std()))
@@ -247,8 +263,10 @@ class Evaluator(EvaluatorAbstractClass):
         curr_data = self.data_provider.test_representation(epoch)
         curr_embedding = self.projector.batch_project(epoch, curr_data)
 
+        # one read of all epochs, from the consolidated store when it is up to date
+        all_data = self.data_provider.test_representations(range(self.data_provider.s, self.data_provider.e + 1, self.data_provider.p))
         for t in range(epoch_num):
-            data = self.data_provider.test_representation(t * self.data_provider.p + self.data_provider.s)
+            data = all_data[t]
             embedding = self.projector.batch_project(t * self.data_provider.p + self.data_provider.s, data)
 
             high_dist = np.linalg.norm(curr_data - data, axis=1)
@@ -262,9 +280,7 @@ class Evaluator(EvaluatorAbstractClass):
         
         high_rankings = high_orders[:, 1:n_neighbors+1]
         low_rankings = low_orders[:, 1:n_neighbors+1]
-        corr = np.zeros(len(high_dists))
-        for i in range(len(data)):
-            corr[i] = len(np.intersect1d(high_rankings[i], low_rankings[i]))
+        corr = knn_overlap(high_rankings, low_rankings).astype(float)
 
         if self.verbose:
             print("Temporal nn preserving (test) for {}-th epoch {}: {:.3f}\t std:{:.3f}".format(epoch, n_neighbors, corr.mean(), corr.std()))
@@ -331,9 +347,9 @@ class Evaluator(EvaluatorAbstractClass):
         low_repr = np.zeros((EPOCH,LEN,2))
 
         # save all representation vectors
+        all_train_repr[:] = self.data_provider.train_representations(range(start, end + 1, period))
         for i in range(start,end + 1, period):
             index = (i - start) //  period
-            all_train_repr[index] = self.data_provider.train_representation(i)
             low_repr[index] = self.projector.batch_project(i, all_train_repr[index])
         
         corrs = np.zeros(LEN)
@@ -362,9 +378,9 @@ class Evaluator(EvaluatorAbstractClass):
 
         all_test_repr = np.zeros((EPOCH,TEST_LEN,repr_dim))
         low_repr = np.zeros((EPOCH,TEST_LEN,2))
+        all_test_repr[:] = self.data_provider.test_representations(range(start, end + 1, period))
         for i in range(start,end + 1, period):
             index = (i - start) //  period
-            all_test_repr[index] = self.data_provider.test_representation(i)
             low_repr[index] = self.projector.batch_project(i, all_test_repr[index])
 
         corrs = np.zeros(TEST_LEN)
@@ -394,9 +410,9 @@ class Evaluator(EvaluatorAbstractClass):
         low_repr = np.zeros((EPOCH,LEN,2))
 
         # save all representation vectors
+        all_train_repr[:] = self.data_provider.train_representations(range(start, end + 1, period))
         for i in range(start,end + 1, period):
             index = (i - start) //  period
-            all_train_repr[index] = self.data_provider.train_representation(i)
             low_repr[index] = self.projector.batch_project(i, all_train_repr[index])
         
         corrs = np.zeros(LEN)
@@ -426,9 +442,9 @@ class Evaluator(EvaluatorAbstractClass):
 
         all_test_repr = np.zeros((EPOCH,TEST_LEN,repr_dim))
         low_repr = np.zeros((EPOCH,TEST_LEN,2))
+        all_test_repr[:] = self.data_provider.test_representations(range(start, end + 1, period))
         for i in range(start,end + 1, period):
             index = (i - start) //  period
-            all_test_repr[index] = self.data_provider.test_representation(i)
             low_repr[index] = self.projector.batch_project(i, all_test_repr[index])
 
         corrs = np.zeros(TEST_LEN)
@@ -466,9 +482,9 @@ class Evaluator(EvaluatorAbstractClass):
         s = selected_stage[0]
 
         # save all representation vectors
+        all_train_repr[:] = self.data_provider.train_representations(selected_stage)
         for i in selected_stage:
             index = (i - s) //  period
-            all_train_repr[index] = self.data_provider.train_representation(i)
             low_repr[index] = self.projector.batch_project(i, all_train_repr[index])
         
         corrs = np.zeros(LEN)
@@ -501,9 +517,9 @@ class Evaluator(EvaluatorAbstractClass):
 
         all_test_repr = np.zeros((EPOCH,TEST_LEN,repr_dim))
         low_repr = np.zeros((EPOCH,TEST_LEN,2))
+        all_test_repr[:] = self.data_provider.test_representations(selected_stage)
         for i in selected_stage:
             index = (i-s)//period
-            all_test_repr[index] = self.data_provider.test_representation(i)
             low_repr[index] = self.projector.batch_project(i, all_test_repr[index])
 
         corrs = np.zeros(TEST_LEN)
@@ -906,6 +922,17 @@ class Evaluator(EvaluatorAbstractClass):
         if self.verbose:
             print("Successfully save evaluation with {:d} neighbors...".format(n_neighbors))
     
+    def save_eval(self, epochs, n_neighbors, temporal_k=5, file_name="evaluation", metrics="all", workers=1, threads_per_worker=None):
+        """
+        compute metrics for many epochs with EvalRunner, resuming an interrupted run
+        :param epochs: list of int
+        :param metrics: list of metric names or "all", see singleVis.eval.runner.METRICS
+        :param workers: int, number of worker processes
+        :return: dict, the evaluation
+        """
+        runner = EvalRunner(self, workers=workers, threads_per_worker=threads_per_worker, verbose=self.verbose)
+        return runner.run(epochs, n_neighbors, temporal_k=temporal_k, file_name=file_name, metrics=metrics)
+
     def get_eval(self, file_name="evaluation"):
         save_dir = os.path.join(self.data_provider.model_path, file_name + ".json")
         f = open(save_dir, "r")
@@ -0,0 +1,353 @@
+"""The EvalRunner class computes evaluation metrics of many epochs in parallel and resumes interrupted runs"""
+import os
+import glob
+import json
+import time
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import torch
+
+from singleVis.knn_cache import KnnCache
+
+# metric name -> (fn(evaluator, epoch, n_neighbors, temporal_k), key layout)
+# layouts, as in the evaluation json written by Evaluator.save_epoch_eval:
+#   "epoch"     evaluation[metric][epoch]
+#   "epoch_k"   evaluation[metric][epoch][n_neighbors]
+#   "epoch_tk"  evaluation[metric][epoch][temporal_k]
+#   "k"         evaluation[metric][n_neighbors], computed once over all epochs
+METRICS = OrderedDict([
+    ("train_acc", (lambda ev, e, k, tk: ev.train_acc(e), "epoch")),
+    ("test_acc", (lambda ev, e, k, tk: ev.test_acc(e), "epoch")),
+    ("nn_train", (lambda ev, e, k, tk: ev.eval_nn_train(e, k), "epoch_k")),
+    ("nn_test", (lambda ev, e, k, tk: ev.eval_nn_test(e, k), "epoch_k")),
+    ("b_train", (lambda ev, e, k, tk: ev.eval_b_train(e, k), "epoch_k")),
+    ("b_test", (lambda ev, e, k, tk: ev.eval_b_test(e, k), "epoch_k")),
+    ("ppr_train", (lambda ev, e, k, tk: ev.eval_inv_train(e), "epoch")),
+    ("ppr_test", (lambda ev, e, k, tk: ev.eval_inv_test(e), "epoch")),
+    ("ppr_dist_train", (lambda ev, e, k, tk: ev.eval_inv_dist_train(e), "epoch")),
+    ("ppr_dist_test", (lambda ev, e, k, tk: ev.eval_inv_dist_test(e), "epoch")),
+    ("tnn_train", (lambda ev, e, k, tk: ev.eval_temporal_nn_train(e, tk), "epoch_tk")),
+    ("tnn_test", (lambda ev, e, k, tk: ev.eval_temporal_nn_test(e, tk), "epoch_tk")),
+    ("tr_train", (lambda ev, e, k, tk: ev.eval_temporal_global_corr_train(e), "epoch")),
+    ("tr_test", (lambda ev, e, k, tk: ev.eval_temporal_global_corr_test(e), "epoch")),
+    ("wtr_train", (lambda ev, e, k, tk: ev.eval_temporal_weighted_global_corr_train(e), "epoch")),
+    ("wtr_test", (lambda ev, e, k, tk: ev.eval_temporal_weighted_global_corr_test(e), "epoch")),
+    ("tlr_train", (lambda ev, e, k, tk: ev.eval_temporal_local_corr_train(e, 3), "epoch")),
+    ("tlr_test", (lambda ev, e, k, tk: ev.eval_temporal_local_corr_test(e, 3), "epoch")),
+    ("temporal_train_mean", (lambda ev, e, k, tk: ev.eval_temporal_train(k)[0], "k")),
+    ("temporal_test_mean", (lambda ev, e, k, tk: ev.eval_temporal_test(k)[0], "k")),
+])
+# what save_epoch_eval computes
+DEFAULT_METRICS = ["train_acc", "test_acc"]
+# metrics that read other epochs than their own, they are stale once any epoch changed
+ACROSS_EPOCHS = {"tnn_train", "tnn_test", "tr_train", "tr_test", "wtr_train", "wtr_test", "tlr_train", "tlr_test",
+                 "temporal_train_mean", "temporal_test_mean"}
+# files of an epoch the metrics are computed from, with the visualization model
+VERSION_FILES = ["train_data.npy", "test_data.npy", "index.json", "border_centers.npy", "test_border_centers.npy", "subject_model.pth"]
+
+# state inherited by forked workers, set right before the pool is created
+_WORKER = dict()
+
+
+def _init_worker(threads):
+    if threads is not None:
+        torch.set_num_threads(threads)
+
+
+def _run_unit(epoch, metrics, n_neighbors, temporal_k):
+    runner = _WORKER["runner"]
+    return epoch, runner.run_unit(epoch, metrics, n_neighbors, temporal_k)
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (tuple, list)):
+        return [_to_json(v) for v in value]
+    return value
+
+
+class _Memo:
+    """small LRU of computed arrays, keyed by the call and a fingerprint of its array argument"""
+    def __init__(self, size):
+        self.size = size
+        self._values = OrderedDict()
+
+    def get(self, key, fn):
+        if key in self._values:
+            self._values.move_to_end(key)
+            return self._values[key]
+        value = fn()
+        self._values[key] = value
+        while len(self._values) > self.size:
+            self._values.popitem(last=False)
+        return value
+
+
+class _MemoProjector:
+    """projector whose batch_project/batch_inverse results are shared by the metrics of an epoch"""
+    def __init__(self, projector, memo):
+        self._projector = projector
+        self._memo = memo
+
+    def batch_project(self, epoch, data):
+        key = ("project", epoch, KnnCache.fingerprint(np.asarray(data)))
+        return self._memo.get(key, lambda: self._projector.batch_project(epoch, data))
+
+    def batch_inverse(self, epoch, embedding):
+        key = ("inverse", epoch, KnnCache.fingerprint(np.asarray(embedding)))
+        return self._memo.get(key, lambda: self._projector.batch_inverse(epoch, embedding))
+
+    def __getattr__(self, name):
+        return getattr(self._projector, name)
+
+
+class _MemoDataProvider:
+    """data provider whose get_pred results are shared by the metrics of an epoch"""
+    def __init__(self, data_provider, memo):
+        self._data_provider = data_provider
+        self._memo = memo
+
+    def get_pred(self, epoch, data):
+        key = ("pred", epoch, KnnCache.fingerprint(np.asarray(data)))
+        return self._memo.get(key, lambda: self._data_provider.get_pred(epoch, data))
+
+    def __getattr__(self, name):
+        return getattr(self._data_provider, name)
+
+
+class EvalRunner:
+    """
+    Schedule the (epoch, metric) tasks of an evaluation over a process pool.
+
+    The metrics of one epoch run together in one worker, which shares projections, inverse projections
+    and predictions between them. Every finished metric value is checkpointed at once to
+    Model/{file_name}/{metric}.json with the version of its inputs, the latest mtime of the epoch's
+    representations, subject model and visualization model. Tasks already stored with an up-to-date
+    version are skipped, so an interrupted run resumes where it stopped and a retrained epoch is
+    evaluated again. At the end the stores are merged into Model/{file_name}.json,
+    in the layout of Evaluator.save_epoch_eval.
+    Workers are forked (CPU devices only), with one worker or on GPU the tasks run in this process.
+
+    Args:
+        evaluator (Evaluator): evaluator whose eval_* methods compute the metrics
+        workers (int): number of worker processes
+        threads_per_worker (int): torch CPU threads of each worker, None to keep torch's default
+        memo_size (int): number of arrays kept for sharing between the metrics of an epoch
+        verbose (int): print progress
+    """
+    def __init__(self, evaluator, workers=1, threads_per_worker=None, memo_size=16, verbose=1):
+        self.evaluator = evaluator
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker
+        self.memo_size = memo_size
+        self.verbose = verbose
+        self._memo_evaluator = None
+
+    ################################################ stores ##############################################
+    def _store_dir(self, file_name):
+        return os.path.join(self.evaluator.data_provider.model_path, file_name)
+
+    def _load_store(self, file_name, metric):
+        """:return: dict, {"values": nested values, "versions": {"epoch/k": version}}"""
+        path = os.path.join(self._store_dir(file_name), "{}.json".format(metric))
+        store = dict()
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                store = json.load(f)
+        if "values" not in store or "versions" not in store:
+            # unversioned, recompute everything
+            store = {"values": dict(), "versions": dict()}
+        return store
+
+    def _save_store(self, file_name, metric, store):
+        os.makedirs(self._store_dir(file_name), exist_ok=True)
+        path = os.path.join(self._store_dir(file_name), "{}.json".format(metric))
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(store, f)
+        os.replace(tmp_path, path)
+
+    def _epoch_version(self, epoch):
+        """latest mtime of the files the metrics of epoch depend on, 0. if none exists"""
+        data_provider = self.evaluator.data_provider
+        checkpoint_path = data_provider.checkpoint_path(epoch)
+        paths = [os.path.join(checkpoint_path, name) for name in VERSION_FILES]
+        vis_model_name = getattr(self.evaluator.projector, "vis_model_name", None)
+        if vis_model_name:
+            # per epoch (DVI, Trustvis), one model (TimeVis) or one per segment (DeepDebugger)
+            paths.append(os.path.join(checkpoint_path, vis_model_name + ".pth"))
+            paths.extend(glob.glob(os.path.join(data_provider.model_path, vis_model_name + "*.pth")))
+        mtimes = [os.path.getmtime(path) for path in paths if os.path.exists(path)]
+        return max(mtimes) if len(mtimes) else 0.
+
+    @staticmethod
+    def _keys(layout, epoch, n_neighbors, temporal_k):
+        if layout == "epoch":
+            return [str(epoch)]
+        if layout == "epoch_k":
+            return [str(epoch), str(n_neighbors)]
+        if layout == "epoch_tk":
+            return [str(epoch), str(temporal_k)]
+        return [str(n_neighbors)]
+
+    @staticmethod
+    def _has(store, keys):
+        for key in keys:
+            if not isinstance(store, dict) or key not in store:
+                return False
+            store = store[key]
+        return True
+
+    @staticmethod
+    def _put(store, keys, value):
+        for key in keys[:-1]:
+            store = store.setdefault(key, dict())
+        store[keys[-1]] = value
+
+    ################################################ tasks ###############################################
+    def _evaluator_with_memo(self):
+        # one memo per process, projections of an epoch are reused by its metrics
+        if self._memo_evaluator is None:
+            memo = _Memo(self.memo_size)
+            evaluator = object.__new__(type(self.evaluator))
+            evaluator.__dict__.update(self.evaluator.__dict__)
+            evaluator.projector = _MemoProjector(self.evaluator.projector, memo)
+            evaluator.data_provider = _MemoDataProvider(self.evaluator.data_provider, memo)
+            self._memo_evaluator = evaluator
+        return self._memo_evaluator
+
+    def run_unit(self, epoch, metrics, n_neighbors, temporal_k):
+        """
+        compute metrics of one epoch (epoch None for the "k" metrics)
+        :return: dict, metric -> (value, seconds), failed metrics are left out
+        """
+        evaluator = self._evaluator_with_memo()
+        results = dict()
+        for metric in metrics:
+            fn, _ = METRICS[metric]
+            t0 = time.time()
+            try:
+                value = _to_json(fn(evaluator, epoch, n_neighbors, temporal_k))
+            except Exception as e:
+                print("Evaluation of {} for epoch {} failed: {}: {}".format(metric, epoch, type(e).__name__, e))
+                continue
+            results[metric] = (value, round(time.time() - t0, 3))
+        return results
+
+    def _parallel(self):
+        if self.workers <= 1:
+            return False
+        if torch.device(self.evaluator.data_provider.DEVICE).type != "cpu":
+            print("Evaluation on {} runs in a single process...".format(self.evaluator.data_provider.DEVICE))
+            return False
+        if "fork" not in multiprocessing.get_all_start_methods():
+            print("Process pool needs fork, evaluation runs in a single process...")
+            return False
+        return True
+
+    def _is_done(self, store, keys, version):
+        return self._has(store["values"], keys) and store["versions"].get("/".join(keys), -1.) >= version
+
+    def _units(self, epochs, metrics, n_neighbors, temporal_k, stores, version):
+        """pending metrics grouped by epoch, [(epoch, [metric, ...]), ...]"""
+        units = list()
+        for epoch in epochs:
+            pending = [m for m in metrics if METRICS[m][1] != "k" and not self._is_done(stores[m], self._keys(METRICS[m][1], epoch, n_neighbors, temporal_k), version(m, epoch))]
+            if len(pending):
+                units.append((epoch, pending))
+        pending = [m for m in metrics if METRICS[m][1] == "k" and not self._is_done(stores[m], self._keys("k", None, n_neighbors, temporal_k), version(m, None))]
+        if len(pending):
+            units.append((None, pending))
+        return units
+
+    def run(self, epochs, n_neighbors, temporal_k=5, file_name="evaluation", metrics=None):
+        """
+        :param epochs: list of int
+        :param n_neighbors: int
+        :param temporal_k: int
+        :param file_name: str, name of the evaluation json under Model/
+        :param metrics: list of metric names, "all" for every metric in METRICS, DEFAULT_METRICS by default
+        :return: dict, the merged evaluation
+        """
+        if metrics is None:
+            metrics = DEFAULT_METRICS
+        elif metrics == "all":
+            metrics = list(METRICS.keys())
+        unknown = [m for m in metrics if m not in METRICS]
+        if len(unknown):
+            raise ValueError("Unknown evaluation metrics: {}".format(unknown))
+
+        epoch_versions = {epoch: self._epoch_version(epoch) for epoch in epochs}
+        latest = max(epoch_versions.values()) if len(epoch_versions) else 0.
+
+        def version(metric, epoch):
+            if epoch is None or metric in ACROSS_EPOCHS:
+                return latest
+            return epoch_versions[epoch]
+
+        stores = {m: self._load_store(file_name, m) for m in metrics}
+        units = self._units(epochs, metrics, n_neighbors, temporal_k, stores, version)
+        if self.verbose > 0:
+            n_tasks = sum(len(u[1]) for u in units)
+            print("Evaluate {:d} tasks over {:d} epochs...".format(n_tasks, len(units)))
+
+        t0 = time.time()
+        timings = dict()
+
+        def collect(epoch, results):
+            for metric, (value, seconds) in results.items():
+                keys = self._keys(METRICS[metric][1], epoch, n_neighbors, temporal_k)
+                self._put(stores[metric]["values"], keys, value)
+                stores[metric]["versions"]["/".join(keys)] = version(metric, epoch)
+                self._save_store(file_name, metric, stores[metric])
+                timings.setdefault(metric, list()).append(seconds)
+            if self.verbose > 0:
+                print("Finish evaluation for {}...".format("Epoch {:d}".format(epoch) if epoch is not None else "all epochs"))
+
+        if len(units) and self._parallel():
+            _WORKER["runner"] = self
+            try:
+                ctx = multiprocessing.get_context("fork")
+                with ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx, initializer=_init_worker, initargs=(self.threads_per_worker,)) as executor:
+                    futures = [executor.submit(_run_unit, epoch, unit_metrics, n_neighbors, temporal_k) for epoch, unit_metrics in units]
+                    for future in as_completed(futures):
+                        collect(*future.result())
+            finally:
+                _WORKER.clear()
+        else:
+            if self.threads_per_worker is not None:
+                torch.set_num_threads(self.threads_per_worker)
+            for epoch, unit_metrics in units:
+                collect(epoch, self.run_unit(epoch, unit_metrics, n_neighbors, temporal_k))
+
+        evaluation = self.merge(file_name, metrics, stores)
+        if self.verbose > 0:
+            print("Evaluation finished in {:.3f}s, mean seconds per task: {}".format(
+                time.time() - t0, {m: round(float(np.mean(t)), 3) for m, t in timings.items()}))
+        return evaluation
+
+    def merge(self, file_name, metrics, stores):
+        """write the per-metric stores into Model/{file_name}.json, keeping other entries"""
+        save_file = os.path.join(self.evaluator.data_provider.model_path, file_name + ".json")
+        evaluation = dict()
+        if os.path.exists(save_file):
+            with open(save_file, "r") as f:
+                evaluation = json.load(f)
+        for metric in metrics:
+            merged = evaluation.setdefault(metric, dict())
+            for key, value in stores[metric]["values"].items():
+                if isinstance(value, dict) and isinstance(merged.get(key), dict):
+                    merged[key].update(value)
+                else:
+                    merged[key] = value
+        tmp_path = save_file + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(evaluation, f)
+        os.replace(tmp_path, save_file)
+        return evaluation
@@ -34,15 +34,79 @@ import numpy as np
 import math
 from sklearn.metrics import pairwise_distances
 
-class kCenterGreedy(object):
+# upper bound of a (points x centers) distance block, in bytes
+MAX_BLOCK_BYTES = 1 << 27
+
 
-  def __init__(self, X, metric='euclidean'):
-    self.features = X.reshape(len(X), -1)
+class kCenterGreedy(object):
+  """k-Center-Greedy over X.
+
+  min_distances is a float32 buffer of shape (n_obs, 1) holding the distance
+  of every point to its closest center, new centers are folded in block-wise
+  with an in-place np.minimum instead of materializing a (n_obs, n_centers)
+  distance matrix. Euclidean distances use the ||x||^2 - 2xc + ||c||^2
+  expansion with cached squared norms, on NumPy or on torch (CPU).
+
+  With centers_per_round > 1, each round takes the farthest point (radius r)
+  and then up to centers_per_round - 1 more of the farthest points whose
+  distance to every center, including those picked in the same round, is at
+  least r / 2. Selected centers are then pairwise at least R / 2 apart for
+  the final radius R, so the result stays within a factor 4 of the optimal
+  radius (2 with one center per round, identical to the original algorithm).
+  """
+
+  def __init__(self, X, metric='euclidean', backend='numpy', centers_per_round=1):
+    self.features = np.ascontiguousarray(X.reshape(len(X), -1), dtype=np.float32)
     self.name = 'kcenter'
     self.metric = metric
     self.min_distances = None
     self.n_obs = self.features.shape[0]
     self.already_selected = []
+    self.centers_per_round = max(1, int(centers_per_round))
+    self._selected = np.zeros(self.n_obs, dtype=bool)
+    self._sq_norms = None
+    self._torch_features = None
+    if backend not in ('numpy', 'torch'):
+      raise ValueError("Unknown backend {}".format(backend))
+    self.backend = backend
+    if metric == 'euclidean':
+      self._sq_norms = np.einsum('ij,ij->i', self.features, self.features)
+      if backend == 'torch':
+        import torch
+        self._torch_features = torch.from_numpy(self.features)
+
+  def _block_rows(self, n_centers):
+    return max(1, MAX_BLOCK_BYTES // (4 * max(1, n_centers)))
+
+  def _min_sq_euclidean(self, start, end, centers):
+    """min over centers of squared euclidean distance, for rows [start, end)"""
+    if self._torch_features is not None:
+      import torch
+      x = self._torch_features[start:end]
+      c = self._torch_features[torch.from_numpy(np.asarray(centers, dtype=np.int64))]
+      d = torch.addmm(torch.from_numpy(self._sq_norms[centers])[None, :], x, c.t(), alpha=-2.)
+      d = d.min(dim=1).values.numpy()
+    else:
+      d = self.features[start:end] @ self.features[centers].T
+      d *= -2.
+      d += self._sq_norms[centers][None, :]
+      d = d.min(axis=1)
+    d += self._sq_norms[start:end]
+    return np.maximum(d, 0., out=d)
+
+  def _fold_in(self, centers):
+    """min_distances = min(min_distances, distance to centers), block-wise and in place"""
+    buf = self.min_distances[:, 0]
+    for c_start in range(0, len(centers), 4096):
+      c = centers[c_start:c_start + 4096]
+      step = self._block_rows(len(c))
+      for start in range(0, self.n_obs, step):
+        end = min(start + step, self.n_obs)
+        if self._sq_norms is not None:
+          d = np.sqrt(self._min_sq_euclidean(start, end, c))
+        else:
+          d = pairwise_distances(self.features[start:end], self.features[c], metric=self.metric).min(axis=1)
+        np.minimum(buf[start:end], d, out=buf[start:end])
 
   def update_distances(self, cluster_centers, only_new=True, reset_dist=False):
     """Update min distances given cluster centers.
@@ -56,18 +120,63 @@ class kCenterGreedy(object):
 
     if reset_dist:
       self.min_distances = None
+      self._selected[:] = False
+    if cluster_centers is None:
+      return
+    cluster_centers = np.asarray(cluster_centers, dtype=np.int64).reshape(-1)
     if only_new:
-      cluster_centers = [d for d in cluster_centers
-                         if d not in self.already_selected]
-    if cluster_centers is not None:
+      cluster_centers = cluster_centers[~self._selected[cluster_centers]]
+    if self.min_distances is None:
+      self.min_distances = np.full((self.n_obs, 1), np.inf, dtype=np.float32)
+    if len(cluster_centers):
       # Update min_distances for all examples given new cluster center.
-      x = self.features[cluster_centers]
-      dist = pairwise_distances(self.features, x, metric=self.metric)
+      self._fold_in(cluster_centers)
+      self._selected[cluster_centers] = True
+
+  def _next_round(self, remaining, r_min):
+    """centers of the next round, at most remaining of them, every one farther than r_min from the centers"""
+    buf = self.min_distances[:, 0]
+    ind = int(np.argmax(buf))
+    r_cover = buf[ind]
+    if r_cover < r_min:
+      return [], r_cover
+    m = min(self.centers_per_round, remaining)
+    if m == 1:
+      return [ind], r_cover
+    # candidates, farthest first
+    cand = np.argpartition(-buf, min(m, self.n_obs) - 1)[:m]
+    cand = cand[np.argsort(-buf[cand], kind='stable')]
+    cand = cand[buf[cand] >= max(r_cover / 2., r_min)]
+    if cand[0] != ind:
+      cand = np.concatenate(([ind], cand[cand != ind]))
+    dist = pairwise_distances(self.features[cand], metric=self.metric)
+    picked = [0]
+    for j in range(1, len(cand)):
+      if dist[j, picked].min() >= r_cover / 2.:
+        picked.append(j)
+    return cand[picked].tolist(), r_cover
+
+  def _select(self, already_selected, budgets=None, r_min=0.):
+    print('Calculating distances...')
+    t0 = time.time()
+    self.update_distances(already_selected, only_new=False, reset_dist=True)
+    t1 = time.time()
+    print("calculating distances for {:d} points within {:.2f} seconds...".format(len(already_selected), t1 - t0))
+
+    new_batch = []
+    r_cover = self.hausdorff()
+    while budgets is None or len(new_batch) < budgets:
+      remaining = self.n_obs if budgets is None else budgets - len(new_batch)
+      inds, r_cover = self._next_round(remaining, r_min)
+      if not len(inds):
+        break
+      # New examples should not be in already selected since those points
+      # should have min_distance of zero to a cluster center.
+      assert not self._selected[inds].any()
 
-      if self.min_distances is None:
-        self.min_distances = np.min(dist, axis=1).reshape(-1,1)
-      else:
-        self.min_distances = np.minimum(self.min_distances, dist)
+      self.update_distances(inds, only_new=False, reset_dist=False)
+      new_batch.extend(inds)
+    return new_batch, r_cover
 
   def select_batch_with_budgets(self, already_selected, budgets, return_min=False):
     """
@@ -81,31 +190,15 @@ class kCenterGreedy(object):
     Returns:
       indices of points selected to minimize distance to cluster centers
     """
-
-    print('Calculating distances...')
-    t0 = time.time()
-    self.update_distances(already_selected, only_new=False, reset_dist=True)
-    t1 = time.time()
-    print("calculating distances for {:d} points within {:.2f} seconds...".format(len(already_selected), t1 - t0))
-
-    new_batch = []
-
-    for _ in range(budgets):
-      ind = np.argmax(self.min_distances)
-      # New examples should not be in already selected since those points
-      # should have min_distance of zero to a cluster center.
-      assert ind not in already_selected
-
-      self.update_distances([ind], only_new=True, reset_dist=False)
-      new_batch.append(ind)
+    new_batch, _ = self._select(already_selected, budgets=budgets)
     print('Hausdorff distance is {:.2f} with {:d} points'.format(self.min_distances.max(), len(already_selected)+len(new_batch)))
-    
-    self.already_selected = np.concatenate((already_selected, np.array(new_batch)))
+
+    self.already_selected = np.concatenate((already_selected, np.array(new_batch, dtype=np.int64)))
 
     if return_min:
       return new_batch, self.min_distances.max()
     return new_batch
-  
+
   def covering_perc(self, p):
     """given a dist, return the covering percentage"""
     sorted = np.sort(self.min_distances.reshape(-1))
@@ -127,32 +220,12 @@ class kCenterGreedy(object):
     Returns:
       indices of points selected to minimize distance to cluster centers
     """
+    # stop once r_cover/c_c0/d_d0 < r_max
+    new_batch, r_cover = self._select(already_selected, r_min=r_max*c_c0*d_d0)
 
-    print('Calculating distances...')
-    t0 = time.time()
-    self.update_distances(already_selected, only_new=False, reset_dist=True)
-    t1 = time.time()
-    print("calculating distances for {:d} points within {:.2f} seconds...".format(len(already_selected), t1 - t0))
-
-    new_batch = []
-    while True:
-      ind = np.argmax(self.min_distances)
-      r_cover = self.min_distances[ind][0]
-      if r_cover/c_c0/d_d0 < r_max:
-        break
-      # New examples should not be in already selected since those points
-      # should have min_distance of zero to a cluster center.
-      assert ind not in already_selected
-
-      self.update_distances([ind], only_new=True, reset_dist=False)
-      new_batch.append(ind)
-
-      # sorted = np.sort(self.min_distances.reshape(-1))
-      # r_cover = sorted[int(self.n_obs*p)-1]
-      
     print('Hausdorff distance is {:.2f} with {:d} points'.format(r_cover, len(already_selected)+len(new_batch)))
-    
-    self.already_selected = np.concatenate((already_selected, np.array(new_batch)))
+
+    self.already_selected = np.concatenate((already_selected, np.array(new_batch, dtype=np.int64)))
 
     if return_min:
       return new_batch, self.min_distances.max()
@@ -0,0 +1,155 @@
+"""The KnnCache class keeps the kNN graphs of an epoch's representations, shared by edge construction and evaluation"""
+import os
+import json
+import zlib
+import threading
+
+import numpy as np
+from pynndescent import NNDescent
+from sklearn.neighbors import NearestNeighbors
+
+
+class KnnCache:
+    """
+    kNN graphs keyed by (epoch, split, k, metric), computed once.
+
+    Layout under Epoch_N/knn/:
+        {split}_{metric}_k{k}.npz   indices int64 and dists float32, (n_queries, k)
+        {split}_{metric}_k{k}.json  {"k", "n", "fingerprint"}
+    A graph over data is built with NNDescent, a graph from query rows to data (e.g. train samples to
+    border centers) with exact NearestNeighbors, with the same parameters the callers used before.
+    fingerprint is the shape and a crc32 of every row of the data, a graph is rebuilt when the
+    data behind the key changed. A graph with more neighbours also serves smaller k.
+    """
+    def __init__(self, data_provider, max_in_memory=8):
+        self.data_provider = data_provider
+        self.max_in_memory = max_in_memory
+        self._graphs = dict()
+        self._lock = threading.Lock()
+
+    def cache_dir(self, epoch):
+        return os.path.join(self.data_provider.checkpoint_path(epoch), "knn")
+
+    def _path(self, epoch, split, k, metric):
+        return os.path.join(self.cache_dir(epoch), "{}_{}_k{}".format(split, metric, k))
+
+    @classmethod
+    def fingerprint(cls, data, query=None):
+        parts = list()
+        for arr in (data, query):
+            if arr is None:
+                continue
+            # the whole buffer, without a copy, a change in any row invalidates the key
+            arr = np.ascontiguousarray(arr)
+            parts.append("{}:{:08x}".format("x".join(map(str, arr.shape)), zlib.crc32(memoryview(arr).cast("B"))))
+        return "|".join(parts)
+
+    ################################################ build ###############################################
+    @staticmethod
+    def build(data, k, metric="euclidean", query=None):
+        """:return: (indices, dists), numpy.ndarray of shape (n_queries, k)"""
+        if query is not None:
+            neigh = NearestNeighbors(n_neighbors=k, radius=0.4, metric=metric)
+            neigh.fit(data)
+            dists, indices = neigh.kneighbors(query, n_neighbors=k, return_distance=True)
+            return indices, dists
+        # number of trees in random projection forest
+        n_trees = min(64, 5 + int(round((data.shape[0]) ** 0.5 / 20.0)))
+        # max number of nearest neighbor iters to perform
+        n_iters = max(5, int(round(np.log2(data.shape[0]))))
+        nnd = NNDescent(
+            data,
+            n_neighbors=k,
+            metric=metric,
+            n_trees=n_trees,
+            n_iters=n_iters,
+            max_candidates=60,
+            verbose=True
+        )
+        return nnd.neighbor_graph
+
+    ################################################ api #################################################
+    def _candidates(self, epoch, split, k, metric):
+        """persisted graphs of the key with at least k neighbours, smallest first"""
+        cache_dir = self.cache_dir(epoch)
+        if not os.path.isdir(cache_dir):
+            return list()
+        prefix = "{}_{}_k".format(split, metric)
+        ks = list()
+        for f in os.listdir(cache_dir):
+            if f.startswith(prefix) and f.endswith(".json") and f[len(prefix):-5].isdigit():
+                ks.append(int(f[len(prefix):-5]))
+        return sorted(kk for kk in ks if kk >= k)
+
+    def _load(self, epoch, split, k, metric, fingerprint):
+        path = self._path(epoch, split, k, metric)
+        with self._lock:
+            entry = self._graphs.get(path)
+        if entry is not None and entry[0] == fingerprint:
+            return entry[1]
+        try:
+            with open(path + ".json", "r") as f:
+                meta = json.load(f)
+            if meta["fingerprint"] != fingerprint:
+                return None
+            with np.load(path + ".npz") as f:
+                graph = (f["indices"], f["dists"])
+        except (OSError, ValueError, KeyError):
+            return None
+        self._remember(path, fingerprint, graph)
+        return graph
+
+    def _remember(self, path, fingerprint, graph):
+        with self._lock:
+            self._graphs.pop(path, None)
+            self._graphs[path] = (fingerprint, graph)
+            while len(self._graphs) > self.max_in_memory:
+                self._graphs.pop(next(iter(self._graphs)))
+
+    def _save(self, epoch, split, k, metric, fingerprint, graph):
+        path = self._path(epoch, split, k, metric)
+        os.makedirs(self.cache_dir(epoch), exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, indices=graph[0], dists=graph[1])
+        os.replace(tmp_path, path + ".npz")
+        with open(path + ".json.tmp", "w") as f:
+            json.dump({"k": k, "n": int(len(graph[0])), "fingerprint": fingerprint}, f)
+        os.replace(path + ".json.tmp", path + ".json")
+        self._remember(path, fingerprint, graph)
+
+    def get(self, epoch, split, data, k, metric="euclidean", query=None):
+        """
+        :param epoch: int
+        :param split: str, names the data, e.g. "train", "all" (train followed by test) or "train_border"
+        :param data: numpy.ndarray, (n, dim) points the neighbours are taken from
+        :param k: int, number of neighbours
+        :param metric: str
+        :param query: numpy.ndarray or None, rows to find neighbours for, data itself by default
+        :return: (indices, dists), numpy.ndarray of shape (n_queries, k)
+        """
+        data = np.asarray(data).reshape(len(data), -1)
+        if query is not None:
+            query = np.asarray(query).reshape(len(query), -1)
+        fingerprint = self.fingerprint(data, query)
+        for kk in self._candidates(epoch, split, k, metric):
+            graph = self._load(epoch, split, kk, metric, fingerprint)
+            if graph is not None:
+                return graph[0][:, :k], graph[1][:, :k]
+        indices, dists = self.build(data, k, metric=metric, query=query)
+        graph = (np.asarray(indices, dtype=np.int64), np.asarray(dists, dtype=np.float32))
+        self._save(epoch, split, k, metric, fingerprint, graph)
+        return graph
+
+
+def knn_overlap(a, b):
+    """
+    number of common neighbours of each pair of rows of two kNN index matrices,
+    len(np.intersect1d(a[i], b[i])) for every i in O(n k log k) array operations
+    :param a: numpy.ndarray, (n, k1) neighbour indices, distinct within a row
+    :param b: numpy.ndarray, (n, k2) neighbour indices, distinct within a row
+    :return: numpy.ndarray, int (n,)
+    """
+    both = np.concatenate((np.asarray(a, dtype=np.int64), np.asarray(b, dtype=np.int64)), axis=1)
+    both.sort(axis=1)
+    # a shared neighbour shows up as two equal entries next to each other
+    return np.count_nonzero(both[:, 1:] == both[:, :-1], axis=1)
@@ -0,0 +1,256 @@
+"""The PredicateIndex class answers point filters of an epoch with packed bitmaps"""
+import os
+import json
+
+import numpy as np
+
+# bits set in each byte value, for counting without unpacking
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class Bitmap:
+    """a set of sample indices in [0, n) stored as np.packbits bits"""
+    __slots__ = ("bits", "n")
+
+    def __init__(self, bits, n):
+        self.bits = bits
+        self.n = n
+
+    @classmethod
+    def from_mask(cls, mask):
+        return cls(np.packbits(np.asarray(mask, dtype=bool)), len(mask))
+
+    @classmethod
+    def from_indices(cls, indices, n):
+        mask = np.zeros(n, dtype=bool)
+        mask[np.asarray(indices, dtype=np.int64)] = True
+        return cls.from_mask(mask)
+
+    @classmethod
+    def full(cls, n):
+        return ~cls.empty(n)
+
+    @classmethod
+    def empty(cls, n):
+        return cls(np.zeros((n + 7) // 8, dtype=np.uint8), n)
+
+    def __and__(self, other):
+        return Bitmap(self.bits & other.bits, self.n)
+
+    def __or__(self, other):
+        return Bitmap(self.bits | other.bits, self.n)
+
+    def __sub__(self, other):
+        return Bitmap(self.bits & ~other.bits, self.n)
+
+    def __invert__(self):
+        bits = ~self.bits
+        if self.n % 8:
+            # clear the padding bits of the last byte
+            bits[-1] &= np.uint8((0xFF << (8 - self.n % 8)) & 0xFF)
+        return Bitmap(bits, self.n)
+
+    def count(self):
+        return int(_POPCOUNT[self.bits].sum())
+
+    def mask(self):
+        return np.unpackbits(self.bits, count=self.n).astype(bool)
+
+    def indices(self):
+        return np.flatnonzero(np.unpackbits(self.bits, count=self.n))
+
+
+class PredicateIndex:
+    """
+    Per-epoch column index over all train and test samples (train rows first).
+
+    Columns with few values are kept as one bitmap per value:
+        label       ground truth class
+        split       "train" or "test"
+        labelled    whether a training sample is in index.json
+        pred        predicted class, -1 for samples without a prediction
+        conf_bin    confidence in n_bins equal-width bins, for range queries
+        boundary    whether the sample lies on the delta-boundary of the subject model
+    The exact confidence is kept too, so only the two edge bins of a range are checked value by value.
+
+    Predicates are dicts, {"label": "cat", "type": "train", "confidence": [0.2, 0.6]}.
+    Keys of one dict are AND-ed, a list value is OR-ed ({"label": ["cat", "dog"]}),
+    and {"and": [...]}, {"or": [...]}, {"not": {...}} nest.
+    """
+    COLUMNS = ["label", "split", "labelled", "pred", "conf_bin", "boundary"]
+
+    def __init__(self, bitmaps, confidence, n, classes, n_bins=20):
+        self.bitmaps = bitmaps
+        self.confidence = confidence
+        self.n = n
+        self.classes = list(classes)
+        self.n_bins = n_bins
+
+    @classmethod
+    def build(cls, labels, train_num, labelled_idx, predictions, classes, n_bins=20):
+        """
+        :param labels: numpy.ndarray, (train_num + test_num,) ground truth classes
+        :param train_num: int
+        :param labelled_idx: array-like, indices of labelled training samples
+        :param predictions: dict, see DataProvider.epoch_predictions
+        :param classes: list of class names
+        :param n_bins: int, number of confidence bins
+        """
+        labels = np.asarray(labels)
+        n = len(labels)
+        labelled_idx = np.asarray(labelled_idx, dtype=np.int64)
+
+        # the prediction rows cover the labelled training samples followed by the test samples
+        pred = np.full(n, -1, dtype=np.int64)
+        confidence = np.full(n, np.nan, dtype=np.float32)
+        boundary = np.zeros(n, dtype=bool)
+        rows = np.arange(n) if len(predictions["pred"]) == n else np.concatenate((labelled_idx, np.arange(train_num, n)))
+        pred[rows] = predictions["pred"]
+        confidence[rows] = predictions["confidence"]
+        top = np.asarray(predictions["topk_val"], dtype=np.float32)
+        logits = np.asarray(predictions["logits"], dtype=np.float32)
+        if top.shape[1] > 1:
+            # delta-boundary as in singleVis.utils.is_B, with the cached top-2 scores
+            span = top[:, 0] - logits.min(axis=1)
+            boundary[rows] = (top[:, 0] - top[:, 1]) < 0.1 * np.maximum(span, 1e-8)
+
+        split = np.zeros(n, dtype=np.int64)
+        split[train_num:] = 1
+        labelled = np.zeros(n, dtype=np.int64)
+        labelled[labelled_idx] = 1
+        conf_bin = np.where(np.isnan(confidence), -1, np.minimum((np.nan_to_num(confidence) * n_bins).astype(np.int64), n_bins - 1))
+
+        columns = {"label": labels, "split": split, "labelled": labelled, "pred": pred, "conf_bin": conf_bin, "boundary": boundary.astype(np.int64)}
+        bitmaps = dict()
+        for name, values in columns.items():
+            bitmaps[name] = {int(v): Bitmap.from_mask(values == v) for v in np.unique(values)}
+        return cls(bitmaps, confidence, n, classes, n_bins=n_bins)
+
+    ############################################## persistence ###########################################
+    def save(self, path, version):
+        arrays = {"confidence": self.confidence}
+        for name, values in self.bitmaps.items():
+            for v, bitmap in values.items():
+                arrays["{}:{}".format(name, v)] = bitmap.bits
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+        meta = {"n": self.n, "classes": self.classes, "n_bins": self.n_bins, "version": version}
+        with open(path + ".json.tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(path + ".json.tmp", path + ".json")
+
+    @classmethod
+    def load(cls, path, version):
+        """:return: PredicateIndex, or None if there is no index as new as version"""
+        if not (os.path.exists(path) and os.path.exists(path + ".json")):
+            return None
+        with open(path + ".json", "r") as f:
+            meta = json.load(f)
+        if meta["version"] < version:
+            return None
+        bitmaps = {name: dict() for name in cls.COLUMNS}
+        with np.load(path) as f:
+            confidence = f["confidence"]
+            for key in f.files:
+                if ":" in key:
+                    name, v = key.split(":")
+                    bitmaps[name][int(v)] = Bitmap(f[key], meta["n"])
+        return cls(bitmaps, confidence, meta["n"], meta["classes"], n_bins=meta["n_bins"])
+
+    ################################################ query ###############################################
+    def eq(self, column, value):
+        bitmap = self.bitmaps[column].get(int(value))
+        return bitmap if bitmap is not None else Bitmap.empty(self.n)
+
+    def isin(self, column, values):
+        result = Bitmap.empty(self.n)
+        for value in values:
+            result = result | self.eq(column, value)
+        return result
+
+    def conf_range(self, lo, hi):
+        """samples with lo <= confidence <= hi"""
+        lo_bin = max(int(np.floor(lo * self.n_bins)), 0)
+        hi_bin = min(int(np.floor(hi * self.n_bins)), self.n_bins - 1)
+        if lo_bin > hi_bin:
+            return Bitmap.empty(self.n)
+        # bins strictly inside the range need no check, the edge bins are checked against the values
+        result = self.isin("conf_bin", range(lo_bin + 1, hi_bin))
+        edges = self.isin("conf_bin", {lo_bin, hi_bin})
+        idx = edges.indices()
+        conf = self.confidence[idx]
+        return result | Bitmap.from_indices(idx[(conf >= lo) & (conf <= hi)], self.n)
+
+    def _class_index(self, name):
+        return self.classes.index(name) if name in self.classes else -1
+
+    def _type(self, value):
+        if value == "train":
+            return self.eq("labelled", 1)
+        if value == "test":
+            return self.eq("split", 1)
+        if value == "unlabel":
+            return self.eq("split", 0) - self.eq("labelled", 1)
+        return Bitmap.full(self.n)
+
+    def _leaf(self, key, value):
+        if key == "confidence":
+            return self.conf_range(float(value[0]), float(value[1]))
+        if isinstance(value, (list, tuple)):
+            result = Bitmap.empty(self.n)
+            for v in value:
+                result = result | self._leaf(key, v)
+            return result
+        if key == "label":
+            return self.eq("label", self._class_index(value))
+        if key == "pred":
+            return self.eq("pred", self._class_index(value))
+        if key == "type":
+            return self._type(value)
+        if key == "boundary":
+            return self.eq("boundary", int(bool(value)))
+        # unknown predicates do not filter, as before
+        return Bitmap.full(self.n)
+
+    def query(self, predicates):
+        """
+        :param predicates: dict, see class docstring
+        :return: Bitmap
+        """
+        result = Bitmap.full(self.n)
+        for key, value in predicates.items():
+            if key == "and":
+                for p in value:
+                    result = result & self.query(p)
+            elif key == "or":
+                any_of = Bitmap.empty(self.n)
+                for p in value:
+                    any_of = any_of | self.query(p)
+                result = result & any_of
+            elif key == "not":
+                result = result - self.query(value)
+            else:
+                result = result & self._leaf(key, value)
+        return result
+
+
+_indices = dict()
+
+
+def load_predicate_index(path, version, build_fn):
+    """
+    PredicateIndex at path, kept in process, rebuilt with build_fn() and saved when older than version
+    :param path: str, location of the .npz file
+    :param version: float, latest mtime of the files the index is built from
+    :param build_fn: callable returning a PredicateIndex
+    """
+    entry = _indices.get(path)
+    if entry is not None and entry[0] >= version:
+        return entry[1]
+    index = PredicateIndex.load(path, version)
+    if index is None:
+        index = build_fn()
+        index.save(path, version)
+    _indices[path] = (version, index)
+    return index
@@ -0,0 +1,108 @@
+"""The PredictionCache class keeps the subject model predictions of an epoch as memory-mapped arrays"""
+import os
+import json
+import threading
+
+import numpy as np
+from scipy.special import softmax
+
+
+class PredictionCache:
+    """
+    Predictions of all samples (train rows first, then test rows) of an epoch, computed once.
+
+    Layout under Epoch_N/predictions/:
+        logits.npy      float16, (N, n_classes), raw prediction scores
+        pred.npy        int32, (N,), argmax class
+        confidence.npy  float32, (N,), max softmax probability
+        topk_idx.npy    int32, (N, k), classes with the highest scores, best first
+        topk_val.npy    float32, (N, k), their raw scores
+        meta.json       {"k", "n", "version"}
+    version is the latest mtime of the checkpoint and representation files of the epoch,
+    the artifact is recomputed once any of them is newer.
+    """
+    FILES = ["logits", "pred", "confidence", "topk_idx", "topk_val"]
+    SOURCES = ["subject_model.pth", "train_data.npy", "test_data.npy", "index.json", "test_index.json"]
+
+    def __init__(self, data_provider, k=3):
+        self.data_provider = data_provider
+        self.k = k
+        self._lock = threading.Lock()
+
+    def cache_dir(self, epoch):
+        return os.path.join(self.data_provider.checkpoint_path(epoch), "predictions")
+
+    def _version(self, epoch):
+        checkpoint_path = self.data_provider.checkpoint_path(epoch)
+        mtimes = [0.]
+        for name in self.SOURCES:
+            path = os.path.join(checkpoint_path, name)
+            if os.path.exists(path):
+                mtimes.append(os.path.getmtime(path))
+        return max(mtimes)
+
+    def _meta(self, epoch):
+        meta_path = os.path.join(self.cache_dir(epoch), "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r") as f:
+            return json.load(f)
+
+    def is_valid(self, epoch):
+        meta = self._meta(epoch)
+        return meta is not None and meta["k"] >= self.k and meta["version"] >= self._version(epoch)
+
+    def get(self, epoch):
+        """
+        :param epoch: int
+        :return: dict, name -> memory-mapped numpy.ndarray, see FILES
+        """
+        with self._lock:
+            if not self.is_valid(epoch):
+                self.compute(epoch)
+        store = self.data_provider.store
+        return {name: store.load(os.path.join(self.cache_dir(epoch), "{}.npy".format(name))) for name in self.FILES}
+
+    def compute(self, epoch):
+        version = self._version(epoch)
+        data = self.data_provider._prediction_data(epoch)
+        logits = self.data_provider.get_pred(epoch, data)
+        arrays = topk_predictions(logits, self.k)
+
+        cache_dir = self.cache_dir(epoch)
+        os.makedirs(cache_dir, exist_ok=True)
+        for name in self.FILES:
+            self.data_provider.store.save(os.path.join(cache_dir, "{}.npy".format(name)), arrays[name])
+        meta_path = os.path.join(cache_dir, "meta.json")
+        tmp_path = meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"k": self.k, "n": int(len(logits)), "version": version}, f)
+        os.replace(tmp_path, meta_path)
+        if self.data_provider.verbose:
+            print("Finish caching predictions of {:d} samples for {}...".format(len(logits), epoch))
+
+
+def topk_predictions(logits, k=3):
+    """
+    argmax, confidence and top-k classes of a batch of prediction scores
+    :param logits: numpy.ndarray, (N, n_classes)
+    :param k: int
+    :return: dict with the arrays of PredictionCache.FILES
+    """
+    logits = np.asarray(logits, dtype=np.float32)
+    k = min(k, logits.shape[1])
+    rows = np.arange(len(logits))[:, None]
+    if k < logits.shape[1]:
+        topk_idx = np.argpartition(logits, -k, axis=1)[:, -k:]
+    else:
+        topk_idx = np.tile(np.arange(k), (len(logits), 1))
+    # order the k candidates by score, best first
+    order = np.argsort(-logits[rows, topk_idx], axis=1, kind="stable")
+    topk_idx = topk_idx[rows, order]
+    return {
+        "logits": logits.astype(np.float16),
+        "pred": logits.argmax(axis=1).astype(np.int32),
+        "confidence": softmax(logits, axis=1).max(axis=1).astype(np.float32),
+        "topk_idx": topk_idx.astype(np.int32),
+        "topk_val": logits[rows, topk_idx],
+    }
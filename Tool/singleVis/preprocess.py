@@ -0,0 +1,168 @@
+"""The PreprocessPipeline class runs the per-epoch preprocessing of a NormalDataProvider in parallel"""
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+# state inherited by forked workers, set right before the pool is created
+_WORKER = dict()
+
+
+def _init_worker(threads):
+    if threads is not None:
+        torch.set_num_threads(threads)
+    # forked workers inherit the parent's random state, border sampling has to differ between them
+    np.random.seed()
+    torch.seed()
+
+
+def _run_epoch(stage, n_epoch, num, l_bound):
+    pipeline = _WORKER["pipeline"]
+    return n_epoch, pipeline.run_epoch(stage, n_epoch, num, l_bound)
+
+
+class PreprocessPipeline:
+    """
+    Fan the epochs of _meta_data and _estimate_boundary out over a process pool.
+
+    Workers are forked after the training/testing tensors are loaded, so they share the parent's copy.
+    With a single worker (or a GPU device, or a platform without fork) epochs run in this process and
+    the next checkpoint is read in a background thread while the current epoch is being inferred.
+    Epochs whose outputs are newer than their subject_model.pth can be skipped.
+    Per-stage timings are merged into Model/time.json under "preprocess".
+
+    Args:
+        data_provider (NormalDataProvider): provider whose epochs are preprocessed
+        workers (int): number of worker processes
+        threads_per_worker (int): torch CPU threads of each worker, None to keep torch's default
+        skip_existing (bool): skip epochs whose outputs are already up to date
+        verbose (int): print progress
+    """
+    META_OUTPUTS = ["train_data.npy", "test_data.npy"]
+    BORDER_OUTPUTS = ["border_centers.npy", "test_border_centers.npy"]
+
+    def __init__(self, data_provider, workers=1, threads_per_worker=None, skip_existing=False, verbose=1):
+        self.data_provider = data_provider
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker
+        self.skip_existing = skip_existing
+        self.verbose = verbose
+        self.training_data = None
+        self.testing_data = None
+
+    def _epoch_dir(self, n_epoch):
+        dp = self.data_provider
+        return os.path.join(dp.model_path, "{}_{:d}".format(dp.epoch_name, n_epoch))
+
+    def _model_location(self, n_epoch):
+        return os.path.join(self._epoch_dir(n_epoch), "subject_model.pth")
+
+    def is_done(self, stage, n_epoch):
+        """whether the outputs of stage exist and are newer than the checkpoint"""
+        outputs = self.META_OUTPUTS if stage == "meta_data" else self.BORDER_OUTPUTS
+        model_mtime = os.path.getmtime(self._model_location(n_epoch))
+        for name in outputs:
+            path = os.path.join(self._epoch_dir(n_epoch), name)
+            if not os.path.exists(path) or os.path.getmtime(path) < model_mtime:
+                return False
+        return True
+
+    def run_epoch(self, stage, n_epoch, num=None, l_bound=None):
+        if stage == "meta_data":
+            return self.data_provider._meta_data_epoch(n_epoch, self.training_data, self.testing_data)
+        return self.data_provider._estimate_boundary_epoch(n_epoch, self.training_data, num, l_bound)
+
+    def _parallel(self):
+        if self.workers <= 1:
+            return False
+        if torch.device(self.data_provider.DEVICE).type != "cpu":
+            print("Preprocessing on {} runs in a single process...".format(self.data_provider.DEVICE))
+            return False
+        if "fork" not in multiprocessing.get_all_start_methods():
+            print("Process pool needs fork, preprocessing runs in a single process...")
+            return False
+        return True
+
+    def _run_serial(self, stage, epochs, num, l_bound):
+        timings = dict()
+        dp = self.data_provider
+        with ThreadPoolExecutor(max_workers=1) as prefetcher:
+            for i, n_epoch in enumerate(epochs):
+                # overlap reading the next checkpoint with the current epoch
+                if i + 1 < len(epochs):
+                    prefetcher.submit(dp.prefetch_subject_model, self._model_location(epochs[i + 1]))
+                timings[n_epoch] = self.run_epoch(stage, n_epoch, num, l_bound)
+                if self.verbose > 0:
+                    print("Finish {} for Epoch {:d}...".format(stage, n_epoch))
+        return timings
+
+    def _run_parallel(self, stage, epochs, num, l_bound):
+        timings = dict()
+        _WORKER["pipeline"] = self
+        try:
+            ctx = multiprocessing.get_context("fork")
+            with ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx, initializer=_init_worker, initargs=(self.threads_per_worker,)) as executor:
+                futures = [executor.submit(_run_epoch, stage, n_epoch, num, l_bound) for n_epoch in epochs]
+                for future in futures:
+                    n_epoch, timing = future.result()
+                    timings[n_epoch] = timing
+                    if self.verbose > 0:
+                        print("Finish {} for Epoch {:d}...".format(stage, n_epoch))
+        finally:
+            _WORKER.clear()
+        # outputs were written by other processes
+        self.data_provider.store.invalidate()
+        return timings
+
+    def _run_stage(self, stage, num=None, l_bound=None):
+        dp = self.data_provider
+        epochs = list(range(dp.s, dp.e + 1, dp.p))
+        if self.skip_existing:
+            skipped = [n_epoch for n_epoch in epochs if self.is_done(stage, n_epoch)]
+            epochs = [n_epoch for n_epoch in epochs if n_epoch not in skipped]
+            if self.verbose > 0 and len(skipped):
+                print("Skip {} for {:d} epochs with up-to-date outputs...".format(stage, len(skipped)))
+        t0 = time.time()
+        if len(epochs) == 0:
+            timings = dict()
+        elif self._parallel():
+            timings = self._run_parallel(stage, epochs, num, l_bound)
+        else:
+            timings = self._run_serial(stage, epochs, num, l_bound)
+        wall = time.time() - t0
+
+        record = {"wall": round(wall, 3), "epochs": len(epochs)}
+        if len(timings):
+            for key in next(iter(timings.values())).keys():
+                record[key] = round(float(np.mean([t[key] for t in timings.values()])), 3)
+        return epochs, record
+
+    def run(self, num, l_bound):
+        dp = self.data_provider
+        self.training_data = dp._load_training_data()
+        self.testing_data = dp._load_testing_data()
+        if self.threads_per_worker is not None and not self._parallel():
+            torch.set_num_threads(self.threads_per_worker)
+
+        meta_epochs, meta_record = self._run_stage("meta_data")
+        if dp.consolidate:
+            for n_epoch in meta_epochs:
+                dp._consolidate_epoch(n_epoch)
+            dp.train_store.close()
+            dp.test_store.close()
+        border_epochs, border_record = self._run_stage("estimate_boundary", num, l_bound)
+
+        # keep the keys of the serial implementation, per-stage details under "preprocess"
+        values = {"preprocess": {"workers": self.workers, "meta_data": meta_record, "estimate_boundary": border_record}}
+        if len(meta_epochs):
+            values["data_inference"] = round(meta_record["load_checkpoint"] + meta_record["inference"], 3)
+        if len(border_epochs):
+            values["data_B_gene"] = border_record["border_gen"]
+        dp.record_time(values)
+
+        self.training_data = None
+        self.testing_data = None
+        return values
@@ -2,6 +2,7 @@
 from abc import ABC, abstractmethod
 import os
 import json
+import threading
 import numpy as np
 import torch
 
@@ -37,29 +38,35 @@ class Projector(ProjectorAbstractClass):
         self.content_path = content_path
         self.vis_model_name = vis_model_name
         self.DEVICE = device
+        # held while a model is loaded and used, a shared projector serves concurrent requests
+        self.lock = threading.RLock()
     
     def load(self, iteration):
         raise NotImplementedError
     
     def batch_project(self, iteration, data):
-        self.load(iteration)
-        embedding = self.vis_model.encoder(torch.from_numpy(data).to(dtype=torch.float32, device=self.DEVICE)).cpu().detach().numpy()
-        return embedding
+        with self.lock:
+            self.load(iteration)
+            embedding = self.vis_model.encoder(torch.from_numpy(data).to(dtype=torch.float32, device=self.DEVICE)).cpu().detach().numpy()
+            return embedding
     
     def individual_project(self, iteration, data):
-        self.load(iteration)
-        embedding = self.vis_model.encoder(torch.from_numpy(np.expand_dims(data, axis=0)).to(dtype=torch.float32, device=self.DEVICE)).cpu().detach().numpy()
-        return embedding.squeeze(axis=0)
+        with self.lock:
+            self.load(iteration)
+            embedding = self.vis_model.encoder(torch.from_numpy(np.expand_dims(data, axis=0)).to(dtype=torch.float32, device=self.DEVICE)).cpu().detach().numpy()
+            return embedding.squeeze(axis=0)
     
     def batch_inverse(self, iteration, embedding):
-        self.load(iteration)
-        data = self.vis_model.decoder(torch.from_numpy(embedding).to(dtype=torch.float32, device=self.DEVICE)).cpu().detach().numpy()
-        return data
+        with self.lock:
+            self.load(iteration)
+            data = self.vis_model.decoder(torch.from_numpy(embedding).to(dtype=torch.float32, device=self.DEVICE)).cpu().detach().numpy()
+            return data
     
     def individual_inverse(self, iteration, embedding):
-        self.load(iteration)
-        data = self.vis_model.decoder(torch.from_numpy(np.expand_dims(embedding, axis=0)).to(dtype=torch.float32, device="cpu")).cpu().detach().numpy()
-        return data.squeeze(axis=0)
+        with self.lock:
+            self.load(iteration)
+            data = self.vis_model.decoder(torch.from_numpy(np.expand_dims(embedding, axis=0)).to(dtype=torch.float32, device="cpu")).cpu().detach().numpy()
+            return data.squeeze(axis=0)
     
 class DeepDebuggerProjector(Projector):
     def __init__(self, vis_model, content_path, vis_model_name, segments, device):
@@ -141,24 +148,28 @@ class DenseALProjector(DeepDebuggerProjector):
         print("Successfully load the visualization model in iteration {} for range ({},{}]...".format(iteration, s,e))
     
     def batch_project(self, iteration, epoch, data):
-        self.load(iteration, epoch)
-        embedding = self.vis_model.encoder(torch.from_numpy(data).to(dtype=torch.float32, device=self.DEVICE)).cpu().detach().numpy()
-        return embedding
+        with self.lock:
+            self.load(iteration, epoch)
+            embedding = self.vis_model.encoder(torch.from_numpy(data).to(dtype=torch.float32, device=self.DEVICE)).cpu().detach().numpy()
+            return embedding
     
     def individual_project(self, iteration, epoch, data):
-        self.load(iteration, epoch)
-        embedding = self.vis_model.encoder(torch.from_numpy(np.expand_dims(data, axis=0)).to(dtype=torch.float32, device=self.DEVICE)).cpu().detach().numpy()
-        return embedding.squeeze(axis=0)
+        with self.lock:
+            self.load(iteration, epoch)
+            embedding = self.vis_model.encoder(torch.from_numpy(np.expand_dims(data, axis=0)).to(dtype=torch.float32, device=self.DEVICE)).cpu().detach().numpy()
+            return embedding.squeeze(axis=0)
     
     def batch_inverse(self, iteration, epoch, embedding):
-        self.load(iteration, epoch)
-        data = self.vis_model.decoder(torch.from_numpy(embedding).to(dtype=torch.float32, device=self.DEVICE)).cpu().detach().numpy()
-        return data
+        with self.lock:
+            self.load(iteration, epoch)
+            data = self.vis_model.decoder(torch.from_numpy(embedding).to(dtype=torch.float32, device=self.DEVICE)).cpu().detach().numpy()
+            return data
     
     def individual_inverse(self, iteration, epoch, embedding):
-        self.load(iteration, epoch)
-        data = self.vis_model.decoder(torch.from_numpy(np.expand_dims(embedding, axis=0)).to(dtype=torch.float32, device=self.DEVICE)).cpu().detach().numpy()
-        return data.squeeze(axis=0)
+        with self.lock:
+            self.load(iteration, epoch)
+            data = self.vis_model.decoder(torch.from_numpy(np.expand_dims(embedding, axis=0)).to(dtype=torch.float32, device=self.DEVICE)).cpu().detach().numpy()
+            return data.squeeze(axis=0)
 
 
 class EvalProjector(DeepDebuggerProjector):
@@ -197,14 +208,20 @@ class EvalProjector(DeepDebuggerProjector):
 class DVIProjector(Projector):
     def __init__(self, vis_model, content_path, vis_model_name, device) -> None:
         super().__init__(vis_model, content_path, vis_model_name, device)
+        # (iteration, mtime) of the loaded visualization model
+        self.curr_state = None
 
     def load(self, iteration):
-        print("DVIPROJECTOR", self.vis_model_name)
         file_path = os.path.join(self.content_path, "Model", "Epoch_{}".format(iteration), "{}.pth".format(self.vis_model_name))
+        state = (iteration, os.path.getmtime(file_path))
+        if state == self.curr_state:
+            return
+        print("DVIPROJECTOR", self.vis_model_name)
         save_model = torch.load(file_path, map_location="cpu")
         self.vis_model.load_state_dict(save_model["state_dict"])
         self.vis_model.to(self.DEVICE)
         self.vis_model.eval()
+        self.curr_state = state
         print("Successfully load the DVI visualization model for iteration {}".format(iteration))
 
 
@@ -243,36 +260,46 @@ class TimeVisDenseALProjector(Projector):
         
     
     def batch_project(self, iteration, epoch, data):
-        self.load(iteration, epoch)
-        embedding = self.vis_model.encoder(torch.from_numpy(data).to(dtype=torch.float32, device=self.DEVICE)).cpu().detach().numpy()
-        return embedding
+        with self.lock:
+            self.load(iteration, epoch)
+            embedding = self.vis_model.encoder(torch.from_numpy(data).to(dtype=torch.float32, device=self.DEVICE)).cpu().detach().numpy()
+            return embedding
     
     def individual_project(self, iteration, epoch, data):
-        self.load(iteration, epoch)
-        embedding = self.vis_model.encoder(torch.from_numpy(np.expand_dims(data, axis=0)).to(dtype=torch.float32, device=self.DEVICE)).cpu().detach().numpy()
-        return embedding.squeeze(axis=0)
+        with self.lock:
+            self.load(iteration, epoch)
+            embedding = self.vis_model.encoder(torch.from_numpy(np.expand_dims(data, axis=0)).to(dtype=torch.float32, device=self.DEVICE)).cpu().detach().numpy()
+            return embedding.squeeze(axis=0)
     
     def batch_inverse(self, iteration, epoch, embedding):
-        self.load(iteration, epoch)
-        data = self.vis_model.decoder(torch.from_numpy(embedding).to(dtype=torch.float32, device=self.DEVICE)).cpu().detach().numpy()
-        return data
+        with self.lock:
+            self.load(iteration, epoch)
+            data = self.vis_model.decoder(torch.from_numpy(embedding).to(dtype=torch.float32, device=self.DEVICE)).cpu().detach().numpy()
+            return data
     
     def individual_inverse(self, iteration, epoch, embedding):
-        self.load(iteration, epoch)
-        data = self.vis_model.decoder(torch.from_numpy(np.expand_dims(embedding, axis=0)).to(dtype=torch.float32, device=self.DEVICE)).cpu().detach().numpy()
-        return data.squeeze(axis=0)
+        with self.lock:
+            self.load(iteration, epoch)
+            data = self.vis_model.decoder(torch.from_numpy(np.expand_dims(embedding, axis=0)).to(dtype=torch.float32, device=self.DEVICE)).cpu().detach().numpy()
+            return data.squeeze(axis=0)
 
 class TrustVisProjector(Projector):
     def __init__(self, vis_model, content_path, vis_model_name, device, verbose=0) -> None:
         super().__init__(vis_model, content_path, vis_model_name, device)
         self.verbose = verbose
+        # (iteration, mtime) of the loaded visualization model
+        self.curr_state = None
 
     def load(self, iteration):
         file_path = os.path.join(self.content_path, "Model", "Epoch_{}".format(iteration), "{}.pth".format(self.vis_model_name))
+        state = (iteration, os.path.getmtime(file_path))
+        if state == self.curr_state:
+            return
         save_model = torch.load(file_path, map_location="cpu")
         self.vis_model.load_state_dict(save_model["state_dict"])
         self.vis_model.to(self.DEVICE)
         self.vis_model.eval()
+        self.curr_state = state
         if self.verbose>0:
             print("Successfully load the Trustvis visualization model for iteration {}".format(iteration))
 
@@ -299,6 +326,7 @@ class tfDVIProjector(ProjectorAbstractClass):
         self.encoder = None
         self.decoder = None
         self.verbose = verbose
+        self.lock = threading.RLock()
 
     def load(self, epoch):
         if self.curr_iteration == epoch:
@@ -322,9 +350,10 @@ class tfDVIProjector(ProjectorAbstractClass):
         :param epoch: int
         :return: embedding numpy.ndarray
         '''
-        self.load(epoch)
-        embedding = self.encoder(data).cpu().numpy()
-        return embedding
+        with self.lock:
+            self.load(epoch)
+            embedding = self.encoder(data).cpu().numpy()
+            return embedding
 
     def individual_project(self, epoch, data):
         '''
@@ -333,10 +362,11 @@ class tfDVIProjector(ProjectorAbstractClass):
         :param epoch: int
         :return: embedding numpy.ndarray
         '''
-        self.load(epoch)
-        data = np.expand_dims(data, axis=0)
-        embedding = self.encoder(data).cpu().numpy()
-        return embedding.squeeze(0)
+        with self.lock:
+            self.load(epoch)
+            data = np.expand_dims(data, axis=0)
+            embedding = self.encoder(data).cpu().numpy()
+            return embedding.squeeze(0)
 
     def batch_inverse(self, epoch, data):
         """
@@ -345,9 +375,10 @@ class tfDVIProjector(ProjectorAbstractClass):
         :param epoch: num of epoch
         :return: high dim representation, numpy.ndarray
         """
-        self.load(epoch)
-        representation_data = self.decoder(data).cpu().numpy()
-        return representation_data
+        with self.lock:
+            self.load(epoch)
+            representation_data = self.decoder(data).cpu().numpy()
+            return representation_data
 
     def individual_inverse(self, epoch, data):
         """
@@ -356,10 +387,11 @@ class tfDVIProjector(ProjectorAbstractClass):
         :param epoch: num of epoch
         :return: high dim representation, numpy.ndarray
         """
-        self.load(epoch)
-        data = np.expand_dims(data, axis=0)
-        representation_data = self.decoder(data).cpu().numpy()
-        return representation_data.squeeze(0)
+        with self.lock:
+            self.load(epoch)
+            data = np.expand_dims(data, axis=0)
+            representation_data = self.decoder(data).cpu().numpy()
+            return representation_data.squeeze(0)
 
 
 class tfDVIDenseALProjector(ProjectorAbstractClass):
@@ -372,6 +404,7 @@ class tfDVIDenseALProjector(ProjectorAbstractClass):
         self.encoder = None
         self.decoder = None
         self.verbose = verbose
+        self.lock = threading.RLock()
 
     def load(self, iteration, epoch):
         if self.curr_iteration == iteration and self.curr_epoch == epoch:
@@ -396,9 +429,10 @@ class tfDVIDenseALProjector(ProjectorAbstractClass):
         :param epoch: int
         :return: embedding numpy.ndarray
         '''
-        self.load(iteration, epoch)
-        embedding = self.encoder(data).cpu().numpy()
-        return embedding
+        with self.lock:
+            self.load(iteration, epoch)
+            embedding = self.encoder(data).cpu().numpy()
+            return embedding
 
     def individual_project(self, iteration, epoch, data):
         '''
@@ -407,10 +441,11 @@ class tfDVIDenseALProjector(ProjectorAbstractClass):
         :param epoch: int
         :return: embedding numpy.ndarray
         '''
-        self.load(iteration, epoch)
-        data = np.expand_dims(data, axis=0)
-        embedding = self.encoder(data).cpu().numpy()
-        return embedding.squeeze(0)
+        with self.lock:
+            self.load(iteration, epoch)
+            data = np.expand_dims(data, axis=0)
+            embedding = self.encoder(data).cpu().numpy()
+            return embedding.squeeze(0)
 
     def batch_inverse(self, iteration, epoch, data):
         """
@@ -419,9 +454,10 @@ class tfDVIDenseALProjector(ProjectorAbstractClass):
         :param epoch: num of epoch
         :return: high dim representation, numpy.ndarray
         """
-        self.load(iteration, epoch)
-        representation_data = self.decoder(data).cpu().numpy()
-        return representation_data
+        with self.lock:
+            self.load(iteration, epoch)
+            representation_data = self.decoder(data).cpu().numpy()
+            return representation_data
 
     def individual_inverse(self, iteration, epoch, data):
         """
@@ -430,7 +466,8 @@ class tfDVIDenseALProjector(ProjectorAbstractClass):
         :param epoch: num of epoch
         :return: high dim representation, numpy.ndarray
         """
-        self.load(iteration, epoch)
-        data = np.expand_dims(data, axis=0)
-        representation_data = self.decoder(data).cpu().numpy()
-        return representation_data.squeeze(0)
\ No newline at end of file
+        with self.lock:
+            self.load(iteration, epoch)
+            data = np.expand_dims(data, axis=0)
+            representation_data = self.decoder(data).cpu().numpy()
+            return representation_data.squeeze(0)
\ No newline at end of file
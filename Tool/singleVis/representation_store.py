@@ -0,0 +1,111 @@
+"""The RepresentationStore class serves as a memory-mapped reader for per-epoch representation files"""
+import os
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class RepresentationStore:
+    """
+    Memory-maps Epoch_N/*.npy files and caches parsed index files.
+
+    Arrays are opened with mmap_mode="c" (copy-on-write), so callers get
+    pages from the OS page cache instead of a private copy per call. The
+    same array is handed to every caller of a path, so it is read-only;
+    callers that modify the data have to work on a copy. Entries are keyed
+    by path and invalidated when the file mtime changes.
+    """
+    def __init__(self, max_open=16):
+        self.max_open = max_open
+        self._arrays = OrderedDict()
+        self._indices = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _mtime(path):
+        return os.path.getmtime(path)
+
+    def load(self, path):
+        """
+        memory-map a .npy file
+        :param path: str, location of the .npy file
+        :return: numpy.ndarray backed by the file, read-only
+        """
+        mtime = self._mtime(path)
+        with self._lock:
+            entry = self._arrays.get(path)
+            if entry is not None and entry[0] == mtime:
+                self._arrays.move_to_end(path)
+                return entry[1]
+        array = np.asarray(np.load(path, mmap_mode="c"))
+        # shared by all callers, a write by one would be seen by the others
+        array.setflags(write=False)
+        with self._lock:
+            self._arrays[path] = (mtime, array)
+            self._arrays.move_to_end(path)
+            while len(self._arrays) > self.max_open:
+                self._arrays.popitem(last=False)
+        return array
+
+    def load_index(self, path):
+        """
+        load an index.json/test_index.json file as an int64 array
+        :param path: str
+        :return: numpy.ndarray, shape (N,)
+        """
+        mtime = self._mtime(path)
+        with self._lock:
+            entry = self._indices.get(path)
+            if entry is not None and entry[0] == mtime:
+                return entry[1]
+        with open(path, "r") as f:
+            index = np.asarray(json.load(f), dtype=np.int64)
+        index.setflags(write=False)
+        with self._lock:
+            self._indices[path] = (mtime, index)
+        return index
+
+    def select(self, path, index_path=None):
+        """
+        load the rows of a .npy file listed in an index file
+        a contiguous index (e.g. all training samples) returns a zero-copy view
+        :param path: str, .npy location
+        :param index_path: str or None, index file location, None to return all rows
+        :return: numpy.ndarray
+        """
+        data = self.load(path)
+        if index_path is None:
+            return data
+        index = self.load_index(index_path)
+        return take_rows(data, index)
+
+    def save(self, path, array):
+        """
+        write a .npy file without invalidating arrays already handed out
+        the file is written next to the target and renamed over it, so existing maps keep the old inode
+        """
+        tmp_path = path + ".tmp.npy"
+        np.save(tmp_path, array)
+        os.replace(tmp_path, path)
+        self.invalidate(path)
+
+    def invalidate(self, path=None):
+        with self._lock:
+            if path is None:
+                self._arrays.clear()
+                self._indices.clear()
+            else:
+                self._arrays.pop(path, None)
+                self._indices.pop(path, None)
+
+
+def take_rows(data, index):
+    """index rows of data, slicing instead of gathering when index is a contiguous ascending range"""
+    if len(index) == 0:
+        return data[:0]
+    start = int(index[0])
+    if len(index) == int(index[-1]) - start + 1 and (len(index) == 1 or np.all(np.diff(index) == 1)):
+        return data[start:start + len(index)]
+    return data[index]
@@ -1,8 +1,13 @@
 import numpy as np
 import json
 import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pynndescent import NNDescent
 
+# state inherited by forked workers, set right before the pool is created
+_WORKER = dict()
+
 # helper function
 def hausdorff_d(curr_data, prev_data):
     # number of trees in random projection forest
@@ -25,10 +30,48 @@ def hausdorff_d(curr_data, prev_data):
     m1 = dists1.mean()
     return m1
 
+
+def _stream_run(epochs):
+    segmenter = _WORKER["segmenter"]
+    return epochs, segmenter._stream(epochs)
+
+
+def segment_dists(dists, threshold):
+    """
+    split the intervals into segments, walking backwards and starting a new segment once the summed distance exceeds threshold
+    :param dists: ndarray, (interval_num,) distance of each interval
+    :return segs: list of (start index, end index) of intervals, inclusive
+    """
+    dists_segs = list()
+    count = 0
+    base = len(dists)-1
+    for i in range(len(dists)-1, -1, -1):
+        count = count + dists[i]
+        if count >threshold:
+            dists_segs.insert(0, (i+1, base))
+            base = i
+            count = dists[i]
+    dists_segs.insert(0, (0, base))
+    return dists_segs
+
+
 class Segmenter:
-    def __init__(self, data_provider, threshold, range_s=None, range_e=None, range_p=None):
+    """
+    Segment the epochs of a run by the distance between consecutive epochs' representations.
+
+    Epochs are streamed in order, each one is read once and only the previous epoch's representation
+    is kept while the current one is indexed. With workers > 1 the intervals are split into contiguous
+    runs streamed by forked processes. The distance curve is persisted to Model/segment_dists.json,
+    one entry per interval with the versions (mtimes) of both epochs' representations, so segment()
+    with another threshold only recomputes intervals whose epochs changed.
+    """
+    DISTS_FILE = "segment_dists.json"
+
+    def __init__(self, data_provider, threshold, range_s=None, range_e=None, range_p=None, workers=1, verbose=1):
         self.data_provider = data_provider
         self.threshold = threshold
+        self.workers = workers
+        self.verbose = verbose
         if range_s is None:
             self.s = data_provider.s
             self.e = data_provider.e
@@ -38,37 +81,133 @@ class Segmenter:
             self.e = range_e
             self.p = range_p
 
+    ################################################ distances ###########################################
+    def _representation(self, epoch):
+        # a row of the consolidated store when it is up to date, the per-epoch file otherwise
+        data = self.data_provider.train_representations([epoch])[0]
+        # reshape representation
+        return data.reshape(len(data), -1)
+
+    def _version(self, epoch):
+        """mtimes of the files train_representation reads, None if they are missing"""
+        path = self.data_provider.checkpoint_path(epoch)
+        version = list()
+        for name in ("train_data.npy", "index.json"):
+            try:
+                version.append(os.path.getmtime(os.path.join(path, name)))
+            except OSError:
+                return None
+        return version
+
+    def _dists_file(self):
+        return os.path.join(self.data_provider.model_path, self.DISTS_FILE)
+
+    def _load_dists(self):
+        dists_file = self._dists_file()
+        if dists_file is None or not os.path.exists(dists_file):
+            return dict()
+        try:
+            with open(dists_file, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def _save_dists(self, intervals):
+        dists_file = self._dists_file()
+        if dists_file is None:
+            return
+        tmp_file = dists_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(intervals, f)
+        os.replace(tmp_file, dists_file)
+
+    def _stream(self, epochs):
+        """distances of the intervals between consecutive epochs, reading every epoch once"""
+        dists = list()
+        prev_data = self._representation(epochs[0])
+        for epoch in epochs[1:]:
+            curr_data = self._representation(epoch)
+            dists.append(float(hausdorff_d(curr_data=curr_data, prev_data=prev_data)))
+            prev_data = curr_data
+            if self.verbose > 0:
+                print("Finish interval distance of Epoch {:d}...".format(epoch))
+        return dists
+
+    def _runs(self, epochs, stale):
+        """contiguous runs of epochs covering the stale intervals, split so that every worker gets a share"""
+        runs = list()
+        for i in stale:
+            if runs and runs[-1][-1] == epochs[i]:
+                runs[-1].append(epochs[i+1])
+            else:
+                runs.append([epochs[i], epochs[i+1]])
+        size = max(1, -(-len(stale) // max(1, self.workers)))
+        chunks = list()
+        for run in runs:
+            for start in range(0, len(run) - 1, size):
+                chunks.append(run[start:start + size + 1])
+        return chunks
+
+    def _parallel(self, n_chunks):
+        if self.workers <= 1 or n_chunks <= 1:
+            return False
+        if "fork" not in multiprocessing.get_all_start_methods():
+            print("Process pool needs fork, segmentation runs in a single process...")
+            return False
+        return True
+
+    def _compute(self, chunks):
+        results = list()
+        if not self._parallel(len(chunks)):
+            for epochs in chunks:
+                results.append((epochs, self._stream(epochs)))
+            return results
+        _WORKER["segmenter"] = self
+        try:
+            ctx = multiprocessing.get_context("fork")
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(chunks)), mp_context=ctx) as executor:
+                futures = [executor.submit(_stream_run, epochs) for epochs in chunks]
+                for future in futures:
+                    results.append(future.result())
+        finally:
+            _WORKER.clear()
+        return results
+
     def _cal_interval_dists(self):
         interval_num = (self.e - self.s)// self.p
+        epochs = [self.s + i * self.p for i in range(interval_num + 1)]
+        versions = [self._version(epoch) for epoch in epochs]
+
+        intervals = self._load_dists()
+        stale = list()
+        for i in range(interval_num):
+            entry = intervals.get("{}-{}".format(epochs[i], epochs[i+1]))
+            if entry is None or versions[i] is None or entry["versions"] != [versions[i], versions[i+1]]:
+                stale.append(i)
+
+        if stale:
+            for run, run_dists in self._compute(self._runs(epochs, stale)):
+                for prev_epoch, epoch, dist in zip(run[:-1], run[1:], run_dists):
+                    i = (prev_epoch - self.s) // self.p
+                    intervals["{}-{}".format(prev_epoch, epoch)] = {"dist": dist, "versions": [versions[i], versions[i+1]]}
+            self._save_dists(intervals)
 
-        dists = np.zeros(interval_num)
-        for curr_epoch in range(self.s, self.e, self.p):
-            next_data = self.data_provider.train_representation(curr_epoch+ self.p)
-            curr_data = self.data_provider.train_representation(curr_epoch)
-            l = next_data.shape[0]
-            next_data = next_data.reshape(l, - 1)
-            curr_data = curr_data.reshape(l, -1)
-            # reshape representation
-            dists[(curr_epoch-self.s)//self.p] = hausdorff_d(curr_data=next_data, prev_data=curr_data)
-        
-        # self.dists = np.copy(dists)
+        dists = np.array([intervals["{}-{}".format(epochs[i], epochs[i+1])]["dist"] for i in range(interval_num)])
         return dists
-    def segment(self):
+
+    def segment(self, threshold=None):
+        """
+        :param threshold: float or None, overrides self.threshold, segmenting again with another threshold reuses the persisted distances
+        :return segs: list of (start epoch, end epoch)
+        """
+        if threshold is not None:
+            self.threshold = threshold
         dists = self._cal_interval_dists()
-        dists_segs = list()
-        count = 0
-        base = len(dists)-1
-        for i in range(len(dists)-1, -1, -1):
-            count = count + dists[i]
-            if count >self.threshold:
-                dists_segs.insert(0, (i+1, base))
-                base = i
-                count = dists[i]
-        dists_segs.insert(0, (0, base))
+        dists_segs = segment_dists(dists, self.threshold)
         segs = [(self.s+i*self.p, self.s+(j+1)*self.p) for i, j in dists_segs]
         self.segments = segs
         return segs
-    
+
     def record_time(self, save_dir, file_name, t):
         # save result
         save_file = os.path.join(save_dir, file_name+".json")
@@ -86,35 +225,24 @@ class Segmenter:
 class DenseALSegmenter(Segmenter):
     def __init__(self, data_provider, threshold, epoch_num):
         super().__init__(data_provider, threshold, 1, epoch_num, 1)
-    
+        self.iteration = None
+
+    def _representation(self, epoch):
+        return self.data_provider.train_representation_lb(self.iteration, epoch)
+
+    def _version(self, epoch):
+        # distances are not persisted across iterations
+        return None
+
+    def _dists_file(self):
+        return None
+
     def _cal_interval_dists(self, iteration):
-        interval_num = (self.e - self.s)// self.p
+        self.iteration = iteration
+        return super()._cal_interval_dists()
 
-        dists = np.zeros(interval_num)
-        for curr_epoch in range(self.s, self.e, self.p):
-            next_data = self.data_provider.train_representation_lb(iteration, curr_epoch+ self.p)
-            curr_data = self.data_provider.train_representation_lb(iteration, curr_epoch)
-            dists[(curr_epoch-self.s)//self.p] = hausdorff_d(curr_data=next_data, prev_data=curr_data)
-        
-        # self.dists = np.copy(dists)
-        return dists
     def segment(self, iteration):
         dists = self._cal_interval_dists(iteration)
-        dists_segs = list()
-        count = 0
-        base = len(dists)-1
-        for i in range(len(dists)-1, -1, -1):
-            count = count + dists[i]
-            if count >self.threshold:
-                dists_segs.insert(0, (i+1, base))
-                base = i
-                count = dists[i]
-        dists_segs.insert(0, (0, base))
+        dists_segs = segment_dists(dists, self.threshold)
         segs = [(self.s+i*self.p, self.s+(j+1)*self.p) for i, j in dists_segs]
         return segs
-
-
-        
-        
-
-
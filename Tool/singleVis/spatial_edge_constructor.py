@@ -14,7 +14,8 @@ from sklearn.utils import check_random_state
 from singleVis.kcenter_greedy import kCenterGreedy
 from singleVis.intrinsic_dim import IntrinsicDim
 from singleVis.backend import get_graph_elements, get_attention
-from singleVis.utils import find_neighbor_preserving_rate
+from singleVis.utils import epoch_neighbor_preserving_rate
+from singleVis.knn_cache import KnnCache
 
 class SpatialEdgeConstructorAbstractClass(ABC):
     @abstractmethod
@@ -57,27 +58,20 @@ class SpatialEdgeConstructor(SpatialEdgeConstructorAbstractClass):
         self.b_n_epochs = b_n_epochs
         self.n_neighbors = n_neighbors
     
-    def _construct_fuzzy_complex(self, train_data):
+    def _construct_fuzzy_complex(self, train_data, epoch=None):
         """
         construct a vietoris-rips complex
+        :param epoch: int or None, when train_data is the full train representation of this epoch,
+            the kNN graph is taken from (and stored in) the data provider's KnnCache
         """
-        # number of trees in random projection forest
-        n_trees = min(64, 5 + int(round((train_data.shape[0]) ** 0.5 / 20.0)))
-        # max number of nearest neighbor iters to perform
-        n_iters = max(5, int(round(np.log2(train_data.shape[0]))))
         # distance metric
         metric = "euclidean"
         # get nearest neighbors
-        nnd = NNDescent(
-            train_data,
-            n_neighbors=self.n_neighbors,
-            metric=metric,
-            n_trees=n_trees,
-            n_iters=n_iters,
-            max_candidates=60,
-            verbose=True
-        )
-        knn_indices, knn_dists = nnd.neighbor_graph
+        knn = getattr(self.data_provider, "knn", None)
+        if epoch is not None and knn is not None:
+            knn_indices, knn_dists = knn.get(epoch, "train", train_data, self.n_neighbors, metric=metric)
+        else:
+            knn_indices, knn_dists = KnnCache.build(train_data, self.n_neighbors, metric=metric)
         random_state = check_random_state(None)
         complex, sigmas, rhos = fuzzy_simplicial_set(
             X=train_data,
@@ -198,16 +192,14 @@ class RandomSpatialEdgeConstructor(SpatialEdgeConstructor):
                 sigmas_t = np.concatenate((sigmas_t1, sigmas_t2[len(sigmas_t1):]), axis=0)
                 rhos_t = np.concatenate((rhos_t1, rhos_t2[len(rhos_t1):]), axis=0)
                 fitting_data = np.concatenate((train_data, border_centers), axis=0)
-                pred_model = self.data_provider.prediction_function(t)
-                attention_t = get_attention(pred_model, fitting_data, temperature=.01, device=self.data_provider.DEVICE, verbose=1)
+                attention_t = self.data_provider.get_attention(t, fitting_data, temperature=.01, verbose=1)
                 t_num = len(train_data)
                 b_num = len(border_centers)
             else:
                 complex, sigmas_t, rhos_t, knn_idxs_t = self._construct_fuzzy_complex(train_data)
                 edge_to_t, edge_from_t, weight_t = self._construct_step_edge_dataset(complex, None, self.n_epochs)
                 fitting_data = np.copy(train_data)
-                pred_model = self.data_provider.prediction_function(t)
-                attention_t = get_attention(pred_model, fitting_data, temperature=.01, device=self.data_provider.DEVICE, verbose=1)
+                attention_t = self.data_provider.get_attention(t, fitting_data, temperature=.01, verbose=1)
                 t_num = len(train_data)
                 b_num = 0
 
@@ -494,8 +486,7 @@ class kcParallelSpatialEdgeConstructor(SpatialEdgeConstructor):
                 sigmas_t = np.concatenate((sigmas_t1, sigmas_t2[len(sigmas_t1):]), axis=0)
                 rhos_t = np.concatenate((rhos_t1, rhos_t2[len(rhos_t1):]), axis=0)
                 fitting_data = np.concatenate((train_data, border_centers), axis=0)
-                pred_model = self.data_provider.prediction_function(t)
-                attention_t = get_attention(pred_model, fitting_data, temperature=.01, device=self.data_provider.DEVICE, verbose=1)
+                attention_t = self.data_provider.get_attention(t, fitting_data, temperature=.01, verbose=1)
             else:
                 t_num = len(selected_idxs)
                 b_num = 0
@@ -503,8 +494,7 @@ class kcParallelSpatialEdgeConstructor(SpatialEdgeConstructor):
                 complex, sigmas_t, rhos_t, knn_idxs_t = self._construct_fuzzy_complex(train_data)
                 edge_to_t, edge_from_t, weight_t = self._construct_step_edge_dataset(complex, None)
                 fitting_data = np.copy(train_data)
-                pred_model = self.data_provider.prediction_function(t)
-                attention_t = get_attention(pred_model, fitting_data, temperature=.01, device=self.data_provider.DEVICE, verbose=1)
+                attention_t = self.data_provider.get_attention(t, fitting_data, temperature=.01, verbose=1)
 
             if edge_to is None:
                 edge_to = edge_to_t
@@ -551,7 +541,7 @@ class SingleEpochSpatialEdgeConstructor(SpatialEdgeConstructor):
 
         if self.b_n_epochs > 0:
             border_centers = self.data_provider.border_representation(self.iteration).squeeze()
-            complex, _, _, _ = self._construct_fuzzy_complex(train_data)
+            complex, _, _, _ = self._construct_fuzzy_complex(train_data, epoch=self.iteration)
             bw_complex, _, _, _ = self._construct_boundary_wise_complex(train_data, border_centers)
             edge_to, edge_from, weight = self._construct_step_edge_dataset(complex, bw_complex)
             feature_vectors = np.concatenate((train_data, border_centers), axis=0)
@@ -559,7 +549,7 @@ class SingleEpochSpatialEdgeConstructor(SpatialEdgeConstructor):
             # attention = get_attention(pred_model, feature_vectors, temperature=.01, device=self.data_provider.DEVICE, verbose=1)
             attention = np.zeros(feature_vectors.shape)
         elif self.b_n_epochs == 0:
-            complex, _, _, _ = self._construct_fuzzy_complex(train_data)
+            complex, _, _, _ = self._construct_fuzzy_complex(train_data, epoch=self.iteration)
             edge_to, edge_from, weight = self._construct_step_edge_dataset(complex, None)
             feature_vectors = np.copy(train_data)
             # pred_model = self.data_provider.prediction_function(self.iteration)
@@ -699,8 +689,7 @@ class kcHybridSpatialEdgeConstructor(SpatialEdgeConstructor):
                 sigmas_t = np.concatenate((sigmas_t1, sigmas_t2[len(sigmas_t1):]), axis=0)
                 rhos_t = np.concatenate((rhos_t1, rhos_t2[len(rhos_t1):]), axis=0)
                 fitting_data = np.concatenate((train_data, border_centers), axis=0)
-                pred_model = self.data_provider.prediction_function(t)
-                attention_t = get_attention(pred_model, fitting_data, temperature=.01, device=self.data_provider.DEVICE, verbose=1)
+                attention_t = self.data_provider.get_attention(t, fitting_data, temperature=.01, verbose=1)
             else:
                 t_num = len(selected_idxs)
                 b_num = 0
@@ -708,8 +697,7 @@ class kcHybridSpatialEdgeConstructor(SpatialEdgeConstructor):
                 complex, sigmas_t, rhos_t, knn_idxs_t = self._construct_fuzzy_complex(train_data)
                 edge_to_t, edge_from_t, weight_t = self._construct_step_edge_dataset(complex, None)
                 fitting_data = np.copy(train_data)
-                pred_model = self.data_provider.prediction_function(t)
-                attention_t = get_attention(pred_model, fitting_data, temperature=.01, device=self.data_provider.DEVICE, verbose=1)
+                attention_t = self.data_provider.get_attention(t, fitting_data, temperature=.01, verbose=1)
             
             if edge_to is None:
                 edge_to = edge_to_t
@@ -873,7 +861,7 @@ class kcHybridDenseALSpatialEdgeConstructor(SpatialEdgeConstructor):
                 sigmas_t = np.concatenate((sigmas_t1, sigmas_t2[len(sigmas_t1):]), axis=0)
                 rhos_t = np.concatenate((rhos_t1, rhos_t2[len(rhos_t1):]), axis=0)
                 fitting_data = np.concatenate((train_data, border_centers), axis=0)
-                pred_model = self.data_provider.prediction_function(t)
+                pred_model = self.data_provider.prediction_function(self.iteration,t)
                 attention_t = get_attention(pred_model, fitting_data, temperature=.01, device=self.data_provider.DEVICE, verbose=1)
             else:
                 t_num = len(selected_idxs)
@@ -972,10 +960,10 @@ class tfEdgeConstructor(SpatialEdgeConstructor):
             prev_data = self.data_provider.train_representation(prev_iteration)
         else:
             prev_data = None
-        n_rate = find_neighbor_preserving_rate(prev_data, train_data, self.n_neighbors)
+        n_rate = epoch_neighbor_preserving_rate(self.data_provider, prev_iteration, iteration, prev_data, train_data, self.n_neighbors)
         if self.b_n_epochs > 0:
             border_centers = self.data_provider.border_representation(iteration).squeeze()
-            complex, _, _, _ = self._construct_fuzzy_complex(train_data)
+            complex, _, _, _ = self._construct_fuzzy_complex(train_data, epoch=iteration)
             bw_complex, _, _, _ = self._construct_boundary_wise_complex(train_data, border_centers)
             edges_to_exp, edges_from_exp, weights_exp = self._construct_step_edge_dataset(complex, bw_complex)
             feature_vectors = np.concatenate((train_data, border_centers), axis=0)
@@ -984,7 +972,7 @@ class tfEdgeConstructor(SpatialEdgeConstructor):
             attention = np.zeros(feature_vectors.shape)
 
         elif self.b_n_epochs == 0:
-            complex, _, _, _ = self._construct_fuzzy_complex(train_data)
+            complex, _, _, _ = self._construct_fuzzy_complex(train_data, epoch=iteration)
             edges_to_exp, edges_from_exp, weights_exp = self._construct_step_edge_dataset(complex, None)
             feature_vectors = np.copy(train_data)
             # pred_model = self.data_provider.prediction_function(self.iteration)
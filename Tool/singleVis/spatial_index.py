@@ -0,0 +1,73 @@
+"""The SpatialIndex class answers range queries on a 2D embedding, SpatialIndexCache keeps one per embedding file"""
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class SpatialIndex:
+    """
+    KD-tree over the points of an embedding, (n, 2).
+    Distances are euclidean and a point is within r when its distance is strictly less than r,
+    as in evaluate_isAlign.
+    """
+    def __init__(self, embedding):
+        self.embedding = np.ascontiguousarray(embedding, dtype=np.float64)
+        self.tree = cKDTree(self.embedding)
+
+    def __len__(self):
+        return len(self.embedding)
+
+    def within(self, point, r):
+        """:return: numpy.ndarray, sorted indices of the points closer than r to point"""
+        point = np.asarray(point, dtype=np.float64)
+        idxs = np.asarray(self.tree.query_ball_point(point, r), dtype=np.int64)
+        # query_ball_point includes the boundary
+        idxs = idxs[np.linalg.norm(self.embedding[idxs] - point, axis=1) < r]
+        idxs.sort()
+        return idxs
+
+    @staticmethod
+    def aligned(left, right, r):
+        """:return: numpy.ndarray, indices i with |left[i] - right[i]| < r"""
+        left = np.asarray(left)
+        right = np.asarray(right)
+        return np.flatnonzero(np.linalg.norm(left - right, axis=1) < r)
+
+
+class SpatialIndexCache:
+    """thread-safe LRU of SpatialIndex keyed by embedding file, rebuilt when the file changes on disk"""
+    def __init__(self, max_size=8):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, load_fn=None):
+        """
+        :param path: str, .npy file of the embedding
+        :param load_fn: callable or None, load_fn() -> embedding, writes path on a miss when the file does not exist
+        :return: SpatialIndex
+        """
+        key = os.path.normpath(path)
+        if not os.path.exists(key):
+            if load_fn is None:
+                raise FileNotFoundError(key)
+            embedding = load_fn()
+            tmp_path = key + ".tmp.npy"
+            np.save(tmp_path, embedding)
+            os.replace(tmp_path, key)
+        mtime = os.path.getmtime(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == mtime:
+                self._entries.move_to_end(key)
+                return entry[1]
+        index = SpatialIndex(np.load(key))
+        with self._lock:
+            self._entries[key] = (mtime, index)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return index
@@ -0,0 +1,144 @@
+"""The SpriteStore class serves sample thumbnails from a packed sprite file with an in-process LRU"""
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+PACK_NAME = "sprites.pack"
+INDEX_NAME = "sprites.pack.idx.npy"
+# sprite file extensions build_sprite_pack and SpriteStore know, in lookup order
+SPRITE_EXTS = (".png", ".webp")
+
+
+def build_sprite_pack(content_path, ext=".png", verbose=1):
+    """
+    concatenate content_path/sprites/{idx}{ext} into content_path/sprites.pack
+    the index is an int64 array of rows (idx, offset, length) sorted by idx, stored as sprites.pack.idx.npy
+    :param content_path: str
+    :param ext: str, sprite file extension, ".png" or ".webp"
+    :return: int, number of sprites packed
+    """
+    sprite_dir = os.path.join(content_path, "sprites")
+    ids = sorted(int(f[:-len(ext)]) for f in os.listdir(sprite_dir) if f.endswith(ext) and f[:-len(ext)].isdigit())
+    index = np.zeros((len(ids), 3), dtype=np.int64)
+    pack_path = os.path.join(content_path, PACK_NAME)
+    index_path = os.path.join(content_path, INDEX_NAME)
+    offset = 0
+    with open(pack_path + ".tmp", "wb") as pack:
+        for i, idx in enumerate(ids):
+            with open(os.path.join(sprite_dir, "{}{}".format(idx, ext)), "rb") as f:
+                data = f.read()
+            pack.write(data)
+            index[i] = (idx, offset, len(data))
+            offset += len(data)
+            if verbose and (i + 1) % 10000 == 0:
+                print("Packed {:d}/{:d} sprites...".format(i + 1, len(ids)))
+    np.save(index_path + ".tmp.npy", index)
+    # index first, a reader that sees the new pack always finds a matching index
+    os.replace(index_path + ".tmp.npy", index_path)
+    os.replace(pack_path + ".tmp", pack_path)
+    if verbose:
+        print("Finish packing {:d} sprites ({:.1f} MB)...".format(len(ids), offset / 2 ** 20))
+    return len(ids)
+
+
+def sprite_mime(data):
+    """image mime type of encoded sprite bytes"""
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/png"
+
+
+class SpriteStore:
+    """
+    Read access to the sprites of a content path.
+
+    Sprites come from sprites.pack when it exists and is at least as new as the sprites directory,
+    otherwise from the individual sprites/{idx}.png (or .webp) files. Recently read sprites are kept in an LRU
+    bounded by cache_bytes, so hovering back and forth over the same points does not touch the disk.
+    """
+    def __init__(self, content_path, cache_bytes=64 * 2 ** 20):
+        self.content_path = content_path
+        self.cache_bytes = cache_bytes
+        self.pack_path = os.path.join(content_path, PACK_NAME)
+        self.index_path = os.path.join(content_path, INDEX_NAME)
+        self.sprite_dir = os.path.join(content_path, "sprites")
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self._index = None
+        self._pack = None
+        self._version = None
+        # extension of the individual sprite files, found on the first read from sprites/
+        self._ext = None
+        self._lock = threading.Lock()
+
+    def version(self):
+        """changes whenever the sprites are rebuilt, used for ETags"""
+        mtimes = [os.path.getmtime(p) for p in (self.pack_path, self.sprite_dir) if os.path.exists(p)]
+        return max(mtimes) if len(mtimes) else 0.
+
+    def _use_pack(self):
+        if not (os.path.exists(self.pack_path) and os.path.exists(self.index_path)):
+            return False
+        return not os.path.exists(self.sprite_dir) or os.path.getmtime(self.pack_path) >= os.path.getmtime(self.sprite_dir)
+
+    def _refresh(self):
+        version = self.version()
+        if version == self._version:
+            return
+        self._cache.clear()
+        self._cached_bytes = 0
+        self._index = None
+        self._pack = None
+        if self._use_pack():
+            self._index = np.load(self.index_path)
+            self._pack = np.memmap(self.pack_path, dtype=np.uint8, mode="r") if os.path.getsize(self.pack_path) else np.zeros(0, dtype=np.uint8)
+        self._version = version
+
+    def _read(self, idx):
+        if self._index is not None:
+            pos = np.searchsorted(self._index[:, 0], idx)
+            if pos < len(self._index) and self._index[pos, 0] == idx:
+                _, offset, length = self._index[pos]
+                return self._pack[offset:offset + length].tobytes()
+            raise KeyError("sprite {} is not in {}".format(idx, self.pack_path))
+        with open(self._sprite_path(idx), "rb") as f:
+            return f.read()
+
+    def _sprite_path(self, idx):
+        exts = SPRITE_EXTS if self._ext is None else (self._ext,) + tuple(e for e in SPRITE_EXTS if e != self._ext)
+        for ext in exts:
+            path = os.path.join(self.sprite_dir, "{}{}".format(idx, ext))
+            if os.path.exists(path):
+                self._ext = ext
+                return path
+        raise FileNotFoundError("sprite {} is not in {}".format(idx, self.sprite_dir))
+
+    def get(self, idx):
+        """
+        :param idx: int, sprite id
+        :return: bytes, encoded image
+        """
+        idx = int(idx)
+        with self._lock:
+            self._refresh()
+            data = self._cache.get(idx)
+            if data is not None:
+                self._cache.move_to_end(idx)
+                return data
+            data = self._read(idx)
+            if len(data) <= self.cache_bytes:
+                self._cache[idx] = data
+                self._cached_bytes += len(data)
+                while self._cached_bytes > self.cache_bytes:
+                    _, evicted = self._cache.popitem(last=False)
+                    self._cached_bytes -= len(evicted)
+            return data
+
+    def get_many(self, indices):
+        """
+        :param indices: iterable of int
+        :return: list of bytes, in the order of indices
+        """
+        return [self.get(idx) for idx in indices]
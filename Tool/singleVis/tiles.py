@@ -0,0 +1,146 @@
+"""The TileRenderer class renders the decision-boundary background as cached z/x/y map tiles"""
+import os
+import io
+import json
+import threading
+
+import numpy as np
+from PIL import Image
+
+
+class TileRenderer:
+    """
+    Multi-resolution background tiles rendered straight from the decision colors of a visualizer.
+
+    Zoom level z splits the plot extent of an epoch into 2^z x 2^z tiles of tile_size x tile_size pixels.
+    Tile (z, x, y) counts x from x_min to the right and y from y_max downwards, like web map tiles.
+    Only the tiles that are requested get inverse-projected, so zooming into a region at high
+    resolution costs tile_size^2 predictions per tile instead of a full grid.
+
+    Tiles are cached on disk under Model/Epoch_N/tiles/{z}/{x}/{y}.png together with a meta.json that
+    holds the extent and color normalization of the epoch, so all tiles of an epoch share one color scale.
+    The cache of an epoch is dropped when a .pth file of that epoch or of Model/ is newer than meta.json,
+    or when the visualizer switched between the dense and the adaptive (quadtree) grid.
+    """
+    def __init__(self, vis, tile_size=256, max_zoom=6):
+        self.vis = vis
+        self.data_provider = vis.data_provider
+        self.tile_size = tile_size
+        self.max_zoom = max_zoom
+        self._lock = threading.Lock()
+
+    ################################################ paths ###############################################
+    def tile_dir(self, epoch):
+        fname = "Epoch" if self.data_provider.mode == "normal" else "Iteration"
+        return os.path.join(self.data_provider.model_path, "{}_{}".format(fname, epoch), "tiles")
+
+    def tile_path(self, epoch, z, x, y):
+        return os.path.join(self.tile_dir(epoch), str(z), str(x), "{}.png".format(y))
+
+    def _model_version(self, epoch):
+        """latest mtime of the subject/visualization models an epoch is rendered from"""
+        dirs = [self.data_provider.model_path, os.path.dirname(self.tile_dir(epoch))]
+        mtimes = [0.]
+        for d in dirs:
+            for f in os.listdir(d):
+                if f.endswith(".pth"):
+                    mtimes.append(os.path.getmtime(os.path.join(d, f)))
+        return max(mtimes)
+
+    ################################################ meta ################################################
+    def _pixel_axes(self, x_min, y_min, x_max, y_max):
+        # pixel centers, first row at y_max
+        xs = x_min + (np.arange(self.tile_size) + 0.5) * (x_max - x_min) / self.tile_size
+        ys = y_max - (np.arange(self.tile_size) + 0.5) * (y_max - y_min) / self.tile_size
+        return xs, ys
+
+    def _current_meta(self, meta_path, version):
+        """meta.json if it is up to date with version and the renderer settings, None otherwise"""
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        if meta["version"] >= version and meta["tile_size"] == self.tile_size and meta.get("adaptive_grid", False) == self.vis.adaptive_grid:
+            return meta
+        return None
+
+    def meta(self, epoch):
+        """
+        extent and color normalization of an epoch, computed with the zoom 0 tile on first use
+        :return: dict with x_min, y_min, x_max, y_max, diff_max, mesh_max_class, tile_size, max_zoom
+        """
+        meta_path = os.path.join(self.tile_dir(epoch), "meta.json")
+        meta = self._current_meta(meta_path, self._model_version(epoch))
+        if meta is not None:
+            return meta
+        with self._lock:
+            # another request may have rendered the epoch while this one waited
+            version = self._model_version(epoch)
+            meta = self._current_meta(meta_path, version)
+            if meta is not None:
+                return meta
+            x_min, y_min, x_max, y_max = [float(i) for i in self.vis.get_epoch_plot_measures(epoch)]
+            xs, ys = self._pixel_axes(x_min, y_min, x_max, y_max)
+            color, diff_max, mesh_max_class = self.vis.get_lattice_decision_colors(epoch, xs, ys)
+            meta = {
+                "x_min": x_min, "y_min": y_min, "x_max": x_max, "y_max": y_max,
+                "diff_max": diff_max, "mesh_max_class": mesh_max_class,
+                "tile_size": self.tile_size, "max_zoom": self.max_zoom, "version": version,
+                "adaptive_grid": self.vis.adaptive_grid,
+            }
+            self._clear(epoch)
+            os.makedirs(self.tile_dir(epoch), exist_ok=True)
+            self._write(self.tile_path(epoch, 0, 0, 0), self._encode(color))
+            tmp_path = meta_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, meta_path)
+        return meta
+
+    def _clear(self, epoch):
+        tile_dir = self.tile_dir(epoch)
+        if not os.path.exists(tile_dir):
+            return
+        for root, _, files in os.walk(tile_dir):
+            for f in files:
+                if f.endswith(".png"):
+                    os.remove(os.path.join(root, f))
+
+    ############################################### render ###############################################
+    def _encode(self, color):
+        img = np.clip(color.reshape(self.tile_size, self.tile_size, 3) * 255, 0, 255).astype(np.uint8)
+        buf = io.BytesIO()
+        Image.fromarray(img, mode="RGB").save(buf, format="PNG")
+        return buf.getvalue()
+
+    def _write(self, path, png):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(tmp_path, "wb") as f:
+            f.write(png)
+        os.replace(tmp_path, path)
+
+    def tile_bounds(self, meta, z, x, y):
+        """data-space bounds (x_min, y_min, x_max, y_max) of tile (z, x, y)"""
+        n = 2 ** z
+        w = (meta["x_max"] - meta["x_min"]) / n
+        h = (meta["y_max"] - meta["y_min"]) / n
+        x_min = meta["x_min"] + x * w
+        y_max = meta["y_max"] - y * h
+        return x_min, y_max - h, x_min + w, y_max
+
+    def render(self, epoch, z, x, y):
+        """
+        render tile (z, x, y) of epoch, reusing the cached png if any
+        :return: str, location of the png
+        """
+        if not (0 <= z <= self.max_zoom and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            raise ValueError("tile {}/{}/{} out of range, max zoom {}".format(z, x, y, self.max_zoom))
+        meta = self.meta(epoch)
+        path = self.tile_path(epoch, z, x, y)
+        if os.path.exists(path):
+            return path
+        xs, ys = self._pixel_axes(*self.tile_bounds(meta, z, x, y))
+        color, _, _ = self.vis.get_lattice_decision_colors(epoch, xs, ys, diff_max=meta["diff_max"], mesh_max_class=meta["mesh_max_class"])
+        self._write(path, self._encode(color))
+        return path
@@ -37,8 +37,10 @@ class TD:
         # epoch, num, 1
         losses = None
 
-        for epoch in range(EPOCH_START, EPOCH_END+1, EPOCH_PERIOD):
-            representation = self.data_provider.train_representation(epoch)
+        epochs = list(range(EPOCH_START, EPOCH_END+1, EPOCH_PERIOD))
+        # one read of all epochs, from the consolidated store when it is up to date
+        representations = self.data_provider.train_representations(epochs)
+        for epoch, representation in zip(epochs, representations):
             pred = self.data_provider.get_pred(epoch, representation)
 
             loss = cross_entropy(pred, labels)
@@ -59,8 +61,10 @@ class TD:
         # epoch, num, 1
         uncertainties = None
 
-        for epoch in range(EPOCH_START, EPOCH_END+1, EPOCH_PERIOD):
-            representation = self.data_provider.train_representation(epoch)
+        epochs = list(range(EPOCH_START, EPOCH_END+1, EPOCH_PERIOD))
+        # one read of all epochs, from the consolidated store when it is up to date
+        representations = self.data_provider.train_representations(epochs)
+        for epoch, representation in zip(epochs, representations):
             pred = self.data_provider.get_pred(epoch, representation)
             uncertainty = pred[np.arange(len(labels)), labels]
 
@@ -79,8 +83,10 @@ class TD:
         # epoch, num, 1
         preds = None
 
-        for epoch in range(EPOCH_START, EPOCH_END+1, EPOCH_PERIOD):
-            representation = self.data_provider.train_representation(epoch)
+        epochs = list(range(EPOCH_START, EPOCH_END+1, EPOCH_PERIOD))
+        # one read of all epochs, from the consolidated store when it is up to date
+        representations = self.data_provider.train_representations(epochs)
+        for epoch, representation in zip(epochs, representations):
             pred = self.data_provider.get_pred(epoch, representation)
 
             if preds is None:
@@ -101,8 +107,10 @@ class TD:
         # epoch, num, dims
         embeddings = None
 
-        for epoch in range(EPOCH_START, EPOCH_END+1, EPOCH_PERIOD):
-            representation = self.data_provider.train_representation(epoch)
+        epochs = list(range(EPOCH_START, EPOCH_END+1, EPOCH_PERIOD))
+        # one read of all epochs, from the consolidated store when it is up to date
+        representations = self.data_provider.train_representations(epochs)
+        for epoch, representation in zip(epochs, representations):
             embedding = self.projector.batch_project(epoch, representation)
             if embeddings is None:
                 embeddings = np.expand_dims(embedding, axis=0)
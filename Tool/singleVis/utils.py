@@ -10,6 +10,9 @@ from sklearn.neighbors import KDTree
 from sklearn.metrics import pairwise_distances
 from scipy import stats as stats
 
+from singleVis.knn_cache import KnnCache, knn_overlap
+
+
 def mixup_bi(model, image1, image2, label, target_cls, device, diff=0.1, max_iter=8, l_bound=0.8):
     '''Get BPs based on mixup method, fast
     :param model: subject model
@@ -156,6 +159,169 @@ def get_border_points(model, input_x, confs, predictions, device, num_adv_eg, l_
     return adv_examples, curr_samples, tot_num
 
 
+def mixup_bi_batch(model, image1, image2, labels, target_cls, device, diff=0.1, max_iter=8, l_bound=0.8):
+    '''Batched mixup_bi, bisect the mixing weight of many pairs at once
+    :param model: subject model
+    :param image1: images, torch.Tensor of shape (B, C, H, W)
+    :param image2: images, torch.Tensor of shape (B, C, H, W)
+    :param labels: predictions for image1, torch.Tensor of shape (B,)
+    :param target_cls: predictions for image2, torch.Tensor of shape (B,)
+    :param device: the device to run code, torch cpu or torch cuda
+    :param diff: the difference between top1 and top2 logits we define as boundary, float by default 0.1
+    :param max_iter: binary search iteration maximum value, int by default 8
+    :param l_bound: lower bound of the weight on image1
+    :return image_mix: torch.Tensor of shape (B, C, H, W), the last mix of each pair
+    :return successful: torch.Tensor of shape (B,), bool
+    :return steps: torch.Tensor of shape (B,), the step each pair stopped at
+    '''
+    num = len(image1)
+    image1 = image1.to(device, dtype=torch.float)
+    image2 = image2.to(device, dtype=torch.float)
+    labels = torch.as_tensor(labels, dtype=torch.long)
+    target_cls = torch.as_tensor(target_cls, dtype=torch.long)
+    rows = torch.arange(num)
+    view = (-1,) + (1,) * (image1.dim() - 1)
+
+    upper = torch.ones(num)
+    lower = torch.full((num,), float(l_bound))
+    successful = torch.zeros(num, dtype=torch.bool)
+    steps = torch.zeros(num, dtype=torch.long)
+    image_mix = torch.empty_like(image1)
+    active = torch.ones(num, dtype=torch.bool)
+
+    for step in range(max_iter):
+        idxs = rows[active]
+        # take middle point
+        lamb = (upper[idxs] + lower[idxs]) / 2
+        lamb_ = lamb.to(device).view(view)
+        mix = lamb_ * image1[idxs] + (1 - lamb_) * image2[idxs]
+        image_mix[idxs] = mix
+
+        with torch.no_grad():
+            pred_new = model(mix).detach().cpu()
+        conf_max = torch.max(pred_new, dim=1, keepdim=True)[0]
+        conf_min = torch.min(pred_new, dim=1, keepdim=True)[0]
+        normalized = (pred_new - conf_min) / (conf_max - conf_min)  # min-max rescaling
+
+        # Bisection method, decrease weight on image 1 while it is still predicted as label
+        local = torch.arange(len(idxs))
+        decrease = normalized[local, labels[idxs]] - normalized[local, target_cls[idxs]] > 0
+        upper[idxs] = torch.where(decrease, lamb, upper[idxs])
+        lower[idxs] = torch.where(decrease, lower[idxs], lamb)
+
+        # Stop when reaching the decision boundary and abs(upper-lower) < 0.1
+        top2 = torch.topk(normalized, 2, dim=1)[0]
+        curr_diff = top2[:, 0] - top2[:, 1]
+        done = (curr_diff < diff) & ((upper[idxs] - lower[idxs]) < 0.1)
+        steps[idxs] = step
+        successful[idxs[done]] = True
+        active[idxs[done]] = False
+        if not active.any():
+            break
+    return image_mix, successful, steps
+
+
+def get_border_points_batch(model, input_x, confs, predictions, device, num_adv_eg, l_bound=0.6, lambd=0.2, batch_size=200, verbose=1):
+    '''Get BPs, batched version of get_border_points
+    Each round draws batch_size class pairs with the same sampling probability as get_border_points
+    (updated between rounds instead of between pairs) and bisects both directions of every pair at once.
+    :param model: subject model
+    :param input_x: images, torch.Tensor of shape (N, C, H, W)
+    :param confs: logits, numpy.ndarray of shape (N, class_num)
+    :param predictions: class prediction, numpy.ndarray of shape (N,)
+    :param num_adv_eg: number of adversarial examples to be generated, int
+    :param l_bound: lower bound to conduct mix-up attack, range (0, 1)
+    :param lambd: trade-off between efficiency and diversity, (0, 1)
+    :param batch_size: number of class pairs drawn per round
+    :return adv_examples: adversarial images, torch.Tensor of shape (num_adv_eg, C, H, W)
+    '''
+    a = lambd
+    # count valid classes
+    valid_cls = np.unique(predictions)
+    valid_cls_num = len(valid_cls)
+    if valid_cls_num < 2:
+        raise Exception("Valid prediction classes less than 2!")
+
+    pair_num = int(valid_cls_num*(valid_cls_num-1)/2)
+    succ_rate = np.ones(pair_num)
+    tot_num = np.zeros(pair_num)
+    curr_samples = np.zeros(pair_num)
+
+    # record index dictionary for query index pair
+    idx = 0
+    index_dict = dict()
+    for i in range(valid_cls_num):
+        for j in range(i+1, len(valid_cls)):
+            index_dict[idx] = (valid_cls[i], valid_cls[j])
+            idx += 1
+
+    # samples of each class and their probability to be picked for a pair
+    # probability to be sampled is inversely proportional to the distance to "targeted" decision boundary
+    cls_index = {c: np.argwhere(predictions == c).squeeze(axis=1) for c in valid_cls}
+    pair_pvecs = dict()
+    for selected, (cls1, cls2) in index_dict.items():
+        conf1 = confs[cls_index[cls1]]
+        conf2 = confs[cls_index[cls2]]
+        pvec1 = 1 / (conf1[:, cls1] - conf1[:, cls2] + 1e-4)
+        pvec2 = 1 / (conf2[:, cls2] - conf2[:, cls1] + 1e-4)
+        pair_pvecs[selected] = (pvec1 / np.sum(pvec1), pvec2 / np.sum(pvec2))
+
+    adv_examples = torch.empty((num_adv_eg,) + tuple(input_x.shape[1:]), dtype=torch.float, device=device)
+    num_adv = 0
+
+    t0 = time.time()
+    while num_adv < num_adv_eg:
+        idxs = np.argwhere(tot_num != 0).squeeze()
+        succ = curr_samples[idxs] / tot_num[idxs]
+        succ_rate[idxs] = succ
+
+        curr_mean = np.mean(curr_samples)
+        curr_rate = curr_mean - curr_samples
+        curr_rate[curr_rate < 0] = 0
+        if np.std(curr_rate) == 0:
+            curr_rate = 1. / len(curr_rate)
+        else:
+            curr_rate = curr_rate / (1e-4 + np.sum(curr_rate))
+        p = a*succ_rate + (1-a)*curr_rate
+        p = p/(np.sum(p))
+
+        # no more pairs than needed, each pair gives at most two examples
+        round_size = min(batch_size, (num_adv_eg - num_adv + 1) // 2)
+        selected = np.random.choice(range(pair_num), size=round_size, p=p)
+        image1_idx = np.empty(round_size, dtype=np.int64)
+        image2_idx = np.empty(round_size, dtype=np.int64)
+        cls1 = np.empty(round_size, dtype=np.int64)
+        cls2 = np.empty(round_size, dtype=np.int64)
+        for pair in np.unique(selected):
+            mask = selected == pair
+            c1, c2 = index_dict[pair]
+            pvec1, pvec2 = pair_pvecs[pair]
+            image1_idx[mask] = cls_index[c1][np.random.choice(len(pvec1), size=mask.sum(), p=pvec1)]
+            image2_idx[mask] = cls_index[c2][np.random.choice(len(pvec2), size=mask.sum(), p=pvec2)]
+            cls1[mask] = c1
+            cls2[mask] = c2
+
+        image1 = input_x[torch.from_numpy(image1_idx).to(input_x.device)]
+        image2 = input_x[torch.from_numpy(image2_idx).to(input_x.device)]
+        # mix towards both classes of every pair
+        attacks, successful, _ = mixup_bi_batch(model, torch.cat((image1, image2)), torch.cat((image2, image1)),
+                                                np.concatenate((cls1, cls2)), np.concatenate((cls2, cls1)), device, l_bound=l_bound)
+        successful = successful.numpy()
+        pairs = np.concatenate((selected, selected))
+
+        succ_idxs = np.argwhere(successful).squeeze(axis=1)[:num_adv_eg - num_adv]
+        adv_examples[num_adv:num_adv + len(succ_idxs)] = attacks[torch.from_numpy(succ_idxs).to(attacks.device)]
+        num_adv += len(succ_idxs)
+        np.add.at(tot_num, pairs, 1)
+        np.add.at(curr_samples, pairs[succ_idxs], 1)
+
+    t1 = time.time()
+    if verbose:
+        print('Total time {:2f}'.format(t1 - t0))
+
+    return adv_examples, curr_samples, tot_num
+
+
 def batch_run(model, data, batch_size=200):
     """batch run, in case memory error"""
     data = data.to(dtype=torch.float)
@@ -277,48 +443,39 @@ def find_nearest(query):
     return indices[:, 1], distances[:, 1]
 
 
-def find_neighbor_preserving_rate(prev_data, train_data, n_neighbors):
+def find_neighbor_preserving_rate(prev_data, train_data, n_neighbors, prev_indices=None, train_indices=None):
     """
     neighbor preserving rate, (0, 1)
     :param prev_data: ndarray, shape(N,2) low dimensional embedding from last epoch
     :param train_data: ndarray, shape(N,2) low dimensional embedding from current epoch
     :param n_neighbors:
+    :param prev_indices: ndarray or None, precomputed kNN indices of prev_data, e.g. from KnnCache
+    :param train_indices: ndarray or None, precomputed kNN indices of train_data
     :return alpha: ndarray, shape (N,)
     """
     if prev_data is None:
         return np.zeros(len(train_data))
-    # number of trees in random projection forest
-    n_trees = min(64, 5 + int(round((train_data.shape[0]) ** 0.5 / 20.0)))
-    # max number of nearest neighbor iters to perform
-    n_iters = max(5, int(round(np.log2(train_data.shape[0]))))
-    # distance metric
-    from pynndescent import NNDescent
-    # get nearest neighbors
-    nnd = NNDescent(
-        train_data,
-        n_neighbors=n_neighbors,
-        metric="euclidean",
-        n_trees=n_trees,
-        n_iters=n_iters,
-        max_candidates=60,
-        verbose=True
-    )
-    train_indices, _ = nnd.neighbor_graph
-    prev_nnd = NNDescent(
-        prev_data,
-        n_neighbors=n_neighbors,
-        metric="euclidean",
-        n_trees=n_trees,
-        n_iters=n_iters,
-        max_candidates=60,
-        verbose=True
-    )
-    prev_indices, _ = prev_nnd.neighbor_graph
-    temporal_pres = np.zeros(len(train_data))
-    for i in range(len(train_indices)):
-        pres = np.intersect1d(train_indices[i], prev_indices[i])
-        temporal_pres[i] = len(pres) / float(n_neighbors)
-    return temporal_pres
+    if train_indices is None:
+        train_indices, _ = KnnCache.build(train_data, n_neighbors)
+    if prev_indices is None:
+        prev_indices, _ = KnnCache.build(prev_data, n_neighbors)
+    return knn_overlap(train_indices[:, :n_neighbors], prev_indices[:, :n_neighbors]) / float(n_neighbors)
+
+
+def epoch_neighbor_preserving_rate(data_provider, prev_epoch, epoch, prev_data, train_data, n_neighbors, split="train"):
+    """
+    find_neighbor_preserving_rate of two epochs, with the kNN graphs taken from data_provider.knn
+    so that the graph of an epoch is built once and reused as the previous epoch of the next one
+    :param split: str, KnnCache split the data belongs to
+    """
+    if prev_data is None:
+        return np.zeros(len(train_data))
+    knn = getattr(data_provider, "knn", None)
+    if knn is None:
+        return find_neighbor_preserving_rate(prev_data, train_data, n_neighbors)
+    prev_indices, _ = knn.get(prev_epoch, split, prev_data, n_neighbors)
+    train_indices, _ = knn.get(epoch, split, train_data, n_neighbors)
+    return find_neighbor_preserving_rate(prev_data, train_data, n_neighbors, prev_indices=prev_indices, train_indices=train_indices)
 
 
 def kl_div(p, q):
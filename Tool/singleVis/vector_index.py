@@ -0,0 +1,172 @@
+"""The VectorIndex class is an in-process IVF-Flat index for L2 similarity search over representations"""
+import os
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class VectorIndex:
+    """
+    Inverted-file index with exact (flat) distances inside the probed lists.
+
+    The vectors are clustered into nlist cells with k-means, each cell keeps the ids of its vectors
+    in one contiguous block, and a query scans the nprobe cells with the closest centroids.
+    With nprobe >= nlist the search is exact. Distances are squared L2, as Milvus reports for "L2".
+
+    Persisted as {name}.npz next to the source file (centroids, cell offsets and cell-ordered ids)
+    plus {name}.json with the source mtime, and rebuilt when the source file changes.
+    """
+    def __init__(self, vectors, nlist=None, n_iter=10, seed=0):
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        n = len(self.vectors)
+        self.nlist = nlist if nlist is not None else max(1, min(1024, int(np.sqrt(n))))
+        self.nlist = min(self.nlist, max(n, 1))
+        self.n_iter = n_iter
+        self.seed = seed
+        self.centroids = None
+        self.offsets = None
+        self.ids = None
+        self._cells = None
+
+    @property
+    def num_entities(self):
+        return len(self.vectors)
+
+    ################################################ build ###############################################
+    @staticmethod
+    def _sq_dists(a, b, b_sq=None):
+        # ||a||^2 - 2ab + ||b||^2, clipped for rounding
+        if b_sq is None:
+            b_sq = np.einsum("ij,ij->i", b, b)
+        d = np.einsum("ij,ij->i", a, a)[:, None] - 2 * a @ b.T + b_sq[None, :]
+        return np.maximum(d, 0)
+
+    def _assign(self, centroids, batch_size=8192):
+        assignment = np.empty(len(self.vectors), dtype=np.int64)
+        c_sq = np.einsum("ij,ij->i", centroids, centroids)
+        for start in range(0, len(self.vectors), batch_size):
+            batch = self.vectors[start:start + batch_size]
+            assignment[start:start + batch_size] = self._sq_dists(batch, centroids, c_sq).argmin(axis=1)
+        return assignment
+
+    def build(self):
+        rng = np.random.default_rng(self.seed)
+        n = len(self.vectors)
+        centroids = self.vectors[rng.choice(n, self.nlist, replace=False)].copy()
+        # k-means on a sample is enough to shape the cells
+        sample = self.vectors if n <= 256 * self.nlist else self.vectors[rng.choice(n, 256 * self.nlist, replace=False)]
+        c_sq = np.einsum("ij,ij->i", centroids, centroids)
+        for _ in range(self.n_iter):
+            labels = self._sq_dists(sample, centroids, c_sq).argmin(axis=1)
+            counts = np.bincount(labels, minlength=self.nlist)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            nonempty = counts > 0
+            centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+            c_sq = np.einsum("ij,ij->i", centroids, centroids)
+        self._set_cells(centroids, self._assign(centroids))
+        return self
+
+    def _set_cells(self, centroids, assignment):
+        self.centroids = centroids.astype(np.float32)
+        self.ids = np.argsort(assignment, kind="stable").astype(np.int64)
+        counts = np.bincount(assignment, minlength=len(centroids))
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        self._cells = self.vectors[self.ids]
+
+    ################################################ search ##############################################
+    def search(self, queries, k=5, nprobe=10):
+        """
+        :param queries: numpy.ndarray, (n_queries, dim)
+        :param k: int
+        :param nprobe: int, number of cells scanned per query
+        :return: (distances, ids), numpy.ndarray of shape (n_queries, k), sorted by distance,
+            ids are -1 and distances inf when fewer than k vectors were scanned
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        n_queries = len(queries)
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argsort(self._sq_dists(queries, self.centroids), axis=1)[:, :nprobe]
+
+        distances = np.full((n_queries, k), np.inf, dtype=np.float32)
+        ids = np.full((n_queries, k), -1, dtype=np.int64)
+        # cell-major, every probed cell is one matrix product against all queries probing it
+        probed = np.zeros((n_queries, len(self.centroids)), dtype=bool)
+        probed[np.arange(n_queries)[:, None], probes] = True
+        for c in np.flatnonzero(probed.any(axis=0)):
+            start, end = self.offsets[c], self.offsets[c + 1]
+            if start == end:
+                continue
+            qs = np.flatnonzero(probed[:, c])
+            d = np.concatenate((distances[qs], self._sq_dists(queries[qs], self._cells[start:end])), axis=1)
+            cand = np.concatenate((ids[qs], np.broadcast_to(self.ids[start:end], (len(qs), end - start))), axis=1)
+            top = np.argpartition(d, k - 1, axis=1)[:, :k] if d.shape[1] > k else np.argsort(d, axis=1)
+            distances[qs] = np.take_along_axis(d, top, axis=1)
+            ids[qs] = np.take_along_axis(cand, top, axis=1)
+        order = np.argsort(distances, axis=1, kind="stable")
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+    ############################################## persistence ###########################################
+    def save(self, path):
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, centroids=self.centroids, offsets=self.offsets, ids=self.ids)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, vectors):
+        with np.load(path) as f:
+            index = cls(vectors, nlist=len(f["centroids"]))
+            index.centroids = f["centroids"]
+            index.offsets = f["offsets"]
+            index.ids = f["ids"]
+        index._cells = index.vectors[index.ids]
+        return index
+
+
+# LRU of loaded indices, each holds two copies of its source file
+_indices = OrderedDict()
+_lock = threading.Lock()
+MAX_INDICES = 4
+
+
+def load_vector_index(source, name="vector_index", nlist=None):
+    """
+    IVF index over the rows of a .npy file, reused across calls and persisted next to the file
+    :param source: str, e.g. Epoch_N/train_data.npy
+    :param name: str, file name of the persisted index
+    :param nlist: int or None, number of cells, sqrt(n) by default
+    :return: VectorIndex
+    the MAX_INDICES most recently used indices stay in memory
+    """
+    source_mtime = os.path.getmtime(source)
+    with _lock:
+        entry = _indices.get((source, name))
+        if entry is not None and entry[0] == source_mtime:
+            _indices.move_to_end((source, name))
+            return entry[1]
+
+    index_dir = os.path.dirname(source)
+    index_path = os.path.join(index_dir, "{}.npz".format(name))
+    meta_path = os.path.join(index_dir, "{}.json".format(name))
+    vectors = np.load(source)
+    meta = None
+    if os.path.exists(meta_path) and os.path.exists(index_path):
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+    if meta is not None and meta["source_mtime"] == source_mtime and meta["n"] == len(vectors):
+        index = VectorIndex.load(index_path, vectors)
+    else:
+        index = VectorIndex(vectors, nlist=nlist).build()
+        index.save(index_path)
+        tmp_path = meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"source_mtime": source_mtime, "n": len(vectors), "nlist": index.nlist}, f)
+        os.replace(tmp_path, meta_path)
+    with _lock:
+        _indices[(source, name)] = (source_mtime, index)
+        _indices.move_to_end((source, name))
+        while len(_indices) > MAX_INDICES:
+            _indices.popitem(last=False)
+    return index
@@ -1,6 +1,7 @@
 from abc import ABC, abstractmethod
 
 import os
+import time
 
 import matplotlib.pyplot as plt
 import matplotlib as mpl
@@ -34,13 +35,159 @@ class VisualizerAbstractClass(ABC):
         pass
 
 class visualizer(VisualizerAbstractClass):
-    def __init__(self, data_provider, projector, resolution, cmap='tab10'):
+    def __init__(self, data_provider, projector, resolution, cmap='tab10', grid_chunk_size=10000, adaptive_grid=False, coarse_step=16, refine_margin=0.3):
         self.data_provider = data_provider
         self.projector = projector
         self.cmap = plt.get_cmap(cmap)
         self.classes = data_provider.classes
         self.class_num = len(self.classes)
         self.resolution= resolution
+        # number of grid points inverse-projected and predicted at once
+        self.grid_chunk_size = grid_chunk_size
+        # render backgrounds with the quadtree grid of _evaluate_grid_adaptive
+        self.adaptive_grid = adaptive_grid
+        self.coarse_step = coarse_step
+        self.refine_margin = refine_margin
+
+    def _evaluate_grid(self, inverse_fn, pred_fn, grid):
+        '''
+        stream grid points through the decoder and the subject model in chunks of self.grid_chunk_size
+        :param inverse_fn: callable, (n, 2) embedding -> (n, repr_dim) representation
+        :param pred_fn: callable, (n, repr_dim) representation -> (n, class_num) prediction
+        :param grid: numpy.ndarray, (N, 2)
+        :return:
+            mesh_classes : numpy.ndarray, (N,), predicted class of each grid point
+            diff : numpy.ndarray, float16, (N,), margin between top-2 confidences, 0 near the boundary
+        '''
+        num = len(grid)
+        mesh_classes = np.empty(num, dtype=np.uint8 if self.class_num <= 256 else np.int32)
+        diff = np.empty(num, dtype=np.float16)
+
+        t0 = time.time()
+        for start in range(0, num, self.grid_chunk_size):
+            end = min(start + self.grid_chunk_size, num)
+            mesh_preds = pred_fn(inverse_fn(grid[start:end]))
+            mesh_preds = mesh_preds + 1e-8
+
+            sort_preds = np.sort(mesh_preds, axis=1)
+            chunk_diff = (sort_preds[:, -1] - sort_preds[:, -2]) / (sort_preds[:, -1] - sort_preds[:, 0])
+            chunk_diff[chunk_diff < 0.15] = 0.
+
+            mesh_classes[start:end] = mesh_preds.argmax(axis=1)
+            diff[start:end] = chunk_diff
+        t1 = time.time()
+        print("Evaluated {:d} grid points in {:.2f}s ({:.0f} points/s)".format(num, t1 - t0, num / max(t1 - t0, 1e-8)))
+        return mesh_classes, diff
+
+    def _evaluate_grid_adaptive(self, inverse_fn, pred_fn, xs, ys, coarse_step=16, refine_margin=0.3):
+        '''
+        quadtree version of _evaluate_grid on the lattice meshgrid(xs, ys)
+        starting from every coarse_step-th point, a block is refined (its points at half the step evaluated)
+        only when its corners disagree in class or have a margin below refine_margin,
+        otherwise its interior takes the corner class and a bilinear interpolation of the corner margins
+        :param xs: numpy.ndarray, (W,), x coordinates of the columns
+        :param ys: numpy.ndarray, (H,), y coordinates of the rows
+        :param coarse_step: int, power of 2, lattice step of the first level
+        :param refine_margin: float, corners below this top-1/top-2 margin count as near the boundary
+        :return: mesh_classes, diff in the flattened order of meshgrid(xs, ys), see _evaluate_grid
+        '''
+        H, W = len(ys), len(xs)
+        mesh_classes = np.zeros((H, W), dtype=np.uint8 if self.class_num <= 256 else np.int32)
+        diff = np.zeros((H, W), dtype=np.float16)
+        known = np.zeros((H, W), dtype=bool)
+        active_px = np.ones((H, W), dtype=bool)
+
+        def lattice(n, step):
+            # block b covers pixels [idx[b], idx[b+1]), the last pixel belongs to the last block
+            idx = np.unique(np.r_[np.arange(0, n, step), n - 1])
+            if len(idx) == 1:
+                idx = np.array([0, 0])
+            sizes = np.maximum(np.diff(idx), 1)
+            blk = np.r_[np.repeat(np.arange(len(sizes)), np.diff(idx)), len(sizes) - 1][:n]
+            t = (np.arange(n) - idx[blk]) / sizes[blk]
+            return idx, blk, t
+
+        evaluated = 0
+        t0 = time.time()
+        step = coarse_step
+        while True:
+            r_idx, r_blk, r_t = lattice(H, step)
+            c_idx, c_blk, c_t = lattice(W, step)
+            active = active_px[np.ix_(r_idx[:-1], c_idx[:-1])]
+
+            # evaluate the unknown corners of active blocks
+            needed = np.zeros((len(r_idx), len(c_idx)), dtype=bool)
+            needed[:-1, :-1] |= active
+            needed[1:, :-1] |= active
+            needed[:-1, 1:] |= active
+            needed[1:, 1:] |= active
+            rows, cols = np.nonzero(needed)
+            # a side of a single pixel maps both corners of its block to the same pixel
+            rows, cols = np.divmod(np.unique(r_idx[rows] * W + c_idx[cols]), W)
+            todo = ~known[rows, cols]
+            rows, cols = rows[todo], cols[todo]
+            if len(rows):
+                points = np.stack((xs[cols], ys[rows]), axis=1)
+                mesh_classes[rows, cols], diff[rows, cols] = self._evaluate_grid(inverse_fn, pred_fn, points)
+                known[rows, cols] = True
+                evaluated += len(rows)
+            if step == 1:
+                break
+
+            # blocks deep inside one class region are filled from their corners
+            corners_cls = [mesh_classes[np.ix_(r, c)] for r in (r_idx[:-1], r_idx[1:]) for c in (c_idx[:-1], c_idx[1:])]
+            corners_diff = [diff[np.ix_(r, c)].astype(np.float32) for r in (r_idx[:-1], r_idx[1:]) for c in (c_idx[:-1], c_idx[1:])]
+            uniform = (corners_cls[0] == corners_cls[1]) & (corners_cls[0] == corners_cls[2]) & (corners_cls[0] == corners_cls[3])
+            uniform &= np.minimum.reduce(corners_diff) >= refine_margin
+
+            fill = (active & uniform)[np.ix_(r_blk, c_blk)] & ~known
+            if fill.any():
+                tr = r_t[:, None]
+                tc = c_t[None, :]
+                d00, d01, d10, d11 = [d[np.ix_(r_blk, c_blk)] for d in corners_diff]
+                interp = d00*(1-tr)*(1-tc) + d01*(1-tr)*tc + d10*tr*(1-tc) + d11*tr*tc
+                mesh_classes[fill] = corners_cls[0][np.ix_(r_blk, c_blk)][fill]
+                diff[fill] = interp[fill]
+                known |= fill
+
+            active_px = (active & ~uniform)[np.ix_(r_blk, c_blk)]
+            if not active_px.any():
+                break
+            step = max(step // 2, 1)
+
+        # anything left, e.g. with a step that is not a power of 2
+        rows, cols = np.nonzero(~known)
+        if len(rows):
+            points = np.stack((xs[cols], ys[rows]), axis=1)
+            mesh_classes[rows, cols], diff[rows, cols] = self._evaluate_grid(inverse_fn, pred_fn, points)
+            evaluated += len(rows)
+        t1 = time.time()
+        print("Adaptive grid: evaluated {:d}/{:d} points ({:.1f}%) in {:.2f}s".format(evaluated, H*W, 100.*evaluated/(H*W), t1 - t0))
+        return mesh_classes.reshape(-1), diff.reshape(-1)
+
+    def _decision_colors(self, mesh_classes, diff, diff_max=None, mesh_max_class=None):
+        '''
+        blend class colors with white according to the confidence margin
+        :return:
+            color : numpy.ndarray, float32, (N, 3)
+            diff_max : float
+            mesh_max_class : int
+        '''
+        if diff_max is None:
+            diff_max = float(diff.max())
+        diff = diff.astype(np.float32)/(diff_max+1e-8)
+        diff = np.clip(diff, 0., 1.)*0.9
+        diff = diff.reshape(-1, 1)
+
+        if mesh_max_class is None:
+            mesh_max_class = int(mesh_classes.max())
+        # classes above mesh_max_class get the last color of the colormap
+        palette = self.cmap(np.arange(max(int(mesh_classes.max()), mesh_max_class) + 1) / mesh_max_class)
+        palette = palette[:, 0:3].astype(np.float32)
+        color = palette[mesh_classes]
+
+        color = diff * 0.5 * color + (1 - diff)
+        return color, diff_max, mesh_max_class
 
     def _init_plot(self, only_img=False):
         '''
@@ -156,32 +303,78 @@ class visualizer(VisualizerAbstractClass):
         grid = np.array(np.meshgrid(xs, ys))
         grid = np.swapaxes(grid.reshape(grid.shape[0], -1), 0, 1)
 
-        # map gridmpoint to images
-        grid_samples = self.projector.batch_inverse(epoch, grid)
-
-        mesh_preds = self.data_provider.get_pred(epoch, grid_samples)
-        mesh_preds = mesh_preds + 1e-8
-
-        sort_preds = np.sort(mesh_preds, axis=1)
-        diff = (sort_preds[:, -1] - sort_preds[:, -2]) / (sort_preds[:, -1] - sort_preds[:, 0])
-        border = np.zeros(len(diff), dtype=np.uint8) + 0.05
-        border[diff < 0.15] = 1
-        diff[border == 1] = 0.
+        color, _, _ = self.get_lattice_decision_colors(epoch, xs, ys)
+        decision_view = color.reshape(resolution, resolution, 3)
+        grid_view = grid.reshape(resolution, resolution, 2)
+        return grid_view, decision_view
 
-        diff = diff/(diff.max()+1e-8)
-        diff = diff*0.9
+    def get_epoch_decision_view_adaptive(self, epoch, resolution, xy_limit=None, coarse_step=16, refine_margin=0.3):
+        '''
+        same as get_epoch_decision_view, but only refines the grid near decision boundaries
+        :param epoch_id: epoch that need to be visualized
+        :param resolution: background resolution
+        :param coarse_step: int, power of 2, spacing of the first evaluated lattice
+        :param refine_margin: float, blocks whose corners have a lower top-1/top-2 margin are refined
+        :return:
+            grid_view : numpy.ndarray, self.resolution,self.resolution, 2
+            decision_view : numpy.ndarray, self.resolution,self.resolution, 3
+        '''
+        print('Computing decision regions (adaptive) ...')
 
-        mesh_classes = mesh_preds.argmax(axis=1)
-        mesh_max_class = max(mesh_classes)
-        color = self.cmap(mesh_classes / mesh_max_class)
+        if xy_limit is None:
+            x_min, y_min, x_max, y_max = self.get_epoch_plot_measures(epoch)
+        else:
+            x_min, y_min, x_max, y_max = xy_limit
 
-        diff = diff.reshape(-1, 1)
+        xs = np.linspace(x_min, x_max, resolution)
+        ys = np.linspace(y_min, y_max, resolution)
+        grid = np.array(np.meshgrid(xs, ys))
+        grid = np.swapaxes(grid.reshape(grid.shape[0], -1), 0, 1)
 
-        color = color[:, 0:3]
-        color = diff * 0.5 * color + (1 - diff) * np.ones(color.shape, dtype=np.uint8)
+        mesh_classes, diff = self._evaluate_grid_adaptive(
+            lambda emb: self.projector.batch_inverse(epoch, emb),
+            lambda data: self.data_provider.get_pred(epoch, data),
+            xs, ys, coarse_step=coarse_step, refine_margin=refine_margin)
+        color, _, _ = self._decision_colors(mesh_classes, diff)
         decision_view = color.reshape(resolution, resolution, 3)
         grid_view = grid.reshape(resolution, resolution, 2)
         return grid_view, decision_view
+
+    def get_grid_decision_colors(self, epoch, grid, diff_max=None, mesh_max_class=None):
+        '''
+        color 2d grid points by the prediction of their inverse projection
+        :param epoch: epoch that need to be visualized
+        :param grid: numpy.ndarray, (N, 2)
+        :param diff_max: normalization of the confidence margin, None to use the max over grid
+        :param mesh_max_class: largest class index of the colormap, None to use the max over grid
+        :return:
+            color : numpy.ndarray, (N, 3)
+            diff_max : float
+            mesh_max_class : int
+        '''
+        # map gridmpoint to images
+        mesh_classes, diff = self._evaluate_grid(
+            lambda emb: self.projector.batch_inverse(epoch, emb),
+            lambda data: self.data_provider.get_pred(epoch, data),
+            grid)
+        return self._decision_colors(mesh_classes, diff, diff_max, mesh_max_class)
+
+    def get_lattice_decision_colors(self, epoch, xs, ys, diff_max=None, mesh_max_class=None):
+        '''
+        get_grid_decision_colors on the lattice meshgrid(xs, ys), with the quadtree grid if self.adaptive_grid
+        :param xs: numpy.ndarray, (W,), x coordinates of the columns
+        :param ys: numpy.ndarray, (H,), y coordinates of the rows
+        :return: color in the flattened order of meshgrid(xs, ys), diff_max, mesh_max_class
+        '''
+        if not self.adaptive_grid:
+            grid = np.array(np.meshgrid(xs, ys))
+            grid = np.swapaxes(grid.reshape(grid.shape[0], -1), 0, 1)
+            return self.get_grid_decision_colors(epoch, grid, diff_max, mesh_max_class)
+        mesh_classes, diff = self._evaluate_grid_adaptive(
+            lambda emb: self.projector.batch_inverse(epoch, emb),
+            lambda data: self.data_provider.get_pred(epoch, data),
+            xs, ys, coarse_step=self.coarse_step, refine_margin=self.refine_margin)
+        return self._decision_colors(mesh_classes, diff, diff_max, mesh_max_class)
     
     def savefig(self, epoch, path="vis"):
         '''
@@ -409,28 +602,11 @@ class DenseALvisualizer(visualizer):
         grid = np.swapaxes(grid.reshape(grid.shape[0], -1), 0, 1)
 
         # map gridmpoint to images
-        grid_samples = self.projector.batch_inverse(iteration, epoch, grid)
-
-        mesh_preds = self.data_provider.get_pred(iteration, epoch, grid_samples)
-        mesh_preds = mesh_preds + 1e-8
-
-        sort_preds = np.sort(mesh_preds, axis=1)
-        diff = (sort_preds[:, -1] - sort_preds[:, -2]) / (sort_preds[:, -1] - sort_preds[:, 0])
-        border = np.zeros(len(diff), dtype=np.uint8) + 0.05
-        border[diff < 0.15] = 1
-        diff[border == 1] = 0.
-
-        diff = diff/(diff.max()+1e-8)
-        diff = diff*0.9
-
-        mesh_classes = mesh_preds.argmax(axis=1)
-        mesh_max_class = max(mesh_classes)
-        color = self.cmap(mesh_classes / mesh_max_class)
-
-        diff = diff.reshape(-1, 1)
-
-        color = color[:, 0:3]
-        color = diff * 0.5 * color + (1 - diff) * np.ones(color.shape, dtype=np.uint8)
+        mesh_classes, diff = self._evaluate_grid(
+            lambda emb: self.projector.batch_inverse(iteration, epoch, emb),
+            lambda data: self.data_provider.get_pred(iteration, epoch, data),
+            grid)
+        color, _, _ = self._decision_colors(mesh_classes, diff)
         decision_view = color.reshape(resolution, resolution, 3)
         grid_view = grid.reshape(resolution, resolution, 2)
         return grid_view, decision_view
@@ -15,7 +15,7 @@ from umap.umap_ import find_ab_params
 from singleVis.custom_weighted_random_sampler import CustomWeightedRandomSampler
 from singleVis.SingleVisualizationModel import VisModel, tfModel
 from singleVis.losses import HybridLoss, SmoothnessLoss, UmapLoss, ReconstructionLoss, TemporalLoss, DVILoss, SingleVisLoss, umap_loss, reconstruction_loss, regularize_loss,DummyTemporalLoss
-from singleVis.edge_dataset import HybridDataHandler, DVIDataHandler, DataHandler, construct_edge_dataset
+from singleVis.edge_dataset import HybridDataHandler, DVIDataHandler, DataHandler, TensorEdgeLoader, construct_edge_dataset
 from singleVis.trainer import HybridVisTrainer, DVITrainer, SingleVisTrainer
 from singleVis.data import DataProviderAbstractClass, NormalDataProvider, ActiveLearningDataProvider, DenseActiveLearningDataProvider
 from singleVis.spatial_edge_constructor import kcHybridSpatialEdgeConstructor, SingleEpochSpatialEdgeConstructor, kcSpatialEdgeConstructor, tfEdgeConstructor
@@ -27,7 +27,7 @@ from singleVis.projector import DeepDebuggerProjector, DVIProjector, ProjectorAb
 from singleVis.segmenter import Segmenter
 from singleVis.eval.evaluator import Evaluator, ALEvaluator, EvaluatorAbstractClass, DenseALEvaluator
 from singleVis.visualizer import VisualizerAbstractClass, visualizer, DenseALvisualizer
-from singleVis.utils import find_neighbor_preserving_rate
+from singleVis.utils import epoch_neighbor_preserving_rate
 
 class StrategyAbstractClass(ABC):
     def __init__(self, CONTENT_PATH, config):
@@ -68,6 +68,12 @@ class StrategyAbstractClass(ABC):
     
     @vis.setter
     def vis(self, visualizer:VisualizerAbstractClass)->None:
+        # VISUALIZATION.ADAPTIVE_GRID renders backgrounds and tiles with the quadtree grid
+        VISUALIZATION_PARAMETER = self.config["VISUALIZATION"]
+        if hasattr(visualizer, "adaptive_grid"):
+            visualizer.adaptive_grid = VISUALIZATION_PARAMETER.get("ADAPTIVE_GRID", False)
+            visualizer.coarse_step = VISUALIZATION_PARAMETER.get("ADAPTIVE_COARSE_STEP", visualizer.coarse_step)
+            visualizer.refine_margin = VISUALIZATION_PARAMETER.get("ADAPTIVE_REFINE_MARGIN", visualizer.refine_margin)
         self._vis = visualizer
     
     @abstractmethod
@@ -97,6 +103,24 @@ class StrategyAbstractClass(ABC):
         self._evaluate()
         self._visualize()
 
+    def _evaluate_epochs(self):
+        """evaluate every epoch of the run with self.evaluator, through the metric runner if EVALUATION_METRICS is set"""
+        EPOCH_START = self.config["EPOCH_START"]
+        EPOCH_END = self.config["EPOCH_END"]
+        EPOCH_PERIOD = self.config["EPOCH_PERIOD"]
+        VISUALIZATION_PARAMETER = self.config["VISUALIZATION"]
+        EVALUATION_NAME = VISUALIZATION_PARAMETER["EVALUATION_NAME"]
+        N_NEIGHBORS = VISUALIZATION_PARAMETER["N_NEIGHBORS"]
+        eval_epochs = list(range(EPOCH_START, EPOCH_END+1, EPOCH_PERIOD))
+        # "EVALUATION_METRICS": "all" or a list of metric names opts into the parallel, resumable runner
+        EVALUATION_METRICS = VISUALIZATION_PARAMETER.get("EVALUATION_METRICS")
+        if EVALUATION_METRICS is not None:
+            self.evaluator.save_eval(eval_epochs, N_NEIGHBORS, temporal_k=5, file_name="{}".format(EVALUATION_NAME),
+                                     metrics=EVALUATION_METRICS, workers=VISUALIZATION_PARAMETER.get("EVALUATION_WORKERS", 1))
+            return
+        for eval_epoch in eval_epochs:
+            self.evaluator.save_epoch_eval(eval_epoch, N_NEIGHBORS, temporal_k=5, file_name="{}".format(EVALUATION_NAME))
+
 class DeepVisualInsight(StrategyAbstractClass):
     def __init__(self, CONTENT_PATH, config):
         super().__init__(CONTENT_PATH, config)
@@ -134,7 +158,8 @@ class DeepVisualInsight(StrategyAbstractClass):
         import Model.model as subject_model
         net = eval("subject_model.{}()".format(NET))
 
-        self._data_provider = NormalDataProvider(self.CONTENT_PATH, net, EPOCH_START, EPOCH_END, EPOCH_PERIOD, device=self.DEVICE, classes=CLASSES, epoch_name=EPOCH_NAME, verbose=1)
+        self._data_provider = NormalDataProvider(self.CONTENT_PATH, net, EPOCH_START, EPOCH_END, EPOCH_PERIOD, device=self.DEVICE, classes=CLASSES, epoch_name=EPOCH_NAME, verbose=1,
+            consolidate=VISUALIZATION_PARAMETER.get("CONSOLIDATE", False), consolidate_dtype=VISUALIZATION_PARAMETER.get("CONSOLIDATE_DTYPE", "float32"))
         self.model = VisModel(ENCODER_DIMS, DECODER_DIMS)
         negative_sample_rate = 5
         min_dist = .1
@@ -195,7 +220,7 @@ class DeepVisualInsight(StrategyAbstractClass):
                 # TODO AL mode, redefine train_representation
                 prev_data = self.data_provider.train_representation(iteration-EPOCH_PERIOD)
                 curr_data = self.data_provider.train_representation(iteration)
-                npr = find_neighbor_preserving_rate(prev_data, curr_data, N_NEIGHBORS)
+                npr = epoch_neighbor_preserving_rate(self.data_provider, iteration-EPOCH_PERIOD, iteration, prev_data, curr_data, N_NEIGHBORS)
                 criterion = DVILoss(self.umap_fn, self.recon_fn, self.temporal_fn, lambd1=LAMBDA1, lambd2=LAMBDA2*npr)
             # Define training parameters
             optimizer = torch.optim.Adam(self.model.parameters(), lr=.01, weight_decay=1e-5)
@@ -212,15 +237,9 @@ class DeepVisualInsight(StrategyAbstractClass):
             edge_from = edge_from[eliminate_zeros]
             probs = probs[eliminate_zeros]
             
-            dataset = DVIDataHandler(edge_to, edge_from, feature_vectors, attention, w_prev)
-
             n_samples = int(np.sum(S_N_EPOCHS * probs) // 1)
-            # chose sampler based on the number of dataset
-            if len(edge_to) > 2^24:
-                sampler = CustomWeightedRandomSampler(probs, n_samples, replacement=True)
-            else:
-                sampler = WeightedRandomSampler(probs, n_samples, replacement=True)
-            edge_loader = DataLoader(dataset, batch_size=1000, sampler=sampler)
+            # batches are sampled and gathered as whole tensors, no per-edge collation
+            edge_loader = TensorEdgeLoader(edge_to, edge_from, feature_vectors, attention, probs, n_samples, batch_size=1000, device=self.DEVICE)
 
             ########################################################################################################################
             #                                                       TRAIN                                                          #
@@ -256,15 +275,7 @@ class DeepVisualInsight(StrategyAbstractClass):
             self.vis.savefig(i, path=os.path.join(save_dir, "{}_{}.png".format(self.VIS_METHOD, i)))
 
     def _evaluate(self):
-        EPOCH_START = self.config["EPOCH_START"]
-        EPOCH_END = self.config["EPOCH_END"]
-        EPOCH_PERIOD = self.config["EPOCH_PERIOD"]
-        VISUALIZATION_PARAMETER = self.config["VISUALIZATION"]
-        EVALUATION_NAME = VISUALIZATION_PARAMETER["EVALUATION_NAME"]
-        N_NEIGHBORS = VISUALIZATION_PARAMETER["N_NEIGHBORS"]
-        eval_epochs = list(range(EPOCH_START, EPOCH_END+1, EPOCH_PERIOD))
-        for eval_epoch in eval_epochs:
-            self.evaluator.save_epoch_eval(eval_epoch, N_NEIGHBORS, temporal_k=5, file_name="{}".format(EVALUATION_NAME))
+        self._evaluate_epochs()
 
 
     def visualize_embedding(self):
@@ -304,7 +315,8 @@ class tfDeepVisualInsight(StrategyAbstractClass):
         import Model.model as subject_model
         net = eval("subject_model.{}()".format(NET))
 
-        self.data_provider = NormalDataProvider(self.CONTENT_PATH, net, EPOCH_START, EPOCH_END, EPOCH_PERIOD, device=self.DEVICE, classes=CLASSES, epoch_name=EPOCH_NAME, verbose=1)
+        self.data_provider = NormalDataProvider(self.CONTENT_PATH, net, EPOCH_START, EPOCH_END, EPOCH_PERIOD, device=self.DEVICE, classes=CLASSES, epoch_name=EPOCH_NAME, verbose=1,
+            consolidate=VISUALIZATION_PARAMETER.get("CONSOLIDATE", False), consolidate_dtype=VISUALIZATION_PARAMETER.get("CONSOLIDATE_DTYPE", "float32"))
         
         # Define Projector
         self.flag = "_temporal_id{}".format("_withoutB" if B_N_EPOCHS==0 else "")
@@ -434,15 +446,7 @@ class tfDeepVisualInsight(StrategyAbstractClass):
             self.vis.savefig(i, path=os.path.join(save_dir, "{}_{}.png".format(self.VIS_METHOD, i)))
 
     def _evaluate(self):
-        EPOCH_START = self.config["EPOCH_START"]
-        EPOCH_END = self.config["EPOCH_END"]
-        EPOCH_PERIOD = self.config["EPOCH_PERIOD"]
-        VISUALIZATION_PARAMETER = self.config["VISUALIZATION"]
-        EVALUATION_NAME = VISUALIZATION_PARAMETER["EVALUATION_NAME"]
-        N_NEIGHBORS = VISUALIZATION_PARAMETER["N_NEIGHBORS"]
-        eval_epochs = list(range(EPOCH_START, EPOCH_END+1, EPOCH_PERIOD))
-        for eval_epoch in eval_epochs:
-            self.evaluator.save_epoch_eval(eval_epoch, N_NEIGHBORS, temporal_k=5, file_name="{}".format(EVALUATION_NAME))
+        self._evaluate_epochs()
 
     def visualize_embedding(self):
         self._preprocess()
@@ -487,7 +491,8 @@ class Trustvis(StrategyAbstractClass):
         import Model.model as subject_model
         net = eval("subject_model.{}()".format(NET))
 
-        self._data_provider = NormalDataProvider(self.CONTENT_PATH, net, EPOCH_START, EPOCH_END, EPOCH_PERIOD, device=self.DEVICE, classes=CLASSES, epoch_name=EPOCH_NAME, verbose=1)
+        self._data_provider = NormalDataProvider(self.CONTENT_PATH, net, EPOCH_START, EPOCH_END, EPOCH_PERIOD, device=self.DEVICE, classes=CLASSES, epoch_name=EPOCH_NAME, verbose=1,
+            consolidate=VISUALIZATION_PARAMETER.get("CONSOLIDATE", False), consolidate_dtype=VISUALIZATION_PARAMETER.get("CONSOLIDATE_DTYPE", "float32"))
         self.model = VisModel(ENCODER_DIMS, DECODER_DIMS)
         negative_sample_rate = 5
         min_dist = .1
@@ -550,7 +555,7 @@ class Trustvis(StrategyAbstractClass):
                 # TODO AL mode, redefine train_representation
                 prev_data = self.data_provider.train_representation(iteration-EPOCH_PERIOD)
                 curr_data = self.data_provider.train_representation(iteration)
-                npr = find_neighbor_preserving_rate(prev_data, curr_data, N_NEIGHBORS)
+                npr = epoch_neighbor_preserving_rate(self.data_provider, iteration-EPOCH_PERIOD, iteration, prev_data, curr_data, N_NEIGHBORS)
                 self.temporal_fn = TemporalLoss(w_prev, self.DEVICE)
                 criterion = DVILoss(self.umap_fn, self.recon_fn, self.temporal_fn, lambd1=LAMBDA1, lambd2=LAMBDA2*npr)
             # Define training parameters
@@ -560,10 +565,6 @@ class Trustvis(StrategyAbstractClass):
             t0 = time.time()
             spatial_cons = TrustvisSpatialEdgeConstructor(self.data_provider, iteration, S_N_EPOCHS, B_N_EPOCHS, N_NEIGHBORS, 0.7)
             edge_to, edge_from, probs, feature_vectors, attention, b_edge_to, b_edge_from, b_probs = spatial_cons.construct()
-            # non-bon be 0
-            labels_non_boundary = np.zeros(len(edge_to))
-            # bon be 1
-            labels_boundary = np.ones(len(b_edge_to))
 
             t1 = time.time()
             print("length of boundary and pred_Same:",len(b_edge_to), len(edge_to))
@@ -575,16 +576,12 @@ class Trustvis(StrategyAbstractClass):
             edge_to = edge_to[eliminate_zeros]
             edge_from = edge_from[eliminate_zeros]
             probs = probs[eliminate_zeros]
-            dataset = DVIDataHandler(edge_to, edge_from, feature_vectors, attention, labels_non_boundary)
+            # non-bon be 0
+            labels_non_boundary = np.zeros(len(edge_to))
 
             n_samples = int(np.sum(S_N_EPOCHS * probs) // 1)
-            # chose sampler based on the number of dataset
-            if len(edge_to) > pow(2,24):
-                sampler = CustomWeightedRandomSampler(probs, n_samples, replacement=True)
-            else:
-                sampler = WeightedRandomSampler(probs, n_samples, replacement=True)
-
-            edge_loader = DataLoader(dataset, batch_size=2000, sampler=sampler, num_workers=8, prefetch_factor=10)
+            # batches are sampled and gathered as whole tensors, no per-edge collation
+            edge_loader = TensorEdgeLoader(edge_to, edge_from, feature_vectors, attention, probs, n_samples, batch_size=2000, edge_labels=labels_non_boundary, device=self.DEVICE)
 
             #################################################### for border start ############################################################
             b_probs = b_probs / (b_probs.max()+1e-3)
@@ -592,27 +589,19 @@ class Trustvis(StrategyAbstractClass):
             b_edge_to = b_edge_to[b_eliminate_zeros]
             b_edge_from = b_edge_from[b_eliminate_zeros]
             b_probs = b_probs[b_eliminate_zeros]
+            # bon be 1
+            labels_boundary = np.ones(len(b_edge_to))
 
-            b_dataset = DVIDataHandler(b_edge_to, b_edge_from, feature_vectors, attention,labels_boundary)
             b_n_samples = int(np.sum(S_N_EPOCHS * b_probs) // 1)
             print("b_n_samples",b_n_samples, n_samples)
-            if len(b_edge_to) > pow(2,24):
-                b_sampler = CustomWeightedRandomSampler(b_probs, b_n_samples, replacement=True)
-            else:
-                b_sampler = WeightedRandomSampler(b_probs, b_n_samples, replacement=True)
-
-            b_edge_loader = DataLoader(b_dataset, batch_size=2000, sampler=b_sampler, num_workers=8, prefetch_factor=10)
-
-            
 
             #################################################### for border end  ############################################################
 
 
             # combined_sampler = ShuffleConcatSampler(dataset, b_dataset, probs, b_probs, n_samples, b_n_samples)
-            combined_dataset = ConcatDataset([dataset, b_dataset])
-
-            combine_sampler = WeightedRandomSampler(np.concatenate((probs,b_probs),axis=0), n_samples+b_n_samples, replacement=True)
-            combined_loader = DataLoader(combined_dataset, batch_size=2000, sampler=combine_sampler, num_workers=8)
+            combined_loader = TensorEdgeLoader(np.concatenate((edge_to, b_edge_to), axis=0), np.concatenate((edge_from, b_edge_from), axis=0),
+                                               feature_vectors, attention, np.concatenate((probs,b_probs),axis=0), n_samples+b_n_samples,
+                                               batch_size=2000, edge_labels=np.concatenate((labels_non_boundary, labels_boundary), axis=0), device=self.DEVICE)
 
             ########################################################################################################################
             #                                                       TRAIN                                                          #
@@ -628,6 +617,7 @@ class Trustvis(StrategyAbstractClass):
             save_dir = self.data_provider.model_path
             trainer.record_time(save_dir, "time_{}.json".format(VIS_MODEL_NAME), "complex_construction", str(iteration), t1-t0)
             trainer.record_time(save_dir, "time_{}.json".format(VIS_MODEL_NAME), "training", str(iteration), t3-t2)
+            trainer.record_time(save_dir, "time_{}.json".format(VIS_MODEL_NAME), "merge_complexes", str(iteration), spatial_cons.merge_time)
             save_dir = os.path.join(self.data_provider.model_path, "Epoch_{}".format(iteration))
             trainer.save(save_dir=save_dir, file_name="{}".format(VIS_MODEL_NAME))
 
@@ -648,15 +638,7 @@ class Trustvis(StrategyAbstractClass):
             self.vis.savefig(i, path=os.path.join(save_dir, "{}_{}.png".format(self.VIS_METHOD, i)))
 
     def _evaluate(self):
-        EPOCH_START = self.config["EPOCH_START"]
-        EPOCH_END = self.config["EPOCH_END"]
-        EPOCH_PERIOD = self.config["EPOCH_PERIOD"]
-        VISUALIZATION_PARAMETER = self.config["VISUALIZATION"]
-        EVALUATION_NAME = VISUALIZATION_PARAMETER["EVALUATION_NAME"]
-        N_NEIGHBORS = VISUALIZATION_PARAMETER["N_NEIGHBORS"]
-        eval_epochs = list(range(EPOCH_START, EPOCH_END+1, EPOCH_PERIOD))
-        for eval_epoch in eval_epochs:
-            self.evaluator.save_epoch_eval(eval_epoch, N_NEIGHBORS, temporal_k=5, file_name="{}".format(EVALUATION_NAME))
+        self._evaluate_epochs()
 
 
     def visualize_embedding(self):
@@ -702,7 +684,8 @@ class TimeVis(StrategyAbstractClass):
         import Model.model as subject_model
         net = eval("subject_model.{}()".format(NET))
 
-        self.data_provider = NormalDataProvider(self.CONTENT_PATH, net, EPOCH_START, EPOCH_END, EPOCH_PERIOD, device=self.DEVICE, classes=CLASSES, epoch_name=EPOCH_NAME, verbose=1)
+        self.data_provider = NormalDataProvider(self.CONTENT_PATH, net, EPOCH_START, EPOCH_END, EPOCH_PERIOD, device=self.DEVICE, classes=CLASSES, epoch_name=EPOCH_NAME, verbose=1,
+            consolidate=VISUALIZATION_PARAMETER.get("CONSOLIDATE", False), consolidate_dtype=VISUALIZATION_PARAMETER.get("CONSOLIDATE_DTYPE", "float32"))
         self.model = VisModel(ENCODER_DIMS, DECODER_DIMS)
         negative_sample_rate = 5
         min_dist = .1
@@ -761,14 +744,9 @@ class TimeVis(StrategyAbstractClass):
         edge_from = edge_from[eliminate_zeros]
         probs = probs[eliminate_zeros]
 
-        dataset = DataHandler(edge_to, edge_from, feature_vectors, attention)
         n_samples = int(np.sum(S_N_EPOCHS * probs) // 1)
-        # chose sampler based on the number of dataset
-        if len(edge_to) > 2^24:
-            sampler = CustomWeightedRandomSampler(probs, n_samples, replacement=True)
-        else:
-            sampler = WeightedRandomSampler(probs, n_samples, replacement=True)
-        edge_loader = DataLoader(dataset, batch_size=1000, sampler=sampler)
+        # batches are sampled and gathered as whole tensors, no per-edge collation
+        edge_loader = TensorEdgeLoader(edge_to, edge_from, feature_vectors, attention, probs, n_samples, batch_size=1000, device=self.DEVICE)
 
         ########################################################################################################################
         #                                                       TRAIN                                                          #
@@ -789,7 +767,7 @@ class TimeVis(StrategyAbstractClass):
         EPOCH_END = self.config["EPOCH_END"]
         EPOCH_PERIOD = self.config["EPOCH_PERIOD"]
 
-        self._vis = visualizer(self.data_provider, self.projector, 200, "plasma")
+        self.vis = visualizer(self.data_provider, self.projector, 200, "plasma")
         save_dir = os.path.join(self.data_provider.content_path, "img")
         if not os.path.exists(save_dir):
             os.mkdir(save_dir)
@@ -797,16 +775,8 @@ class TimeVis(StrategyAbstractClass):
             self.vis.savefig(i, path=os.path.join(save_dir, "{}_{}.png".format(self.VIS_METHOD, i)))
 
     def _evaluate(self):
-        EPOCH_START = self.config["EPOCH_START"]
-        EPOCH_END = self.config["EPOCH_END"]
-        EPOCH_PERIOD = self.config["EPOCH_PERIOD"]
-        VISUALIZATION_PARAMETER = self.config["VISUALIZATION"]
-        EVALUATION_NAME = VISUALIZATION_PARAMETER["EVALUATION_NAME"]
-        N_NEIGHBORS = VISUALIZATION_PARAMETER["N_NEIGHBORS"]
-        eval_epochs = list(range(EPOCH_START, EPOCH_END+1, EPOCH_PERIOD))
         self.evaluator = Evaluator(self.data_provider, self.projector)
-        for eval_epoch in eval_epochs:
-            self.evaluator.save_epoch_eval(eval_epoch, N_NEIGHBORS, temporal_k=5, file_name="{}".format(EVALUATION_NAME))
+        self._evaluate_epochs()
 
 
     def visualize_embedding(self):
@@ -853,7 +823,8 @@ class DeepDebugger(StrategyAbstractClass):
         import Model.model as subject_model
         net = eval("subject_model.{}()".format(NET))
 
-        self.data_provider = NormalDataProvider(self.CONTENT_PATH, net, EPOCH_START, EPOCH_END, EPOCH_PERIOD, device=self.DEVICE, classes=CLASSES, epoch_name=EPOCH_NAME, verbose=1)        
+        self.data_provider = NormalDataProvider(self.CONTENT_PATH, net, EPOCH_START, EPOCH_END, EPOCH_PERIOD, device=self.DEVICE, classes=CLASSES, epoch_name=EPOCH_NAME, verbose=1,
+            consolidate=VISUALIZATION_PARAMETER.get("CONSOLIDATE", False), consolidate_dtype=VISUALIZATION_PARAMETER.get("CONSOLIDATE_DTYPE", "float32"))        
         self.model = VisModel(ENCODER_DIMS, DECODER_DIMS)
         negative_sample_rate = 5
         min_dist = .1
@@ -862,7 +833,7 @@ class DeepDebugger(StrategyAbstractClass):
         recon_loss_fn = ReconstructionLoss(beta=1.0)
         smooth_loss_fn = SmoothnessLoss(margin=0.5)
         self.criterion = HybridLoss(umap_loss_fn, recon_loss_fn, smooth_loss_fn, lambd1=LAMBDA, lambd2=S_LAMBDA)
-        self.segmenter = Segmenter(data_provider=self.data_provider, threshold=78.5, range_s=EPOCH_START, range_e=EPOCH_END, range_p=EPOCH_PERIOD)
+        self.segmenter = Segmenter(data_provider=self.data_provider, threshold=VISUALIZATION_PARAMETER.get("SEGMENT_THRESHOLD", 78.5), range_s=EPOCH_START, range_e=EPOCH_END, range_p=EPOCH_PERIOD, workers=VISUALIZATION_PARAMETER.get("SEGMENT_WORKERS", 1))
         self.projector = DeepDebuggerProjector(vis_model=self.model, content_path=self.CONTENT_PATH,vis_model_name=VIS_MODEL_NAME, segments=None, device=self.DEVICE)
         self.vis = visualizer(self.data_provider, self.projector, 200, "tab10")
         self.evaluator = Evaluator(self.data_provider, self.projector)
@@ -881,11 +852,12 @@ class DeepDebugger(StrategyAbstractClass):
             if B_N_EPOCHS >0:
                 self.data_provider._estimate_boundary(LEN//10, l_bound=L_BOUND)
     
-    def _segment(self):
+    def _segment(self, threshold=None):
+        # the interval distances are persisted by the segmenter, another threshold only re-segments them
         VISUALIZATION_PARAMETER = self.config["VISUALIZATION"]
         VIS_MODEL_NAME = VISUALIZATION_PARAMETER["VIS_MODEL_NAME"]
         t0 = time.time()
-        SEGMENTS = self.segmenter.segment()
+        SEGMENTS = self.segmenter.segment(threshold)
         t1 = time.time()
         self.projector.segments = SEGMENTS
         self.segmenter.record_time(self.data_provider.model_path, "time_{}.json".format(VIS_MODEL_NAME), t1-t0)
@@ -939,14 +911,9 @@ class DeepDebugger(StrategyAbstractClass):
             edge_from = edge_from[eliminate_zeros]
             probs = probs[eliminate_zeros]
 
-            dataset = HybridDataHandler(edge_to, edge_from, feature_vectors, attention, embedded, coefficient)
             n_samples = int(np.sum(S_N_EPOCHS * probs) // 1)
-            # chose sampler based on the number of dataset
-            if len(edge_to) > 2^24:
-                sampler = CustomWeightedRandomSampler(probs, n_samples, replacement=True)
-            else:
-                sampler = WeightedRandomSampler(probs, n_samples, replacement=True)
-            edge_loader = DataLoader(dataset, batch_size=1000, sampler=sampler)
+            # batches are sampled and gathered as whole tensors, replayed positions and coefficients at edge_to
+            edge_loader = TensorEdgeLoader(edge_to, edge_from, feature_vectors, attention, probs, n_samples, batch_size=1000, node_extras=(embedded, coefficient), device=self.DEVICE)
 
             ########################################################################################################################
             #                                                       TRAIN                                                          #
@@ -973,15 +940,7 @@ class DeepDebugger(StrategyAbstractClass):
     
 
     def _evaluate(self):
-        EPOCH_START = self.config["EPOCH_START"]
-        EPOCH_END = self.config["EPOCH_END"]
-        EPOCH_PERIOD = self.config["EPOCH_PERIOD"]
-        VISUALIZATION_PARAMETER = self.config["VISUALIZATION"]
-        EVALUATION_NAME = VISUALIZATION_PARAMETER["EVALUATION_NAME"]
-        N_NEIGHBORS = VISUALIZATION_PARAMETER["N_NEIGHBORS"]
-        eval_epochs = list(range(EPOCH_START, EPOCH_END+1, EPOCH_PERIOD))
-        for eval_epoch in eval_epochs:
-            self.evaluator.save_epoch_eval(eval_epoch, N_NEIGHBORS, temporal_k=5, file_name="{}".format(EVALUATION_NAME))
+        self._evaluate_epochs()
     
     def _visualize(self):
         EPOCH_START = self.config["EPOCH_START"]
@@ -1070,14 +1029,9 @@ class DVIAL(StrategyAbstractClass):
 
         spatial_cons.record_time(self.data_provider.model_path, "time_{}".format(VIS_MODEL_NAME), "complex_construction", t1-t0)
 
-        dataset = DataHandler(edge_to, edge_from, feature_vectors, attention)
         n_samples = int(np.sum(S_N_EPOCHS * probs) // 1)
-        # chosse sampler based on the number of dataset
-        if len(edge_to) > 2^24:
-            sampler = CustomWeightedRandomSampler(probs, n_samples, replacement=True)
-        else:
-            sampler = WeightedRandomSampler(probs, n_samples, replacement=True)
-        edge_loader = DataLoader(dataset, batch_size=1024, sampler=sampler)
+        # batches are sampled and gathered as whole tensors, no per-edge collation
+        edge_loader = TensorEdgeLoader(edge_to, edge_from, feature_vectors, attention, probs, n_samples, batch_size=1024, device=self.DEVICE)
 
         negative_sample_rate = 5
         min_dist = .1